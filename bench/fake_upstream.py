@@ -0,0 +1,147 @@
+# 基准测试用的假上游：模拟 simple-one-api 的 OpenAI 兼容接口 (/v1/models, /v1/chat/completions)
+# 延迟可配置，支持流式输出，不会真正调用任何大模型服务。
+#
+# 单独运行: python bench/fake_upstream.py --port 9090 --latency-ms 300 --ttft-ms 150 --chunks 20
+# 也可以由 bench/run_bench.py 在后台线程中启动。
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+
+UPSTREAM_DEFAULTS = {
+    "latency_ms": 300,  # 非流式请求的总耗时
+    "ttft_ms": 150,     # 流式请求的首 token 延迟
+    "chunk_ms": 10,     # 流式请求中相邻两个分片的间隔
+    "chunks": 20,       # 每个回答拆成的分片数
+    "jitter": 0.1,      # 各项延迟的随机抖动比例 (0.1 表示 ±10%)
+    "error_rate": 0.0,  # 以该概率返回 500，用于观察重试/熔断下的表现
+}
+
+fake_app = Flask(__name__)
+fake_settings = dict(UPSTREAM_DEFAULTS)
+_stats = {"requests": 0, "streams": 0, "errors": 0}
+_stats_lock = threading.Lock()
+
+def _count(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+def get_upstream_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def _sleep_ms(ms):
+    """按毫秒休眠，叠加随机抖动"""
+    if ms <= 0:
+        return
+    jitter = fake_settings["jitter"]
+    time.sleep(ms * random.uniform(1 - jitter, 1 + jitter) / 1000)
+
+def _estimate_tokens(text):
+    return max(1, len(text) // 2)
+
+def make_answer(messages):
+    """根据最后一条用户消息生成固定格式的回答，长度与分片数相关"""
+    prompt = messages[-1]["content"] if messages else ""
+    return f"收到: {prompt[:40]}。" + "这是基准测试的模拟回答。" * max(1, fake_settings["chunks"] // 4)
+
+def _usage(messages, answer):
+    prompt_tokens = sum(_estimate_tokens(m.get("content") or "") for m in messages)
+    completion_tokens = _estimate_tokens(answer)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+@fake_app.route('/v1/models', methods=['GET'])
+def list_models():
+    return jsonify({"object": "list", "data": [{"id": "bench-model", "object": "model", "owned_by": "bench"}]})
+
+@fake_app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    body = request.get_json(force=True)
+    model = body.get("model", "bench-model")
+    messages = body.get("messages") or []
+    _count("requests")
+
+    if fake_settings["error_rate"] and random.random() < fake_settings["error_rate"]:
+        _count("errors")
+        _sleep_ms(fake_settings["ttft_ms"])
+        return jsonify({"error": {"message": "bench injected error", "type": "server_error"}}), 500
+
+    answer = make_answer(messages)
+    created = int(time.time())
+    completion_id = f"chatcmpl-bench-{created}-{random.randrange(1 << 30)}"
+
+    if not body.get("stream"):
+        _sleep_ms(fake_settings["latency_ms"])
+        return jsonify({
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": _usage(messages, answer),
+        })
+
+    _count("streams")
+    chunk_count = max(1, fake_settings["chunks"])
+    step = max(1, -(-len(answer) // chunk_count)) # 向上取整
+
+    def chunk(delta, finish_reason=None, usage=None):
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        if usage is not None:
+            payload["usage"] = usage
+        return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+    def generate():
+        _sleep_ms(fake_settings["ttft_ms"])
+        yield chunk({"role": "assistant", "content": ""})
+        for i in range(0, len(answer), step):
+            if i:
+                _sleep_ms(fake_settings["chunk_ms"])
+            yield chunk({"content": answer[i:i + step]})
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+        yield chunk({}, "stop", _usage(messages, answer) if include_usage else None)
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+def configure(**overrides):
+    """覆盖假上游的延迟参数 (只接受 UPSTREAM_DEFAULTS 中的键)"""
+    fake_settings.update({k: v for k, v in overrides.items() if k in UPSTREAM_DEFAULTS and v is not None})
+
+def start_fake_upstream(host="127.0.0.1", port=9090, **overrides):
+    """在后台线程中启动假上游，返回 werkzeug 服务器对象 (调用 shutdown() 停止)"""
+    from werkzeug.serving import make_server
+
+    configure(**overrides)
+    server = make_server(host, port, fake_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"假上游已启动: http://{host}:{port}/v1 ({fake_settings})")
+    return server
+
+def add_upstream_arguments(parser):
+    """假上游的命令行参数，run_bench.py 复用"""
+    parser.add_argument("--latency-ms", type=int, default=UPSTREAM_DEFAULTS["latency_ms"], help="非流式请求的耗时 (毫秒)")
+    parser.add_argument("--ttft-ms", type=int, default=UPSTREAM_DEFAULTS["ttft_ms"], help="流式请求的首 token 延迟 (毫秒)")
+    parser.add_argument("--chunk-ms", type=int, default=UPSTREAM_DEFAULTS["chunk_ms"], help="流式分片间隔 (毫秒)")
+    parser.add_argument("--chunks", type=int, default=UPSTREAM_DEFAULTS["chunks"], help="每个回答的分片数")
+    parser.add_argument("--jitter", type=float, default=UPSTREAM_DEFAULTS["jitter"], help="延迟抖动比例")
+    parser.add_argument("--error-rate", type=float, default=UPSTREAM_DEFAULTS["error_rate"], help="返回 500 的概率")
+
+def upstream_overrides(args):
+    return {"latency_ms": args.latency_ms, "ttft_ms": args.ttft_ms, "chunk_ms": args.chunk_ms,
+            "chunks": args.chunks, "jitter": args.jitter, "error_rate": args.error_rate}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="模拟 simple-one-api 的 OpenAI 兼容上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9090, help="默认与 simple-one-api 的端口相同")
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    configure(**upstream_overrides(args))
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.info(f"假上游监听 http://{args.host}:{args.port}/v1 ({fake_settings})")
+    fake_app.run(host=args.host, port=args.port, threaded=True)
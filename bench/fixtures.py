@@ -0,0 +1,96 @@
+# 生成基准测试用的 users.csv / chat_history.csv (格式与 chatapp_new.py 一致)
+# 同一组参数 + seed 生成的数据完全相同，便于前后两次结果对比。
+#
+# 单独运行: python bench/fixtures.py --size 100k --out /tmp/bench_data
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+USERS_HEADER = ["username", "password_hash"]
+HISTORY_COLUMNS = ["session_id", "username", "user_msg", "ai_msg", "timestamp"]
+FIXTURE_SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+BENCH_USER_PREFIX = "bench_user_"  # 有聊天记录、压测时用来登录的用户
+FILLER_USER_PREFIX = "fixture_user_" # 只用于撑大 users.csv 的用户
+BENCH_PASSWORD = "bench"
+BENCH_PASSWORD_HASH = hashlib.sha256(BENCH_PASSWORD.encode("utf-8")).hexdigest() # 与前端一样先做 SHA256
+HISTORY_START = datetime(2025, 1, 1)
+
+_WORDS = ["今天", "天气", "怎么样", "帮我", "写一段", "Python", "代码", "解释", "一下", "这个", "问题", "为什么",
+          "如何", "优化", "SQL", "查询", "性能", "翻译", "成", "英文", "总结", "文章", "要点", "the", "quick",
+          "brown", "fox", "model", "latency", "cache", "请", "给出", "例子", "并且", "说明", "原因"]
+
+def parse_size(size):
+    """'10k' / '100k' / '1m' 或纯数字"""
+    size = str(size).lower()
+    if size in FIXTURE_SIZES:
+        return FIXTURE_SIZES[size]
+    return int(size)
+
+def bench_username(index):
+    return f"{BENCH_USER_PREFIX}{index}"
+
+def _sentence(rng, min_words, max_words):
+    return "".join(rng.choices(_WORDS, k=rng.randint(min_words, max_words)))
+
+def generate_users(path, rows, bench_users):
+    """写入 rows 个用户，其中前 bench_users 个是可登录的压测用户 (密码均为 BENCH_PASSWORD)"""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(USERS_HEADER)
+        for i in range(min(bench_users, rows)):
+            writer.writerow([bench_username(i), BENCH_PASSWORD_HASH])
+        for i in range(max(0, rows - bench_users)):
+            writer.writerow([f"{FILLER_USER_PREFIX}{i}", BENCH_PASSWORD_HASH])
+
+def generate_history(path, rows, bench_users, turns_per_session, seed):
+    """
+    写入 rows 条聊天记录，均匀分给 bench_users 个压测用户。
+    每个会话约 turns_per_session 轮 (随机 ±50%)，时间戳单调递增。
+    返回 {username: [session_id, ...]}。
+    """
+    rng = random.Random(seed)
+    sessions = {bench_username(i): [] for i in range(bench_users)}
+    current = {} # username -> (session_id, 剩余轮数)
+    timestamp = HISTORY_START
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HISTORY_COLUMNS)
+        for n in range(rows):
+            username = bench_username(n % bench_users)
+            session_id, remaining = current.get(username, (None, 0))
+            if remaining <= 0:
+                session_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+                remaining = rng.randint(max(1, turns_per_session // 2), max(1, turns_per_session * 3 // 2))
+                sessions[username].append(session_id)
+            current[username] = (session_id, remaining - 1)
+            timestamp += timedelta(seconds=rng.randint(1, 30))
+            writer.writerow([session_id, username, _sentence(rng, 3, 20), _sentence(rng, 20, 120),
+                             timestamp.strftime("%Y-%m-%d %H:%M:%S")])
+    return sessions
+
+def generate_fixtures(out_dir, rows, bench_users=100, turns_per_session=20, seed=42):
+    """在 out_dir 下生成 users.csv 和 chat_history.csv，返回 {username: [session_id, ...]}"""
+    os.makedirs(out_dir, exist_ok=True)
+    bench_users = max(1, min(bench_users, rows))
+    generate_users(os.path.join(out_dir, "users.csv"), rows, bench_users)
+    sessions = generate_history(os.path.join(out_dir, "chat_history.csv"), rows, bench_users, turns_per_session, seed)
+    logging.info(f"已在 {out_dir} 生成 {rows} 个用户和 {rows} 条聊天记录 "
+                 f"({bench_users} 个压测用户，{sum(len(s) for s in sessions.values())} 个会话)")
+    return sessions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="生成基准测试数据 (users.csv / chat_history.csv)")
+    parser.add_argument("--size", default="10k", help="行数: 10k / 100k / 1m 或具体数字")
+    parser.add_argument("--out", required=True, help="输出目录")
+    parser.add_argument("--bench-users", type=int, default=100, help="拥有聊天记录的压测用户数")
+    parser.add_argument("--turns", type=int, default=20, help="每个会话的平均轮数")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    generate_fixtures(args.out, parse_size(args.size), args.bench_users, args.turns, args.seed)
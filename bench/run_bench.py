@@ -0,0 +1,324 @@
+# 基准测试入口：生成数据 -> 启动假上游和应用 -> 按并发度压测各接口 -> 输出吞吐量和 p50/p95/p99 延迟
+#
+# 示例:
+#   python bench/run_bench.py                                   # 10k 数据，默认场景和并发度
+#   python bench/run_bench.py --size 10k --size 100k --concurrency 1,8,32 --json bench_result.json
+#   python bench/run_bench.py --baseline bench_result.json      # 与上次结果对比，p95 变差超过阈值时返回码为 1
+#
+# 每次运行都在临时目录中复制一份应用并生成数据，不会改动仓库里的 users.csv / chat_history.db 等文件。
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_upstream import add_upstream_arguments, get_upstream_stats, start_fake_upstream, upstream_overrides
+from fixtures import BENCH_PASSWORD_HASH, bench_username, generate_fixtures, parse_size
+
+APP_FILES = ["chatapp_new.py", "Mconfig.json", "config_template.json"] # 运行应用所需的文件
+SCENARIOS = ["login", "get_models", "sessions", "load_session", "search", "send"]
+SEARCH_QUERIES = ["天气", "Python 代码", "优化 查询", "性能", "cache", "翻译成英文"]
+APP_READY_TIMEOUT = 900 # 1M 行数据首次启动需要导入 CSV、构建摘要表，给足时间
+REQUEST_TIMEOUT = 120
+
+# --- 各场景的单次请求 ---
+# 每个函数接收 (client, username, sessions, n)，返回 HTTP 状态码
+
+def request_login(client, username, sessions, n):
+    response = client.post("/api/login", json={"username": username, "password": BENCH_PASSWORD_HASH})
+    return response.status_code
+
+def request_get_models(client, username, sessions, n):
+    return client.get("/api/get_models", params={"user": username}).status_code
+
+def request_sessions(client, username, sessions, n):
+    return client.get("/api/sessions", params={"user": username}).status_code
+
+def request_load_session(client, username, sessions, n):
+    params = {"user": username, "session": sessions[n % len(sessions)]}
+    return client.get("/api/load_session", params=params).status_code
+
+def request_search(client, username, sessions, n):
+    params = {"user": username, "q": SEARCH_QUERIES[n % len(SEARCH_QUERIES)]}
+    return client.get("/api/search", params=params).status_code
+
+def request_send(client, username, sessions, n):
+    # 每条消息都不同，避免命中回答缓存或被合并，测到的是完整的上游调用路径
+    message = f"基准测试消息 {n} {uuid.uuid4().hex[:8]}"
+    return client.post("/api/send", json={"message": message, "username": username}).status_code
+
+SCENARIO_REQUESTS = {
+    "login": request_login,
+    "get_models": request_get_models,
+    "sessions": request_sessions,
+    "load_session": request_load_session,
+    "search": request_search,
+    "send": request_send,
+}
+
+# --- 统计 ---
+
+def percentile(sorted_values, pct):
+    """最近秩法求百分位数 (sorted_values 已升序)"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+# --- 应用进程 ---
+
+def prepare_app_dir(work_dir, rows, args):
+    """复制应用文件、生成数据和 Uconfig.json，返回 {username: [session_id, ...]}"""
+    for name in APP_FILES:
+        shutil.copy2(os.path.join(REPO_DIR, name), os.path.join(work_dir, name))
+    os.makedirs(os.path.join(work_dir, "simple-one-api"), exist_ok=True) # apply_default_config 写入活动配置
+    sessions = generate_fixtures(work_dir, rows, args.bench_users, args.turns, args.seed)
+
+    # 压测期间不做后台归档，避免数据在两轮之间被移动；需要测归档读取路径时用 --uconfig 打开
+    # 准入控制同样关闭：少数压测用户连续发送会用完令牌桶，send 场景测到的将是 429 而不是发送路径；
+    # 需要测准入控制时用 --uconfig 打开
+    uconfig = {"logged_in_user": None, "session_state": {"restore_last_login": False},
+               "history_archive": {"enabled": False}, "admission": {"enabled": False}}
+    if args.uconfig:
+        with open(args.uconfig, "r", encoding="utf-8") as f:
+            uconfig.update(json.load(f)) # 例如关闭回答缓存、切换状态存储后端
+    with open(os.path.join(work_dir, "Uconfig.json"), "w", encoding="utf-8") as f:
+        json.dump(uconfig, f, ensure_ascii=False, indent=4)
+    return sessions
+
+def start_app(work_dir, args):
+    """启动 serve_app.py 子进程并等待其可以响应，返回 (进程, 启动耗时)"""
+    command = [sys.executable, os.path.join(BENCH_DIR, "serve_app.py"), "--app-dir", work_dir,
+               "--upstream", f"http://127.0.0.1:{args.upstream_port}/v1", "--port", str(args.port)]
+    if args.asgi:
+        command.append("--asgi")
+    log_file = open(os.path.join(work_dir, "app.log"), "w", encoding="utf-8")
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    log_file.close() # 子进程持有自己的句柄
+    deadline = time.monotonic() + APP_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"应用进程启动失败 (返回码 {process.returncode})，见 {work_dir}/app.log")
+        try:
+            if httpx.get(f"{app_url(args)}/api/check_auth", timeout=1.0).status_code == 200:
+                return process, time.perf_counter() - start
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    stop_app(process)
+    raise RuntimeError(f"应用在 {APP_READY_TIMEOUT} 秒内未就绪，见 {work_dir}/app.log")
+
+def stop_app(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def app_url(args):
+    return f"http://127.0.0.1:{args.port}"
+
+# --- 压测 ---
+
+def open_worker_clients(args, concurrency):
+    """每个并发 worker 各自登录一个压测用户，返回 [(client, username)]"""
+    workers = []
+    for i in range(concurrency):
+        username = bench_username(i % args.bench_users)
+        client = httpx.Client(base_url=app_url(args), timeout=REQUEST_TIMEOUT)
+        response = client.post("/api/login", json={"username": username, "password": BENCH_PASSWORD_HASH})
+        response.raise_for_status()
+        client.headers["X-Auth-Token"] = response.json()["token"]
+        workers.append((client, username))
+    return workers
+
+def run_scenario(scenario, workers, sessions, total_requests):
+    """所有 worker 并发地从共享计数器领取请求编号，直到发完 total_requests 个"""
+    send_one = SCENARIO_REQUESTS[scenario]
+    latencies = []
+    errors = 0
+    next_request = 0
+    lock = threading.Lock()
+
+    def worker(client, username):
+        nonlocal next_request, errors
+        user_sessions = sessions.get(username) or ["missing"]
+        local_latencies = []
+        local_errors = 0
+        while True:
+            with lock:
+                n = next_request
+                next_request += 1
+            if n >= total_requests:
+                break
+            start = time.perf_counter()
+            try:
+                status = send_one(client, username, user_sessions, n)
+            except httpx.HTTPError:
+                status = None
+            local_latencies.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    threads = [threading.Thread(target=worker, args=w) for w in workers]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def bench_size(size, args):
+    """对一种数据规模跑完所有场景和并发度，返回结果列表"""
+    rows = parse_size(size)
+    work_dir = tempfile.mkdtemp(prefix=f"chatapp_bench_{size}_")
+    results = []
+    process = None
+    try:
+        sessions = prepare_app_dir(work_dir, rows, args)
+        process, startup_seconds = start_app(work_dir, args)
+        logging.info(f"[{size}] 应用就绪，启动耗时 {startup_seconds:.2f} 秒")
+        results.append({"size": size, "scenario": "startup", "concurrency": 1, "requests": 1, "errors": 0,
+                        "throughput_rps": 0.0, "p50_ms": round(startup_seconds * 1000, 2),
+                        "p95_ms": round(startup_seconds * 1000, 2), "p99_ms": round(startup_seconds * 1000, 2),
+                        "max_ms": round(startup_seconds * 1000, 2)})
+        for concurrency in args.concurrency:
+            workers = open_worker_clients(args, concurrency)
+            try:
+                for scenario in args.scenarios:
+                    total = args.requests * (args.send_ratio if scenario == "send" else 1)
+                    total = max(concurrency, int(total))
+                    run_scenario(scenario, workers, sessions, min(total, concurrency * 2)) # 预热
+                    result = run_scenario(scenario, workers, sessions, total)
+                    result.update({"size": size, "scenario": scenario, "concurrency": concurrency})
+                    results.append(result)
+                    logging.info(f"[{size}] {scenario} c={concurrency}: {result}")
+            finally:
+                for client, _ in workers:
+                    client.close()
+    finally:
+        if process is not None:
+            stop_app(process)
+        if args.keep:
+            logging.info(f"[{size}] 保留工作目录: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+# --- 报告 ---
+
+def print_report(results):
+    header = f"{'size':>6} {'scenario':<13} {'conc':>5} {'reqs':>6} {'errs':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['size']:>6} {r['scenario']:<13} {r['concurrency']:>5} {r['requests']:>6} {r['errors']:>5} "
+              f"{r['throughput_rps']:>9.1f} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['max_ms']:>9.1f}")
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    """与基线逐项比较 p95 和吞吐量，返回回归项列表"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["size"], r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get((r["size"], r["scenario"], r["concurrency"]))
+        if old is None:
+            continue
+        if old["p95_ms"] > 0 and r["p95_ms"] > old["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{r['size']} {r['scenario']} c={r['concurrency']}: p95 {old['p95_ms']} -> {r['p95_ms']} ms")
+        if r["scenario"] != "startup" and old["throughput_rps"] > 0 and r["throughput_rps"] < old["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{r['size']} {r['scenario']} c={r['concurrency']}: 吞吐量 {old['throughput_rps']} -> {r['throughput_rps']} rps")
+        if r["errors"] > old["errors"]:
+            regressions.append(f"{r['size']} {r['scenario']} c={r['concurrency']}: 错误数 {old['errors']} -> {r['errors']}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="chatapp_new 基准测试")
+    parser.add_argument("--size", action="append", help="数据规模 (10k / 100k / 1m 或具体行数)，可重复，默认 10k")
+    parser.add_argument("--concurrency", default="1,8,32", help="并发度列表，逗号分隔")
+    parser.add_argument("--requests", type=int, default=200, help="每个场景、每个并发度的请求数")
+    parser.add_argument("--send-ratio", type=float, default=0.5, help="send 场景的请求数相对 --requests 的比例 (每次都要等上游)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"要跑的场景，逗号分隔 ({', '.join(SCENARIOS)})")
+    parser.add_argument("--bench-users", type=int, default=100, help="拥有聊天记录的压测用户数")
+    parser.add_argument("--turns", type=int, default=20, help="每个会话的平均轮数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=5055, help="应用监听端口")
+    parser.add_argument("--upstream-port", type=int, default=9190, help="假上游端口 (避开 simple-one-api 的 9090-9092)")
+    parser.add_argument("--asgi", action="store_true", help="以异步模式启动应用")
+    parser.add_argument("--uconfig", help="合并进 Uconfig.json 的 JSON 文件 (覆盖缓存、容错等设置)")
+    parser.add_argument("--json", help="把结果写入该 JSON 文件")
+    parser.add_argument("--baseline", help="与之前 --json 输出的结果对比")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的 p95/吞吐量退化比例")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录 (含 app.log)")
+    add_upstream_arguments(parser)
+    args = parser.parse_args(argv)
+    args.size = args.size or ["10k"]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIO_REQUESTS]
+    if unknown:
+        parser.error(f"未知场景: {unknown}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    upstream = start_fake_upstream(port=args.upstream_port, **upstream_overrides(args))
+    results = []
+    try:
+        for size in args.size:
+            results.extend(bench_size(size, args))
+    finally:
+        upstream.shutdown()
+
+    print_report(results)
+    logging.info(f"假上游共收到请求: {get_upstream_stats()}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "upstream": upstream_overrides(args),
+                       "asgi": args.asgi, "results": results}, f, ensure_ascii=False, indent=2)
+        logging.info(f"结果已写入 {args.json}")
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        for line in regressions:
+            logging.error(f"性能回归: {line}")
+        if regressions:
+            return 1
+        logging.info("与基线相比没有超过阈值的回归")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+# 以无窗口方式启动 chatapp_new.py，供基准测试驱动
+# 与 `python chatapp_new.py` 的区别：不启动 simple-one-api 和 webview，上游改为指定的地址 (通常是 fake_upstream.py)。
+#
+# 用法: python bench/serve_app.py --app-dir <含 chatapp_new.py 的目录> --upstream http://127.0.0.1:9090/v1 [--asgi]
+import argparse
+import logging
+import os
+import signal
+import sys
+import time
+
+def main():
+    parser = argparse.ArgumentParser(description="启动 chatapp_new 供基准测试使用")
+    parser.add_argument("--app-dir", required=True, help="chatapp_new.py 所在目录 (数据文件也在这里)")
+    parser.add_argument("--upstream", default="http://127.0.0.1:9090/v1", help="OpenAI 兼容上游地址")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--asgi", action="store_true", help="使用异步模式 (需要 asgiref 和 uvicorn)")
+    args = parser.parse_args()
+
+    app_dir = os.path.abspath(args.app_dir)
+    sys.path.insert(0, app_dir)
+    os.chdir(app_dir)
+    start = time.perf_counter()
+    import chatapp_new
+
+    # 不启动 simple-one-api，直接指向假上游；run_startup 完成 CSV 导入、摘要表构建等初始化
+    chatapp_new.BASE_URL = args.upstream.rstrip("/")
+    chatapp_new.reset_openai_client()
+    chatapp_new.run_startup(launch_sidecar=False)
+    logging.info(f"chatapp_new 初始化耗时 {time.perf_counter() - start:.2f} 秒")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING) # 关闭逐请求的访问日志
+
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    try:
+        if args.asgi:
+            import uvicorn
+            uvicorn.run(chatapp_new.create_asgi_app(), host=args.host, port=args.port, log_level="warning")
+        else:
+            from werkzeug.serving import make_server
+            server = make_server(args.host, args.port, chatapp_new.app, threaded=True)
+            logging.info(f"基准测试服务已启动: http://{args.host}:{args.port} (上游 {chatapp_new.BASE_URL})")
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        chatapp_new.stop_history_writer()
+        chatapp_new.flush_user_keys()
+        chatapp_new.flush_usage()
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,56 @@
 # app.py (Flask后端)
-from flask import Flask, jsonify, request, send_from_directory
-from openai import OpenAI
-import subprocess
+from flask import Flask, jsonify, request, send_from_directory, Response, stream_with_context, g
+# **修改：** openai、httpx、subprocess 改为在首次使用的函数内导入 (仅 openai 导入就要近 1 秒)，加快启动
 import os
 import csv
+import io
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import json # <-- 导入 json 模块
-import shutil # <-- 新增：导入 shutil 用于文件操作
+import sqlite3 # <-- 新增：聊天历史改用 SQLite 存储
+import threading
+import queue
+import atexit
+import socket
+from contextlib import contextmanager
+import asyncio
+import sys
+import time
+from collections import deque, OrderedDict
+import base64
+import binascii
+import hashlib
+import copy
+import tempfile
+import bisect
+import heapq
+import math
+import random
+import email.utils
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, FIRST_COMPLETED
+import http.cookies
+import re
+import unicodedata
+import struct
+import zlib
+
+_MODULE_LOAD_START = time.perf_counter() # 启动阶段计时的起点 (见 run_startup)
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
 app = Flask(__name__, static_folder='static')
-current_session = str(uuid.uuid4()) ## 全局会话 ID，现在主要由前端在加载历史时设置
 BASE_DIR = os.path.dirname(__file__)
 SETTING_DIR = os.path.join(BASE_DIR, "setting")
 
-HISTORY_PATH = os.path.join(BASE_DIR, "chat_history.csv") ## 聊天历史
+HISTORY_PATH = os.path.join(BASE_DIR, "chat_history.csv") ## 聊天历史 (旧版 CSV，仅用于一次性导入)
+HISTORY_DB_PATH = os.path.join(BASE_DIR, "chat_history.db") # 新增：聊天历史 SQLite 数据库
+COMPLETION_CACHE_DB_PATH = os.path.join(BASE_DIR, "completion_cache.db") # 新增：回答缓存的磁盘层
+STATE_DB_PATH = os.path.join(BASE_DIR, "session_state.db") # 新增：用户会话状态 (sqlite 存储时使用)
 USERS_PATH = os.path.join(BASE_DIR, "users.csv") # 新增：用户存储文件
+USERS_HEADER = ["username", "password_hash"] # users.csv 表头
 CONFIG_PATH = os.path.join(BASE_DIR, "Uconfig.json") # <-- 新增：用户界面配置路径
 
 # --- 新增：API 相关路径 ---
@@ -36,9 +66,239 @@ MCONFIG_PATH = os.path.join(BASE_DIR, "Mconfig.json")
 
 # --- 全局变量 ---
 api_process = None # 存储 API 进程
-current_logged_in_user = None # 当前登录用户
 config = {} # 用户界面配置 (Uconfig.json)
 
+# --- 新增：文件存储层 (原子替换 + 跨进程文件锁 + 读缓存) ---
+# 以前 JSON/CSV 文件都用 open(..., 'w') 原地改写，多个工作进程 (例如 gunicorn -w N) 同时写入时
+# 会出现写了一半的文件或互相覆盖的修改。现在所有写入都先写同目录的临时文件、fsync 后 os.replace
+# 原子替换；"读取-修改-写回" 在文件锁 (<path>.lock，只约束同样使用 file_lock 的代码) 内完成。
+# 本进程写入后直接更新 load_json_cached 的缓存，之后的读取一定能看到自己刚写的内容。
+CONFIG_CACHE_CHECK_INTERVAL = 1.0 # 两次 stat 检查之间的最短间隔 (秒)，其他进程的修改最多延迟这么久可见
+FILE_LOCK_POLL_INTERVAL = 0.05 # Windows 下等待文件锁的轮询间隔 (秒)
+_json_file_cache = {} # path -> {"signature": (mtime_ns, size), "data": 解析结果, "checked_at": 时间}
+_json_file_cache_lock = threading.Lock()
+
+@contextmanager
+def file_lock(path):
+    """跨进程的排他文件锁 (建议锁)"""
+    with open(path + ".lock", "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt # 平台相关模块，按需导入
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(FILE_LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def _write_file_atomic(path, write, binary=False):
+    """调用 write(f) 写入同目录的临时文件，fsync 后原子替换 path (调用方负责加锁)"""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8", newline="")) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _remember_json(path, data):
+    """写入后更新读缓存 (read-your-writes)"""
+    st = os.stat(path)
+    with _json_file_cache_lock:
+        _json_file_cache[path] = {"signature": (st.st_mtime_ns, st.st_size),
+                                  "data": copy.deepcopy(data), "checked_at": time.monotonic()}
+
+def write_json_atomic(path, data, indent=4):
+    """原子地整体写入 JSON 文件"""
+    with file_lock(path):
+        _write_file_atomic(path, lambda f: json.dump(data, f, indent=indent, ensure_ascii=False))
+        _remember_json(path, data)
+
+def update_json_file(path, mutate, indent=4):
+    """在文件锁内读取磁盘上的最新内容，调用 mutate(data) 原地修改后原子写回，返回写入的数据"""
+    with file_lock(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+            data = json.loads(content) if content.strip() else {}
+        except FileNotFoundError:
+            data = {}
+        mutate(data)
+        _write_file_atomic(path, lambda f: json.dump(data, f, indent=indent, ensure_ascii=False))
+        _remember_json(path, data)
+    return data
+
+def copy_file_atomic(src, dst):
+    """把 src 的内容原子地复制到 dst"""
+    with open(src, "rb") as f:
+        content = f.read()
+    with file_lock(dst):
+        _write_file_atomic(dst, lambda f: f.write(content), binary=True)
+
+def load_json_cached(path):
+    """
+    读取 JSON 文件并缓存解析结果，返回 (data, signature)。
+    文件不存在或格式错误时抛出 FileNotFoundError / json.JSONDecodeError。
+    返回的 data 为共享对象，调用方不要修改。
+    """
+    now = time.monotonic()
+    with _json_file_cache_lock:
+        entry = _json_file_cache.get(path)
+        if entry and now - entry["checked_at"] < CONFIG_CACHE_CHECK_INTERVAL:
+            return entry["data"], entry["signature"]
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _json_file_cache_lock:
+        entry = _json_file_cache.get(path)
+        if entry and entry["signature"] == signature:
+            entry["checked_at"] = now
+            return entry["data"], signature
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    with _json_file_cache_lock:
+        _json_file_cache[path] = {"signature": signature, "data": data, "checked_at": now}
+    logging.info(f"已加载配置文件 {path}")
+    return data, signature
+
+# --- 新增：Prometheus 指标 (/metrics) ---
+# 以前只有日志，没有可以汇总的数据。这里维护一个很小的指标表 (计数器 / 仪表 / 直方图)，
+# 热点路径上每次记录只是一次加锁和一次二分查找，开销足够低，可以在生产环境常开。
+# 仪表中 "当前值" 类的数据 (在途请求数、队列长度等) 在渲染 /metrics 时由采集函数读取。
+METRIC_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_metrics = {} # name -> {"type", "help", "labels", "buckets", "series": {标签值元组: 值}}
+_metrics_lock = threading.Lock()
+_gauge_collectors = [] # 渲染时调用的函数，返回 [(name, 标签值元组, 值), ...]
+
+def register_metric(name, metric_type, help_text, labels=(), buckets=METRIC_LATENCY_BUCKETS):
+    """登记一个指标 (metric_type 为 "counter" / "gauge" / "histogram")"""
+    _metrics[name] = {"type": metric_type, "help": help_text, "labels": tuple(labels),
+                      "buckets": tuple(buckets) if metric_type == "histogram" else (), "series": {}}
+
+def observe(name, value, *label_values):
+    """直方图记录一次观测值"""
+    metric = _metrics[name]
+    index = bisect.bisect_left(metric["buckets"], value)
+    with _metrics_lock:
+        series = metric["series"].get(label_values)
+        if series is None:
+            series = metric["series"][label_values] = [0] * (len(metric["buckets"]) + 1) + [0.0]
+        series[index] += 1 # 最后一个桶为 +Inf
+        series[-1] += value
+
+def inc_counter(name, *label_values, amount=1):
+    """计数器 / 仪表增加 amount (仪表可以为负)"""
+    metric = _metrics[name]
+    with _metrics_lock:
+        metric["series"][label_values] = metric["series"].get(label_values, 0) + amount
+
+def set_gauge(name, value, *label_values):
+    with _metrics_lock:
+        _metrics[name]["series"][label_values] = value
+
+@contextmanager
+def observe_duration(name, *label_values):
+    """用法：with observe_duration("xxx_seconds"): ...，把耗时记录到直方图"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, *label_values)
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render_metrics():
+    """按 Prometheus 文本格式输出全部指标"""
+    collected = {}
+    for collector in _gauge_collectors:
+        try:
+            for name, label_values, value in collector():
+                collected.setdefault(name, {})[label_values] = value
+        except Exception as e:
+            logging.error(f"采集指标时出错: {e}")
+    lines = []
+    with _metrics_lock:
+        for name, metric in _metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            series = dict(metric["series"])
+            series.update(collected.get(name, {}))
+            for label_values, value in series.items():
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_format_labels(metric['labels'], label_values)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    le = 'le="' + (bound if bound == "+Inf" else repr(float(bound))) + '"'
+                    lines.append(f"{name}_bucket{_format_labels(metric['labels'], label_values, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(metric['labels'], label_values)} {value[-1]}")
+                lines.append(f"{name}_count{_format_labels(metric['labels'], label_values)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+register_metric("chatapp_http_request_duration_seconds", "histogram",
+                "HTTP request latency by route (streaming routes: time until the response starts)",
+                ("route", "method", "status"))
+register_metric("chatapp_http_requests_in_progress", "gauge", "HTTP requests currently being handled")
+register_metric("chatapp_upstream_request_duration_seconds", "histogram",
+                "Upstream model call latency per attempt (streaming: until the stream ends)", ("model", "outcome"))
+register_metric("chatapp_upstream_ttft_seconds", "histogram", "Upstream time to first token", ("model",))
+register_metric("chatapp_upstream_in_flight", "gauge", "Upstream requests in flight by base URL", ("base_url",))
+register_metric("chatapp_save_chat_duration_seconds", "histogram", "save_chat duration (summary update + enqueue)")
+register_metric("chatapp_history_read_duration_seconds", "histogram", "History read duration", ("operation",))
+register_metric("chatapp_history_write_batch_duration_seconds", "histogram", "Background history batch commit duration")
+register_metric("chatapp_history_queue_depth", "gauge", "Chat records waiting for the background writer")
+register_metric("chatapp_sidecar_restarts_total", "counter", "simple-one-api restarts by result", ("result",))
+register_metric("chatapp_sidecar_restart_duration_seconds", "histogram", "Time from restart request to traffic switch")
+register_metric("chatapp_sidecar_downtime_seconds", "histogram",
+                "Time without a ready simple-one-api during a restart (0 for blue/green switches)")
+
+@app.before_request
+def _metrics_before_request():
+    g.metrics_start = time.perf_counter()
+    inc_counter("chatapp_http_requests_in_progress")
+
+@app.after_request
+def _metrics_after_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        observe("chatapp_http_request_duration_seconds", time.perf_counter() - start,
+                route, request.method, str(response.status_code))
+    return response
+
+@app.teardown_request
+def _metrics_teardown_request(error=None):
+    inc_counter("chatapp_http_requests_in_progress", amount=-1)
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # --- 新增：用户密钥管理函数 ---
 
 def load_user_keys():
@@ -59,59 +319,94 @@ def load_user_keys():
         return {}
 
 def save_user_keys(user_keys_data):
-    """保存所有用户的密钥"""
+    """保存所有用户的密钥 (**修改：** 原子替换)"""
     try:
-        with open(USER_KEYS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(user_keys_data, f, indent=4, ensure_ascii=False)
+        write_json_atomic(USER_KEYS_PATH, user_keys_data)
         logging.info(f"用户密钥已保存到 {USER_KEYS_PATH}")
-    except IOError as e:
+    except OSError as e:
         logging.error(f"保存用户密钥文件 {USER_KEYS_PATH} 时出错: {e}")
 
-def merge_config_with_user_keys(username):
-    """将用户密钥合并到模板配置中，并写入活动的 config.json"""
+# --- 新增：内存中的用户密钥表 ---
+# 用户密钥不再合并进 simple-one-api 的 config.json，而是在每次上游调用时按用户注入。
+# 读取走 load_json_cached，文件未变化时不重新解析；修改密钥只更新内存，文件在后台延迟写回。
+# 多个工作进程时，写回只把本进程的修改合并进文件里的最新内容，其他进程的修改在文件变化后重新载入。
+USER_KEYS_SAVE_DELAY = 0.5 # 延迟写回的秒数，短时间内的多次修改合并为一次写入
+_user_keys_map = None # username -> {model_name: api_key}
+_user_keys_signature = None # _user_keys_map 对应的文件签名
+_user_keys_pending = {} # 本进程尚未写回文件的修改 username -> {model_name: api_key}
+_user_keys_lock = threading.Lock()
+_user_keys_save_timer = None
+
+def _ensure_user_keys_loaded():
+    """返回内存密钥表；文件被其他进程修改过时重新载入，并叠加本进程尚未写回的修改"""
+    global _user_keys_map, _user_keys_signature
+    if not os.path.exists(USER_KEYS_PATH):
+        load_user_keys() # 创建空文件
     try:
-        # 1. 读取模板配置
-        if not os.path.exists(CONFIG_TEMPLATE_PATH):
-             logging.error(f"配置模板 {CONFIG_TEMPLATE_PATH} 未找到！无法加载配置。")
-             # 尝试从当前的活动配置创建模板？或者报错？这里选择报错
-             return False
-        with open(CONFIG_TEMPLATE_PATH, 'r', encoding='utf-8') as f:
-            active_config = json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        logging.error(f"无法读取配置模板 {CONFIG_TEMPLATE_PATH}: {e}。无法为用户 {username} 加载配置。")
-        return False # 返回失败
-
-    # 2. 读取用户密钥
-    all_user_keys = load_user_keys()
-    user_specific_keys = all_user_keys.get(username, {}) # 获取当前用户的密钥字典
-
-    # 3. 合并密钥 (只合并用户已定义的key)
-    if user_specific_keys and 'services' in active_config:
-        logging.info(f"为用户 {username} 合并已保存的密钥...")
-        for service_type, service_list in active_config.get('services', {}).items():
-            for i, service_instance in enumerate(service_list):
-                models_in_instance = service_instance.get("models", [])
-                # 检查此服务实例中的任何模型是否在用户的密钥中有定义
-                for model_name in models_in_instance:
-                    if model_name in user_specific_keys:
-                        user_key = user_specific_keys[model_name]
-                        if user_key: # 只合并非空的 key
-                             if "credentials" not in active_config['services'][service_type][i]:
-                                 active_config['services'][service_type][i]["credentials"] = {}
-                             active_config['services'][service_type][i]["credentials"]["api_key"] = user_key
-                             logging.debug(f"  - 模型 {model_name} (服务 {service_type}) 使用用户保存的密钥。")
-                             # 假设一个服务实例共享一个key，找到一个匹配就更新并跳出内层 model 循环
-                             break
-
-    # 4. 写入活动的 config.json
-    try:
-        with open(CONFIG_ACTIVE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(active_config, f, indent=2, ensure_ascii=False) # Use indent=2 like original config
-        logging.info(f"已为用户 {username} 更新活动的配置文件 {CONFIG_ACTIVE_PATH}")
-        return True # 返回成功
-    except IOError as e:
-        logging.error(f"写入活动配置文件 {CONFIG_ACTIVE_PATH} 时出错: {e}")
-        return False # 返回失败
+        data, signature = load_json_cached(USER_KEYS_PATH)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"读取用户密钥文件 {USER_KEYS_PATH} 时出错: {e}. 使用内存中的数据。")
+        data, signature = {}, _user_keys_signature
+    with _user_keys_lock:
+        if _user_keys_map is None or signature != _user_keys_signature:
+            keys_map = {user: dict(keys) for user, keys in data.items()}
+            for user, keys in _user_keys_pending.items():
+                keys_map.setdefault(user, {}).update(keys)
+            _user_keys_map = keys_map
+            _user_keys_signature = signature
+        return _user_keys_map
+
+def get_user_keys(username):
+    """返回该用户所有模型的密钥 (副本)"""
+    keys_map = _ensure_user_keys_loaded()
+    with _user_keys_lock:
+        return dict(keys_map.get(username, {}))
+
+def get_user_key(username, model_name):
+    """返回该用户为模型保存的非空密钥，没有则返回 None"""
+    if not username:
+        return None
+    keys_map = _ensure_user_keys_loaded()
+    with _user_keys_lock:
+        return keys_map.get(username, {}).get(model_name) or None
+
+def set_user_key(username, model_name, api_key):
+    """更新内存中的密钥 (空字符串表示清除)，并安排后台写回文件"""
+    global _user_keys_save_timer
+    keys_map = _ensure_user_keys_loaded()
+    with _user_keys_lock:
+        keys_map.setdefault(username, {})[model_name] = api_key
+        _user_keys_pending.setdefault(username, {})[model_name] = api_key
+        if _user_keys_save_timer is None:
+            _user_keys_save_timer = threading.Timer(USER_KEYS_SAVE_DELAY, flush_user_keys)
+            _user_keys_save_timer.daemon = True
+            _user_keys_save_timer.start()
+
+def flush_user_keys():
+    """把本进程的密钥修改合并写回 user_api_keys.json (后台定时器和程序退出时调用)"""
+    global _user_keys_save_timer, _user_keys_pending
+    with _user_keys_lock:
+        if _user_keys_save_timer is not None:
+            _user_keys_save_timer.cancel()
+            _user_keys_save_timer = None
+        pending, _user_keys_pending = _user_keys_pending, {}
+    if not pending:
+        return
+
+    def merge(data):
+        for user, keys in pending.items():
+            data.setdefault(user, {}).update(keys)
+
+    try:
+        update_json_file(USER_KEYS_PATH, merge)
+        logging.info(f"用户密钥已保存到 {USER_KEYS_PATH}")
+    except OSError as e:
+        logging.error(f"保存用户密钥文件 {USER_KEYS_PATH} 时出错: {e}")
+        with _user_keys_lock: # 放回待写队列，下次再试 (期间的新修改优先)
+            for user, keys in pending.items():
+                merged = dict(keys)
+                merged.update(_user_keys_pending.get(user, {}))
+                _user_keys_pending[user] = merged
 
 def apply_default_config():
     """将模板配置写回活动的 config.json"""
@@ -119,8 +414,8 @@ def apply_default_config():
          logging.error(f"配置模板 {CONFIG_TEMPLATE_PATH} 未找到！无法恢复默认配置。")
          return False
     try:
-        # 直接复制模板文件到活动配置文件路径
-        shutil.copy2(CONFIG_TEMPLATE_PATH, CONFIG_ACTIVE_PATH)
+        # 复制模板文件到活动配置文件路径 (**修改：** 原子替换，simple-one-api 不会读到写了一半的文件)
+        copy_file_atomic(CONFIG_TEMPLATE_PATH, CONFIG_ACTIVE_PATH)
         logging.info(f"已将默认配置模板 {CONFIG_TEMPLATE_PATH} 应用到活动配置 {CONFIG_ACTIVE_PATH}")
         return True
     except Exception as e:
@@ -132,60 +427,691 @@ def apply_default_config():
 
 def load_config():
     """从 config.json 加载配置"""
-    global current_logged_in_user
     try:
         if os.path.exists(CONFIG_PATH):
             with open(CONFIG_PATH, "r", encoding="utf-8") as f:
                 config_data = json.load(f)
-                current_logged_in_user = config_data.get("logged_in_user") # 读取已登录用户
-                logging.info(f"从配置文件加载登录用户: {current_logged_in_user}")
+                logging.info(f"从配置文件加载上次登录用户: {config_data.get('logged_in_user')}")
                 return config_data
         else:
             logging.info(f"配置文件 {CONFIG_PATH} 不存在，将创建。")
-            # 文件不存在，返回默认空配置，并初始化 current_logged_in_user 为 None
-            current_logged_in_user = None
+            # 文件不存在，返回默认空配置
             return {"logged_in_user": None}
     except (json.JSONDecodeError, IOError) as e:
         logging.error(f"读取配置文件 {CONFIG_PATH} 时出错: {e}。将使用默认配置。")
         # 文件损坏或读取错误，同样返回默认
-        current_logged_in_user = None
         return {"logged_in_user": None}
 
 def save_config(config_data):
-    """将配置数据保存到 config.json"""
+    """将配置数据保存到 config.json (**修改：** 只把给出的键合并进文件中的最新内容，不覆盖其他进程的修改)"""
     try:
-        with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(config_data, f, indent=4, ensure_ascii=False) # indent=4 使文件更易读
+        update_json_file(CONFIG_PATH, lambda data: data.update(config_data))
         logging.info(f"配置已保存到 {CONFIG_PATH}")
-    except IOError as e:
+    except OSError as e:
         logging.error(f"保存配置文件 {CONFIG_PATH} 时出错: {e}")
 
 # --- 程序启动时加载配置 ---
-config = load_config() # 加载初始配置并设置 current_logged_in_user
+config = load_config() # 加载初始配置
+
+
+# --- 新增：聊天历史 SQLite 存储 ---
+# 旧实现每次请求都要把 chat_history.csv 从头读到尾（包含所有用户的记录），
+# 现在改为 WAL 模式的 SQLite，按 (username, timestamp) / (session_id, timestamp) 建索引，
+# 查询开销只和请求用户自己的数据量有关。
+HISTORY_COLUMNS = ["session_id", "username", "user_msg", "ai_msg", "timestamp"]
+_history_db_local = threading.local() # sqlite3 连接不能跨线程使用，每个线程各持有一个
+
+def get_history_db():
+    """获取当前线程的历史数据库连接（首次调用时创建）"""
+    conn = getattr(_history_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(HISTORY_DB_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL") # 读写互不阻塞
+        conn.execute("PRAGMA synchronous=NORMAL") # WAL 下 NORMAL 已足够安全，写入更快
+        # 新增：全文索引在 SQL 中调用的分词函数
+        conn.create_function("search_owner_token", 1, search_owner_token, deterministic=True)
+        conn.create_function("search_index_text", 2, search_index_text, deterministic=True)
+        _history_db_local.conn = conn
+    return conn
+
+def initialize_history_db():
+    """创建历史表和索引（如果不存在）"""
+    conn = get_history_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                user_msg TEXT NOT NULL,
+                ai_msg TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_time ON chat_history (username, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session_time ON chat_history (session_id, timestamp)")
+        conn.execute("CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value TEXT)")
+        # 新增：会话摘要表，save_chat 每次写入时同步更新，/api/sessions 只读这张表
+        # 注意 session_id 是全局生成的，不同用户可能共用同一个，所以主键是 (username, session_id)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                last_time TEXT NOT NULL,
+                preview TEXT NOT NULL,
+                message_count INTEGER NOT NULL,
+                PRIMARY KEY (username, session_id)
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_time ON chat_sessions (username, last_time)")
+        # 新增：每个用户的历史版本号，write_history_batch 每次写入时递增 (见 history_cache_version)
+        conn.execute("CREATE TABLE IF NOT EXISTS history_versions (username TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        # 新增：已移入归档段的记录 (只保留定位信息，内容在 history_archive 中)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_archive_rows (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_rows_session ON chat_archive_rows (session_id)")
+        # 新增：按用户、模型、小时汇总的 token 用量 (见 record_usage / flush_usage)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_hourly (
+                username TEXT NOT NULL,
+                hour TEXT NOT NULL,
+                model TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                total_tokens INTEGER NOT NULL,
+                latency_ms REAL NOT NULL,
+                estimated_calls INTEGER NOT NULL,
+                coalesced_calls INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, hour, model)
+            )""")
+        if "coalesced_calls" not in {row[1] for row in conn.execute("PRAGMA table_info(usage_hourly)")}:
+            conn.execute("ALTER TABLE usage_hourly ADD COLUMN coalesced_calls INTEGER NOT NULL DEFAULT 0")
+
+def import_csv_history(csv_path=HISTORY_PATH):
+    """
+    一次性把旧版 chat_history.csv 导入 SQLite。
+    导入完成后在 history_meta 中打标记，之后再调用直接返回。返回导入的行数。
+    """
+    conn = get_history_db()
+    if conn.execute("SELECT 1 FROM history_meta WHERE key = 'csv_imported'").fetchone():
+        return 0
+    if not os.path.exists(csv_path):
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('csv_imported', ?)", ("no_csv",))
+        return 0
+
+    imported = 0
+    skipped = 0
+    try:
+        with open(csv_path, "r", newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is not None and header != HISTORY_COLUMNS:
+                logging.error(f"历史文件表头不匹配: {header}，跳过导入")
+                return 0
 
+            def valid_rows():
+                nonlocal imported, skipped
+                for row in reader:
+                    if len(row) == 5:
+                        imported += 1
+                        yield row
+                    else:
+                        skipped += 1
+
+            # 整个导入放在一个事务里，中途失败不会留下半份数据
+            with conn:
+                conn.executemany(
+                    "INSERT INTO chat_history (session_id, username, user_msg, ai_msg, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    valid_rows())
+                conn.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('csv_imported', ?)",
+                             (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+    except (IOError, csv.Error) as e:
+        logging.error(f"导入历史文件 {csv_path} 时出错: {e}")
+        return 0
+
+    logging.info(f"已从 {csv_path} 导入 {imported} 条聊天记录到 {HISTORY_DB_PATH} (跳过格式不正确的行 {skipped} 条)")
+    return imported
+
+# --- 新增：历史版本号 ---
+# 会话摘要索引和上下文窗口都是进程内缓存，多个工作进程 (gunicorn -w N) 共用一个数据库时，
+# 其他进程写入的记录不会出现在本进程的缓存里。history_versions 表为每个用户记一个版本号，
+# write_history_batch 在写入记录的同一事务中递增。使用缓存前先查一次版本号 (主键查询)：
+# 从缓存加载时的版本到当前版本之间的每次递增都是本进程写入的 (缓存里已经有)，缓存才继续有效。
+HISTORY_LOCAL_VERSIONS_KEEP = 256 # 每个用户最多记住本进程最近的这么多次写入，更早的按过期处理
+HISTORY_BUMP_VERSION_SQL = """
+    INSERT INTO history_versions (username, version) VALUES (?, 1)
+    ON CONFLICT (username) DO UPDATE SET version = version + 1"""
+_history_local_versions = {} # username -> {本进程写入前的版本号}
+_history_versions_lock = threading.Lock()
+_history_write_seq = {} # username -> 本进程 save_chat 的次数 (持 _session_index_lock 和 _context_lock 修改)
+
+def get_history_version(username):
+    row = get_history_db().execute("SELECT version FROM history_versions WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else 0
+
+def bump_history_versions(conn, usernames):
+    """在写入事务中递增这些用户的版本号，返回 [(username, 递增前的版本号)]"""
+    bumped = []
+    for username in usernames:
+        conn.execute(HISTORY_BUMP_VERSION_SQL, (username,))
+        version = conn.execute("SELECT version FROM history_versions WHERE username = ?", (username,)).fetchone()[0]
+        bumped.append((username, version - 1))
+    return bumped
+
+def remember_local_history_versions(bumped):
+    """提交成功后记下本进程的写入 (对应的记录已经由 save_chat 加进了缓存)"""
+    with _history_versions_lock:
+        for username, version in bumped:
+            versions = _history_local_versions.setdefault(username, set())
+            versions.add(version)
+            if len(versions) > HISTORY_LOCAL_VERSIONS_KEEP:
+                versions.discard(min(versions))
+
+def history_cache_version(username, cached_version):
+    """缓存仍然有效时返回数据库中的当前版本号 (调用方据此更新缓存的版本)，其他进程写入过则返回 None"""
+    current = get_history_version(username)
+    if current < cached_version:
+        return None # 数据库被替换或重建
+    with _history_versions_lock:
+        local = _history_local_versions.get(username, ())
+        if all(version in local for version in range(cached_version, current)):
+            return current
+    return None
+
+def history_write_seq(username):
+    return _history_write_seq.get(username, 0)
+
+def _count_history_write_locked(username):
+    """save_chat 入队时调用 (调用方需持有 _session_index_lock 和 _context_lock)：
+    缓存加载期间本进程又写入了该用户的记录时，加载结果不放入缓存"""
+    _history_write_seq[username] = _history_write_seq.get(username, 0) + 1
+
+# --- 新增：会话摘要索引 ---
+# chat_sessions 表是持久化快照，_session_index 是内存副本 (username -> {"version", "sessions": {session_id: 摘要}})。
+# 只在摘要表缺失或与明细表对不上时才从 chat_history 全量重建。
+_session_index = {}
+_session_index_lock = threading.Lock()
+
+def make_preview(user_msg):
+    """会话列表中显示的预览文本"""
+    return user_msg[:30] + "..." if len(user_msg) > 30 else user_msg
+
+def rebuild_session_summary():
+    """从 chat_history 明细 (和归档段) 全量重建 chat_sessions 摘要表"""
+    conn = get_history_db()
+    with conn:
+        conn.execute("DELETE FROM chat_sessions")
+        # 每个 (username, session_id) 取时间最新的一条作为 last_time / preview
+        conn.execute("""
+            INSERT INTO chat_sessions (username, session_id, last_time, preview, message_count)
+            SELECT username, session_id, timestamp,
+                   CASE WHEN length(user_msg) > 30 THEN substr(user_msg, 1, 30) || '...' ELSE user_msg END,
+                   cnt
+            FROM (
+                SELECT username, session_id, timestamp, user_msg,
+                       COUNT(*) OVER (PARTITION BY username, session_id) AS cnt,
+                       ROW_NUMBER() OVER (PARTITION BY username, session_id ORDER BY timestamp DESC, id DESC) AS rn
+                FROM chat_history
+            )
+            WHERE rn = 1""")
+        merge_archive_into_session_summary(conn) # 已归档的轮次不在 chat_history 中，从归档段尾部索引补上
+        conn.execute("INSERT OR REPLACE INTO history_meta (key, value) VALUES ('session_summary_ready', '1')")
+    with _session_index_lock:
+        _session_index.clear()
+    logging.info("会话摘要表已从聊天历史重建")
+
+def ensure_session_summary():
+    """启动时检查摘要表：缺失标记、损坏或消息数与明细不一致时重建"""
+    conn = get_history_db()
+    try:
+        ready = conn.execute("SELECT 1 FROM history_meta WHERE key = 'session_summary_ready'").fetchone()
+        if ready:
+            summary_total = conn.execute("SELECT COALESCE(SUM(message_count), 0) FROM chat_sessions").fetchone()[0]
+            history_total = conn.execute(
+                "SELECT (SELECT COUNT(*) FROM chat_history) + (SELECT COUNT(*) FROM chat_archive_rows)").fetchone()[0]
+            if summary_total == history_total:
+                return
+            logging.warning(f"会话摘要消息数 ({summary_total}) 与历史记录数 ({history_total}) 不一致，将重建摘要")
+        else:
+            logging.info("会话摘要表尚未建立，开始构建...")
+    except sqlite3.DatabaseError as e:
+        logging.error(f"读取会话摘要表出错: {e}，将重建摘要")
+    rebuild_session_summary()
+
+def get_user_sessions(username):
+    """返回该用户的会话摘要字典，首次访问或其他进程写入过该用户的记录后从摘要表重新加载"""
+    with _session_index_lock:
+        cached = _session_index.get(username)
+        seq = history_write_seq(username)
+    if cached is not None:
+        version = history_cache_version(username, cached["version"])
+        if version is not None:
+            with _session_index_lock:
+                cached["version"] = max(cached["version"], version)
+            return cached["sessions"]
+
+    # 不持锁读取 (不阻塞其他用户的 save_chat)：先等本进程已入队的记录写完，摘要表就包含了它们
+    with observe_duration("chatapp_history_read_duration_seconds", "sessions"):
+        flush_history()
+        version = get_history_version(username) # 先读版本号：读完之前其他进程的写入会让下次访问重新加载
+        rows = get_history_db().execute(
+            "SELECT session_id, last_time, preview, message_count FROM chat_sessions WHERE username = ?",
+            (username,)).fetchall()
+    user_sessions = {
+        session_id: {"last_time": last_time, "preview": preview, "message_count": message_count}
+        for session_id, last_time, preview, message_count in rows
+    }
+    with _session_index_lock:
+        if history_write_seq(username) == seq: # 加载期间本进程又有写入时，读到的结果可能缺少它，不放入缓存
+            _session_index[username] = {"version": version, "sessions": user_sessions}
+    return user_sessions
+
+def _update_session_index_locked(username, session_id, user_msg, timestamp):
+    """save_chat 时同步更新内存摘要（仅当该用户已被加载到内存时，调用方需持有 _session_index_lock）"""
+    cached = _session_index.get(username)
+    if cached is None:
+        return # 尚未加载，下次访问时会从摘要表读取最新数据
+    user_sessions = cached["sessions"]
+    entry = user_sessions.get(session_id)
+    if entry is None:
+        user_sessions[session_id] = {"last_time": timestamp, "preview": make_preview(user_msg), "message_count": 1}
+    else:
+        entry["message_count"] += 1
+        if timestamp >= entry["last_time"]:
+            entry["last_time"] = timestamp
+            entry["preview"] = make_preview(user_msg)
+
+# --- 新增：聊天记录全文索引 ---
+# chat_search 是 SQLite FTS5 倒排索引 (contentless，只存索引，rowid 与 chat_history.id 一致)。
+# 中文没有空格，FTS5 自带的分词器会把整句当成一个词，所以先在 Python 中切词再交给 FTS5：
+#   - 连续的中日韩字符切成重叠的二元组 ("今天天气" -> 今天 天天 天气)，外加片段末字，单字查询用前缀匹配
+#   - 英文、数字按单词切分，统一转小写 (全角先转半角)
+# owner 列存用户名的哈希，查询时只在该用户自己的记录中匹配。
+# write_history_batch 在写入明细的同一事务中更新索引；建立索引之前已有的记录由后台线程分批补建。
+SEARCH_DEFAULTS = {
+    "max_results": 20,            # 默认返回条数
+    "candidate_limit": 1000,      # 最多取最近的这么多条命中记录参与排序
+    "recency_half_life_days": 30, # 时间加权的半衰期 (天)
+    "recency_weight": 1.0,        # 时间加权的比重，0 表示只按相关度排序
+    "backfill_batch": 5000,       # 后台补建索引时每个事务处理的记录数
+}
+_SEARCH_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z]+") # 假名、汉字、韩文 | 英文数字
+_search_available = False # SQLite 未编译 FTS5 时为 False，搜索退化为逐条匹配
+_search_backfill_thread = None
+
+def get_search_settings():
+    """默认搜索参数，叠加 Uconfig.json 中 "search" 的覆盖项"""
+    settings = dict(SEARCH_DEFAULTS)
+    overrides = config.get("search") or {}
+    settings.update({k: v for k, v in overrides.items() if k in SEARCH_DEFAULTS})
+    return settings
+
+def search_text_runs(text):
+    """归一化后切出连续的中日韩字符片段和英文/数字单词"""
+    return _SEARCH_TOKEN_RE.findall(unicodedata.normalize("NFKC", text or "").lower())
+
+def _is_cjk_run(run):
+    return not run[0].isascii()
+
+def search_tokens(text):
+    """索引用的词列表"""
+    tokens = []
+    for run in search_text_runs(text):
+        if _is_cjk_run(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1]) # 末字单独成词，单字查询才能命中片段结尾的字
+        else:
+            tokens.append(run)
+    return tokens
+
+def search_index_text(user_msg, ai_msg):
+    """写入 FTS5 body 列的文本 (空格分隔的词)"""
+    return " ".join(search_tokens(user_msg) + search_tokens(ai_msg))
+
+def search_owner_token(username):
+    """用户名可能含任意字符，owner 列存它的哈希"""
+    return "u" + hashlib.sha1(username.encode("utf-8")).hexdigest()[:16]
+
+def build_search_query(username, query):
+    """把用户输入转成 FTS5 查询 (各词之间为 AND)，没有可搜索的词时返回 None"""
+    terms = []
+    for run in search_text_runs(query):
+        if _is_cjk_run(run) and len(run) > 1:
+            # 二元组组成的短语：要求原文中连续出现
+            terms.append('body:"' + " ".join(run[i:i + 2] for i in range(len(run) - 1)) + '"')
+        elif _is_cjk_run(run):
+            terms.append(f'body:"{run}"*') # 单字：匹配以它开头的二元组或片段末字
+        else:
+            terms.append(f'body:"{run}"')
+    if not terms:
+        return None
+    return f'owner:"{search_owner_token(username)}" AND ' + " AND ".join(terms)
+
+def index_history_rows(conn, first_id, last_id):
+    """把 id 在 [first_id, last_id] 内的明细加入索引 (调用方负责事务)"""
+    conn.execute("""
+        INSERT INTO chat_search (rowid, owner, body)
+        SELECT id, search_owner_token(username), search_index_text(user_msg, ai_msg)
+        FROM chat_history WHERE id BETWEEN ? AND ?""", (first_id, last_id))
+
+def get_search_backfill_progress(conn=None):
+    """返回 (已补建到的 id, 需要补建到的 id)"""
+    conn = conn or get_history_db()
+    meta = dict(conn.execute(
+        "SELECT key, value FROM history_meta WHERE key IN ('search_backfill_done', 'search_backfill_until')").fetchall())
+    return int(meta.get("search_backfill_done", 0)), int(meta.get("search_backfill_until", 0))
+
+def is_search_index_complete():
+    done, until = get_search_backfill_progress()
+    return done >= until
+
+def backfill_search_index_step(batch):
+    """补建一批索引，返回是否已全部完成"""
+    conn = get_history_db()
+    conn.execute("BEGIN IMMEDIATE") # 先拿写锁再读进度，多个进程同时补建也不会重复索引
+    with conn:
+        done, until = get_search_backfill_progress(conn)
+        if done >= until:
+            return True
+        end = min(done + batch, until)
+        index_history_rows(conn, done + 1, end)
+        conn.execute("UPDATE history_meta SET value = ? WHERE key = 'search_backfill_done'", (str(end),))
+    return end >= until
+
+def _search_backfill_loop():
+    batch = get_search_settings()["backfill_batch"]
+    start = time.perf_counter()
+    try:
+        while not backfill_search_index_step(batch):
+            time.sleep(0.01) # 每批之间让写线程有机会提交新消息
+    except sqlite3.Error as e:
+        logging.error(f"补建聊天记录搜索索引失败: {e}，下次启动时继续")
+        return
+    logging.info(f"聊天记录搜索索引补建完成，耗时 {time.perf_counter() - start:.1f} 秒")
+
+def initialize_search_index():
+    """创建 chat_search 索引表；首次创建时记下需要补建的范围，并在后台补建"""
+    global _search_available, _search_backfill_thread
+    conn = get_history_db()
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(owner, body, content='')")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"当前 SQLite 不支持 FTS5 ({e})，聊天记录搜索将逐条匹配")
+        return
+    with conn:
+        # 之后写入的记录由 write_history_batch 直接索引，这里只记录之前已有的范围
+        conn.execute("""
+            INSERT OR IGNORE INTO history_meta (key, value)
+            SELECT 'search_backfill_until', COALESCE(MAX(id), 0) FROM chat_history""")
+        conn.execute("INSERT OR IGNORE INTO history_meta (key, value) VALUES ('search_backfill_done', '0')")
+    _search_available = True
+    if not is_search_index_complete():
+        logging.info("开始在后台补建聊天记录搜索索引...")
+        _search_backfill_thread = threading.Thread(target=_search_backfill_loop, name="search-backfill", daemon=True)
+        _search_backfill_thread.start()
+
+# --- 新增：聊天历史冷热分层 ---
+# chat_history 表 (热数据) 只保留最近 hot_days 天所在月份之后的记录，更早的记录由后台线程定期移到
+# history_archive/<用户>/<YYYY-MM>.seg 归档段中 (每个用户每月一个文件)：
+#   [SEGMENT_MAGIC] [会话块 1] [会话块 2] ... [尾部索引] [尾部索引偏移 + 长度 + SEGMENT_END_MAGIC]
+# 每个会话块是该会话当月所有轮次的 zlib 压缩 JSON；尾部索引记录各会话块的位置、轮数和时间范围，
+# 读取某个会话时只需读尾部索引和对应的块。
+# chat_sessions 摘要不随归档改变，会话列表不需要读归档；只有加载会话翻到热数据之外时才读归档段。
+# chat_archive_rows 为每条归档记录保留 (id, 用户, 会话, 时间)，用于搜索结果定位和摘要校验。
+ARCHIVE_DIR = os.path.join(BASE_DIR, "history_archive")
+ARCHIVE_DEFAULTS = {
+    "enabled": True,
+    "hot_days": 90,          # 保留在热数据中的天数 (按月对齐：只归档完整的旧月份)
+    "interval_hours": 24,    # 两次归档检查的间隔
+    "compress_level": 1,     # zlib 压缩级别，1 最快
+}
+ARCHIVE_START_DELAY = 60 # 启动后等待多久进行第一次归档 (秒)，避开启动高峰
+SEGMENT_MAGIC = b"CHSEG1\n"
+SEGMENT_END_MAGIC = b"CHSEGEND"
+SEGMENT_TRAILER = struct.Struct(">QI8s") # 尾部索引偏移、长度、结束标记
+_segment_footer_cache = {} # path -> ((mtime_ns, size), 尾部索引)
+_segment_footer_lock = threading.Lock()
+_archive_thread = None
+
+def get_archive_settings():
+    """默认归档参数，叠加 Uconfig.json 中 "history_archive" 的覆盖项"""
+    settings = dict(ARCHIVE_DEFAULTS)
+    overrides = config.get("history_archive") or {}
+    settings.update({k: v for k, v in overrides.items() if k in ARCHIVE_DEFAULTS})
+    return settings
+
+def archive_user_dir(username):
+    # 用户名可能含路径中不允许的字符，目录名使用哈希
+    return os.path.join(ARCHIVE_DIR, hashlib.sha1(username.encode("utf-8")).hexdigest()[:16])
+
+def archive_segment_path(username, month):
+    return os.path.join(archive_user_dir(username), f"{month}.seg")
+
+def write_segment(path, username, month, rows, compress_level):
+    """把 rows [(id, session_id, timestamp, user_msg, ai_msg)] 按会话分块写成一个归档段"""
+    by_session = {}
+    for row_id, session_id, timestamp, user_msg, ai_msg in sorted(rows, key=lambda r: (r[2], r[0])):
+        by_session.setdefault(session_id, []).append([row_id, timestamp, user_msg, ai_msg])
+
+    def write(f):
+        f.write(SEGMENT_MAGIC)
+        sessions = {}
+        for session_id, turns in by_session.items():
+            block = zlib.compress(json.dumps(turns, ensure_ascii=False).encode("utf-8"), compress_level)
+            sessions[session_id] = {"offset": f.tell(), "length": len(block), "count": len(turns),
+                                    "first_time": turns[0][1], "last_time": turns[-1][1],
+                                    "preview": make_preview(turns[-1][2])}
+            f.write(block)
+        footer = zlib.compress(json.dumps({"username": username, "month": month, "sessions": sessions},
+                                          ensure_ascii=False).encode("utf-8"), compress_level)
+        footer_offset = f.tell()
+        f.write(footer)
+        f.write(SEGMENT_TRAILER.pack(footer_offset, len(footer), SEGMENT_END_MAGIC))
+
+    _write_file_atomic(path, write, binary=True)
+
+def read_segment_footer(path):
+    """读取归档段的尾部索引 (按文件修改时间和大小缓存)，文件不存在返回 None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _segment_footer_lock:
+        cached = _segment_footer_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, "rb") as f:
+        f.seek(-SEGMENT_TRAILER.size, os.SEEK_END)
+        footer_offset, footer_length, end_magic = SEGMENT_TRAILER.unpack(f.read(SEGMENT_TRAILER.size))
+        if end_magic != SEGMENT_END_MAGIC:
+            raise ValueError(f"归档段 {path} 已损坏 (缺少结束标记)")
+        f.seek(footer_offset)
+        footer = json.loads(zlib.decompress(f.read(footer_length)))
+    with _segment_footer_lock:
+        _segment_footer_cache[path] = (signature, footer)
+    return footer
+
+def read_segment_session(path, session_id):
+    """读取归档段中某个会话的所有轮次 [(id, timestamp, user_msg, ai_msg)]，按时间正序"""
+    footer = read_segment_footer(path)
+    entry = footer and footer["sessions"].get(session_id)
+    if not entry:
+        return []
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        return [tuple(turn) for turn in json.loads(zlib.decompress(f.read(entry["length"])))]
+
+def read_segment_rows(path):
+    """读取整个归档段 [(id, session_id, timestamp, user_msg, ai_msg)]，合并归档时使用"""
+    footer = read_segment_footer(path)
+    if footer is None:
+        return []
+    return [(row_id, session_id, timestamp, user_msg, ai_msg)
+            for session_id in footer["sessions"]
+            for row_id, timestamp, user_msg, ai_msg in read_segment_session(path, session_id)]
+
+def load_archived_session_rows(username, session_id, before=None, limit=None):
+    """
+    倒序读取归档中该会话在 before (timestamp, id) 之前的轮次，最多 limit 条。
+    先从 chat_archive_rows 查出包含该会话的月份 (会话没有归档时不碰任何文件)，按月份从新到旧读取，读够即停。
+    """
+    sql = "SELECT DISTINCT substr(timestamp, 1, 7) FROM chat_archive_rows WHERE session_id = ? AND username = ?"
+    params = [session_id, username]
+    if before:
+        sql += " AND timestamp <= ?"
+        params.append(before[0])
+    months = [month for (month,) in get_history_db().execute(sql + " ORDER BY 1 DESC", params)]
+    rows = []
+    if not months:
+        return rows
+    start = time.perf_counter()
+    for month in months:
+        path = archive_segment_path(username, month)
+        try:
+            turns = [turn for turn in read_segment_session(path, session_id) if not before or (turn[1], turn[0]) < before]
+        except (OSError, ValueError, zlib.error) as e:
+            logging.error(f"读取归档段 {path} 失败: {e}")
+            continue
+        turns.sort(key=lambda turn: (turn[1], turn[0]), reverse=True)
+        rows.extend(turns)
+        if limit is not None and len(rows) >= limit:
+            break
+    observe("chatapp_history_read_duration_seconds", time.perf_counter() - start, "archive")
+    return rows[:limit] if limit is not None else rows
+
+def read_archived_turns(turn_refs):
+    """按 {(username, session_id, month): {id, ...}} 读取指定的归档轮次，返回 {id: (user_msg, ai_msg)}"""
+    found = {}
+    for (username, session_id, month), ids in turn_refs.items():
+        path = archive_segment_path(username, month)
+        try:
+            turns = read_segment_session(path, session_id)
+        except (OSError, ValueError, zlib.error) as e:
+            logging.error(f"读取归档段 {path} 失败: {e}")
+            continue
+        for row_id, timestamp, user_msg, ai_msg in turns:
+            if row_id in ids:
+                found[row_id] = (user_msg, ai_msg)
+    return found
+
+def merge_archive_into_session_summary(conn):
+    """把归档段尾部索引中的会话统计合并进 chat_sessions (重建摘要时调用，调用方负责事务)"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    for user_dir in os.listdir(ARCHIVE_DIR):
+        dir_path = os.path.join(ARCHIVE_DIR, user_dir)
+        for name in os.listdir(dir_path) if os.path.isdir(dir_path) else []:
+            if not name.endswith(".seg"):
+                continue
+            footer = read_segment_footer(os.path.join(dir_path, name))
+            conn.executemany("""
+                INSERT INTO chat_sessions (username, session_id, last_time, preview, message_count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (username, session_id) DO UPDATE SET
+                    message_count = message_count + excluded.message_count,
+                    preview = CASE WHEN excluded.last_time > last_time THEN excluded.preview ELSE preview END,
+                    last_time = MAX(last_time, excluded.last_time)""",
+                [(footer["username"], session_id, entry["last_time"], entry["preview"], entry["count"])
+                 for session_id, entry in footer["sessions"].items()])
+
+def archive_cutoff(hot_days, now=None):
+    """早于该时间的记录可以归档：now - hot_days 所在月份的第一天"""
+    boundary = (now or datetime.now()) - timedelta(days=hot_days)
+    return boundary.strftime("%Y-%m-01 00:00:00")
+
+def archive_user_month(conn, username, month, settings):
+    """把该用户某个月的热数据并入归档段，然后从 chat_history 删除，返回归档的条数"""
+    next_month = (datetime.strptime(month, "%Y-%m") + timedelta(days=32)).strftime("%Y-%m")
+    rows = conn.execute("""
+        SELECT id, session_id, timestamp, user_msg, ai_msg FROM chat_history
+        WHERE username = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp, id""",
+        (username, f"{month}-01 00:00:00", f"{next_month}-01 00:00:00")).fetchall()
+    if not rows:
+        return 0
+    path = archive_segment_path(username, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock(archive_user_dir(username)): # 每个用户一个锁文件，多个进程同时归档也不会互相覆盖
+        # 先写归档段再删热数据：中途崩溃最多留下两边都有的记录，下次归档时按 id 去重合并
+        merged = {row[0]: row for row in read_segment_rows(path)}
+        merged.update({row[0]: row for row in rows})
+        write_segment(path, username, month, list(merged.values()), settings["compress_level"])
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO chat_archive_rows (id, username, session_id, timestamp) VALUES (?, ?, ?, ?)",
+                         [(row_id, username, session_id, timestamp) for row_id, session_id, timestamp, _, _ in rows])
+        conn.executemany("DELETE FROM chat_history WHERE id = ?", [(row[0],) for row in rows])
+    return len(rows)
+
+def compact_history(now=None):
+    """把早于归档边界的热数据移到归档段，返回归档的条数"""
+    settings = get_archive_settings()
+    if _search_available and not is_search_index_complete():
+        logging.info("搜索索引尚未补建完成，推迟本次归档")
+        return 0
+    conn = get_history_db()
+    cutoff = archive_cutoff(settings["hot_days"], now)
+    targets = conn.execute("""
+        SELECT DISTINCT username, substr(timestamp, 1, 7) FROM chat_history WHERE timestamp < ?""", (cutoff,)).fetchall()
+    archived = 0
+    start = time.perf_counter()
+    for username, month in targets:
+        try:
+            archived += archive_user_month(conn, username, month, settings)
+        except (OSError, ValueError, zlib.error, sqlite3.Error) as e:
+            logging.error(f"归档用户 {username} {month} 的聊天记录失败: {e}")
+    if archived:
+        logging.info(f"已将 {archived} 条早于 {cutoff} 的聊天记录移入归档 ({len(targets)} 个归档段)，"
+                     f"耗时 {time.perf_counter() - start:.1f} 秒")
+    return archived
+
+def _archive_loop():
+    time.sleep(ARCHIVE_START_DELAY)
+    while True:
+        settings = get_archive_settings()
+        if settings["enabled"]:
+            try:
+                compact_history()
+            except sqlite3.Error as e:
+                logging.error(f"归档聊天记录时出错: {e}")
+        time.sleep(settings["interval_hours"] * 3600)
+
+def start_history_archiver():
+    """启动后台归档线程 (已在运行则忽略)"""
+    global _archive_thread
+    if _archive_thread is not None and _archive_thread.is_alive():
+        return
+    _archive_thread = threading.Thread(target=_archive_loop, name="history-archiver", daemon=True)
+    _archive_thread.start()
 
 # 初始化用户文件和历史文件（如果不存在，则创建并添加表头）
 def initialize_files():
     if not os.path.exists(USERS_PATH):
         try:
-            with open(USERS_PATH, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["username", "password_hash"]) # 添加表头
-            logging.info(f"用户文件已创建: {USERS_PATH}")
-        except IOError as e:
+            with file_lock(USERS_PATH):
+                if not os.path.exists(USERS_PATH): # 其他进程可能已经创建
+                    _write_file_atomic(USERS_PATH, lambda f: csv.writer(f).writerow(USERS_HEADER)) # 添加表头
+                    logging.info(f"用户文件已创建: {USERS_PATH}")
+        except OSError as e:
             logging.error(f"无法创建用户文件 {USERS_PATH}: {e}")
 
-    if not os.path.exists(HISTORY_PATH):
-        try:
-            with open(HISTORY_PATH, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                # **修改：** 添加 username 列
-                writer.writerow(["session_id", "username", "user_msg", "ai_msg", "timestamp"]) # 添加表头
-            logging.info(f"聊天历史文件已创建: {HISTORY_PATH}")
-        except IOError as e:
-            logging.error(f"无法创建聊天历史文件 {HISTORY_PATH}: {e}")
+    # **修改：** 聊天历史改存 SQLite，旧的 CSV 只在首次启动时导入一次
+    try:
+        initialize_history_db()
+        import_csv_history()
+        ensure_session_summary()
+        initialize_search_index()
+        start_history_archiver()
+        start_usage_flusher()
+    except sqlite3.Error as e:
+        logging.error(f"无法初始化聊天历史数据库 {HISTORY_DB_PATH}: {e}")
 
     # 新增：确保必要的配置文件存在
+    # (活动配置 config.json 的同步移到 sidecar 启动流程中，与这里的初始化并行)
     if not os.path.exists(CONFIG_PATH):
          logging.info(f"用户界面配置文件 {CONFIG_PATH} 不存在，将创建。")
          save_config({"logged_in_user": None}) # 创建包含默认值的配置
@@ -194,20 +1120,14 @@ def initialize_files():
          logging.info(f"用户密钥文件 {USER_KEYS_PATH} 不存在，将创建。")
          save_user_keys({}) # 创建空的密钥文件
 
-    # 确保活动配置文件存在，如果不存在则从模板复制
-    if not os.path.exists(CONFIG_ACTIVE_PATH):
-         logging.warning(f"活动配置文件 {CONFIG_ACTIVE_PATH} 不存在。")
-         if apply_default_config():
-             logging.info(f"已从模板创建活动配置文件 {CONFIG_ACTIVE_PATH}。")
-         else:
-             logging.error(f"无法创建活动配置文件 {CONFIG_ACTIVE_PATH}！API 服务可能无法启动。")
-
-initialize_files() # 程序启动时检查并初始化文件
 
 # 全局状态
-current_api = "zhipuai" # 默认 API 标识符 (需要与 MODEL_MAPPING 的 key 对应)
-temperature = 1.0
+DEFAULT_API = "zhipuai" # 新用户状态的默认 API 标识符 (需要与 MODEL_MAPPING 的 key 对应)
+DEFAULT_TEMPERATURE = 1.0
 BASE_URL = "http://localhost:9090/v1"
+# 新增：蓝绿切换时 simple-one-api 轮流使用的端口，第一个为默认端口
+SIDECAR_PORTS = (9090, 9091, 9092)
+api_port = SIDECAR_PORTS[0] # 当前 api_process 监听的端口
 #用于前端的映射
 MODEL_MAPPING = {
     "zhipuai": "glm-4-flash",         # 智谱AI
@@ -216,62 +1136,316 @@ MODEL_MAPPING = {
     # "test_api": "test" # 如果有 test 模型，也需要映射
 }
 
+# --- 新增：按用户隔离的会话状态 ---
+# 以前当前会话、模型选择、温度和登录用户都是模块级全局变量，多个用户共用一个进程时会互相覆盖。
+# 现在登录时签发一个认证 token (Cookie "auth_token"，API 客户端也可用请求头 X-Auth-Token)，
+# 每个 token 对应一份状态：{"username", "session_id", "api", "temperature", "updated_at"}。
+# 存储后端 (Uconfig.json 的 "session_state.backend")：
+#   "memory" 进程内字典，单进程使用
+#   "sqlite" 本地 SQLite 文件，多个工作进程共享同一份状态
+AUTH_COOKIE_NAME = "auth_token"
+AUTH_HEADER_NAME = "X-Auth-Token"
+STATE_STORE_DEFAULTS = {
+    "backend": "memory",
+    "ttl_seconds": 7 * 24 * 3600,  # 超过该时间未使用的状态失效，需要重新登录
+    # 桌面单用户模式：没有有效 token 时恢复 Uconfig.json 中记录的登录用户。
+    # 默认关闭 (否则网络上任何匿名访问者都会以上次登录的用户身份登录)，只在 webview 窗口模式下打开，且只接受本机请求
+    "restore_last_login": False,
+}
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1", "localhost")
+STATE_TOUCH_INTERVAL = 3600 # 读取状态时最多每隔这么久刷新一次 updated_at
+_memory_states = {} # token -> 状态
+_memory_states_lock = threading.Lock()
+_state_db_local = threading.local()
+_state_db_ready = False
+
+def get_state_store_settings():
+    """默认状态存储参数，叠加 Uconfig.json 中 "session_state" 的覆盖项"""
+    settings = dict(STATE_STORE_DEFAULTS)
+    overrides = config.get("session_state") or {}
+    settings.update({k: v for k, v in overrides.items() if k in STATE_STORE_DEFAULTS})
+    return settings
+
+def _memory_state_load(token):
+    with _memory_states_lock:
+        state = _memory_states.get(token)
+        return dict(state) if state else None
+
+def _memory_state_save(token, state):
+    with _memory_states_lock:
+        _memory_states[token] = dict(state)
+
+def _memory_state_delete(token):
+    with _memory_states_lock:
+        _memory_states.pop(token, None)
+
+def get_state_db():
+    """获取当前线程的状态数据库连接（首次调用时建表）"""
+    global _state_db_ready
+    conn = getattr(_state_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not _state_db_ready:
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS user_state (
+                        token TEXT PRIMARY KEY,
+                        data TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )""")
+            _state_db_ready = True
+        _state_db_local.conn = conn
+    return conn
+
+def _sqlite_state_load(token):
+    row = get_state_db().execute("SELECT data FROM user_state WHERE token = ?", (token,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _sqlite_state_save(token, state):
+    conn = get_state_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO user_state (token, data, updated_at) VALUES (?, ?, ?)",
+                     (token, json.dumps(state, ensure_ascii=False), state["updated_at"]))
+
+def _sqlite_state_delete(token):
+    conn = get_state_db()
+    with conn:
+        conn.execute("DELETE FROM user_state WHERE token = ?", (token,))
+
+STATE_STORE_BACKENDS = {
+    "memory": {"load": _memory_state_load, "save": _memory_state_save, "delete": _memory_state_delete},
+    "sqlite": {"load": _sqlite_state_load, "save": _sqlite_state_save, "delete": _sqlite_state_delete},
+}
+
+def _state_backend():
+    backend = get_state_store_settings()["backend"]
+    if backend not in STATE_STORE_BACKENDS:
+        logging.error(f"未知的会话状态存储后端 '{backend}'，改用 memory")
+        backend = "memory"
+    return STATE_STORE_BACKENDS[backend]
+
+def create_user_state(username):
+    """为登录用户签发 token 并创建初始状态"""
+    token = uuid.uuid4().hex + uuid.uuid4().hex
+    state = {
+        "username": username,
+        "session_id": str(uuid.uuid4()),
+        "api": DEFAULT_API,
+        "temperature": DEFAULT_TEMPERATURE,
+        "updated_at": time.time(),
+    }
+    _state_backend()["save"](token, state)
+    return token, state
+
+def load_user_state(token):
+    """读取 token 对应的状态，不存在或已过期时返回 None"""
+    if not token:
+        return None
+    backend = _state_backend()
+    state = backend["load"](token)
+    if state is None:
+        return None
+    now = time.time()
+    if now - state["updated_at"] > get_state_store_settings()["ttl_seconds"]:
+        backend["delete"](token)
+        return None
+    if now - state["updated_at"] > STATE_TOUCH_INTERVAL:
+        state["updated_at"] = now
+        backend["save"](token, state)
+    return state
+
+def update_user_state(token, **changes):
+    """修改状态中的若干字段并保存，返回新的状态 (token 无效时返回 None)"""
+    state = load_user_state(token)
+    if state is None:
+        return None
+    state.update(changes)
+    state["updated_at"] = time.time()
+    _state_backend()["save"](token, state)
+    return state
+
+def delete_user_state(token):
+    if token:
+        _state_backend()["delete"](token)
+
+def get_request_token():
+    """从 Cookie 或请求头中取出认证 token"""
+    return request.cookies.get(AUTH_COOKIE_NAME) or request.headers.get(AUTH_HEADER_NAME)
+
+def get_request_state(username=None):
+    """当前请求的 (token, 状态)；未登录，或给出的 username 与 token 所属用户不一致时状态为 None"""
+    token = get_request_token()
+    state = load_user_state(token)
+    if state is not None and username is not None and state["username"] != username:
+        logging.warning(f"请求中的用户 {username} 与认证 token 所属用户 {state['username']} 不一致")
+        state = None
+    return token, state
+
 # --- 新增：用户认证相关函数 ---
 
-# 查找用户
+# --- 新增：内存用户索引 ---
+# users.csv 作为只追加的日志保存在磁盘上，内存中维护 username -> 记录 的哈希索引。
+# 索引记录已读入的文件偏移，文件变长时只读取新追加的部分 (例如其他进程注册的用户)。
+_users_index = {} # username -> [username, password_hash]
+_users_log_offset = 0 # 已读入索引的 users.csv 字节数
+_users_lock = threading.Lock() # 保护索引，并保证注册时 "检查 + 写入" 是原子的
+
+def _sync_users_index_locked():
+    """把 users.csv 中尚未进入索引的新行读入索引 (调用方需持有 _users_lock)"""
+    global _users_log_offset
+    try:
+        size = os.path.getsize(USERS_PATH)
+    except OSError:
+        return
+    if size < _users_log_offset:
+        # 文件被替换或截断，从头重建索引
+        logging.warning(f"用户文件 {USERS_PATH} 变短了，重建用户索引")
+        _users_index.clear()
+        _users_log_offset = 0
+    if size == _users_log_offset:
+        return
+    with open(USERS_PATH, "rb") as f:
+        f.seek(_users_log_offset)
+        chunk = f.read(size - _users_log_offset)
+    # 只处理到最后一个换行符，另一方写了一半的行留到下次
+    end = chunk.rfind(b"\n") + 1
+    if end == 0:
+        return
+    reader = csv.reader(io.StringIO(chunk[:end].decode("utf-8"), newline=""))
+    if _users_log_offset == 0:
+        header = next(reader, None)
+        if header is not None and header != USERS_HEADER and len(header) >= 2 and header[0]:
+            _users_index.setdefault(header[0], header) # 没有表头的旧文件，第一行就是用户
+    for row in reader:
+        if len(row) >= 2 and row[0]:
+            _users_index.setdefault(row[0], row) # 同名重复行以最早的为准，与旧的顺序扫描一致
+    _users_log_offset += end
+
+# 查找用户 (**修改：** 哈希索引查找，开销与用户总数无关)
 def find_user(username):
-    if not os.path.exists(USERS_PATH):
-        return None
     try:
-        with open(USERS_PATH, "r", newline="", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            next(reader) # 跳过表头
-            for row in reader:
-                if len(row) >= 1 and row[0] == username:
-                    return row # 返回整行 [username, password_hash]
-    except StopIteration: # 文件为空（只有表头）
-        return None
+        with _users_lock:
+            _sync_users_index_locked()
+            row = _users_index.get(username)
+            return list(row) if row else None # 返回整行 [username, password_hash]
     except Exception as e:
         logging.error(f"读取用户文件时出错: {e}")
         return None
-    return None
 
-# --- 新增：辅助函数，用于从模板配置中查找默认 Key ---
-def get_default_key_from_template(model_name, template_data):
-    """
-    在加载的模板配置数据中查找指定模型的默认 API Key。
-    返回非空 Key 字符串或 None。
-    """
-    if not template_data or 'services' not in template_data:
-        return None
-    for service_type, service_list in template_data.get('services', {}).items():
-        for service_instance in service_list:
-            # 检查当前服务实例配置是否包含目标模型
-            if model_name in service_instance.get("models", []):
-                # 找到了包含该模型的服务配置块
-                key = service_instance.get("credentials", {}).get("api_key")
-                # 只有当 key 存在且不为空字符串时，才认为模板有有效 Key
-                if key:
-                    return key # 返回找到的非空 Key
-                else:
-                    # 找到了配置块，但 key 为空或不存在
-                    return None
-    # 遍历完所有服务配置块，都没找到该模型
-    return None
-# 注册用户
+# --- 新增：配置文件缓存与模型索引 ---
+# Mconfig.json / config_template.json 通过 load_json_cached 读取，只在 mtime 或大小变化时才重新解析；
+# 同时预先算好 model -> (服务类型, 实例序号, 默认 key, 直连地址, API 标识符) 的索引，
+# get_models / select_model / save_api_key 在稳定状态下不做文件读取和嵌套遍历。
+_model_index = None # {"models": {...}, "mconfig": ..., "signature": ...}
+_model_index_lock = threading.Lock()
+
+def normalize_provider_base_url(server_url):
+    """config_template.json 中的 server_url 有的带 /chat/completions 后缀，OpenAI 客户端只需要前缀"""
+    server_url = server_url.rstrip("/")
+    suffix = "/chat/completions"
+    if server_url.endswith(suffix):
+        server_url = server_url[:-len(suffix)]
+    return server_url
+
+def build_model_index(template_data, mconfig):
+    """从模板配置、Mconfig 和 MODEL_MAPPING 构建模型索引"""
+    models = {}
+    for service_type, service_list in (template_data or {}).get('services', {}).items():
+        for i, service_instance in enumerate(service_list):
+            # 只有当 key 存在且不为空字符串时，才认为模板有有效 Key
+            default_key = service_instance.get("credentials", {}).get("api_key") or None
+            server_url = service_instance.get("server_url")
+            # 只有 OpenAI 兼容服务可以直连 (其他协议只能经 simple-one-api 转换)
+            provider_base_url = normalize_provider_base_url(server_url) if service_type == "openai" and server_url else None
+            for model_name in service_instance.get("models", []):
+                if model_name in models:
+                    continue # 同一模型出现在多个服务实例中时，以第一个为准
+                models[model_name] = {
+                    "service_type": service_type,
+                    "instance_index": i,
+                    "default_key": default_key,
+                    "provider_base_url": provider_base_url,
+                    "api_identifier": None,
+                    "company": None,
+                    "context_tokens": None,
+                    "cache": False,
+                    "fallback_model": None,
+                }
+    empty_entry = {"service_type": None, "instance_index": None, "default_key": None,
+                   "provider_base_url": None, "api_identifier": None, "company": None, "context_tokens": None,
+                   "cache": False, "fallback_model": None}
+    for company_name, company_data in (mconfig or {}).items():
+        for model_name in company_data.get("models", []):
+            entry = models.setdefault(model_name, dict(empty_entry))
+            entry["company"] = company_name
+            entry["context_tokens"] = company_data.get("context_tokens") # 可选：该公司模型的上下文 token 预算
+            entry["cache"] = bool(company_data.get("cache", False)) # 可选：是否缓存该公司模型的回答
+            entry["fallback_model"] = company_data.get("fallback_model") # 可选：该公司模型故障/变慢时改用的模型
+    for api_identifier, model_name in MODEL_MAPPING.items():
+        models.setdefault(model_name, dict(empty_entry))["api_identifier"] = api_identifier
+    return models
+
+def get_model_index():
+    """获取模型索引；模板或 Mconfig 变化后自动重建。Mconfig 缺失或损坏时抛出异常"""
+    global _model_index
+    mconfig, mconfig_signature = load_json_cached(MCONFIG_PATH)
+    try:
+        template_data, template_signature = load_json_cached(CONFIG_TEMPLATE_PATH)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        # 即使模板不存在，也继续构建索引，只是没有默认 Key 和直连地址
+        logging.error(f"读取配置模板 {CONFIG_TEMPLATE_PATH} 失败: {e}。无法检查默认 Key。")
+        template_data, template_signature = None, None
+
+    signature = (mconfig_signature, template_signature)
+    index = _model_index
+    if index is not None and index["signature"] == signature:
+        return index
+    with _model_index_lock:
+        if _model_index is None or _model_index["signature"] != signature:
+            template_changed = _model_index is not None and _model_index["signature"][1] != template_signature
+            _model_index = {
+                "models": build_model_index(template_data, mconfig),
+                "mconfig": mconfig,
+                "signature": signature,
+            }
+            logging.info(f"模型索引已重建 ({len(_model_index['models'])} 个模型)")
+            if template_changed and template_data is not None:
+                # 模板变化后，simple-one-api 的默认配置也要跟着更新
+                threading.Thread(target=reload_sidecar_config, daemon=True).start()
+        return _model_index
+
+def get_model_info(model_name):
+    """返回模型的索引条目，未知模型返回 None"""
+    return get_model_index()["models"].get(model_name)
+
+def reload_sidecar_config():
+    """把新的模板同步到活动配置，并平滑重启 simple-one-api"""
+    logging.info("检测到配置模板变化，正在同步活动配置并重启 simple-one-api...")
+    if apply_default_config():
+        restart_api_server()
+
+# 注册用户 (**修改：** 在锁内完成检查和写入，同名并发注册只有一个能成功)
+# 文件锁保证多个工作进程之间也是如此：持锁后先补读其他进程追加的用户再检查
 def register_user(username, hashed_password):
-    if find_user(username):
-        return False, "用户名已被注册。"
+    with _users_lock, file_lock(USERS_PATH):
+        _sync_users_index_locked()
+        if username in _users_index:
+            return False, "用户名已被注册。"
 
-    try:
-        with open(USERS_PATH, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([username, hashed_password])
-        logging.info(f"新用户注册成功: {username}")
-        return True, "注册成功！"
-    except IOError as e:
-        logging.error(f"写入用户文件时出错: {e}")
-        return False, "注册过程中发生服务器错误。"
+        try:
+            with open(USERS_PATH, "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow([username, hashed_password])
+                f.flush()
+                os.fsync(f.fileno()) # 确认落盘后才算注册成功
+        except IOError as e:
+            logging.error(f"写入用户文件时出错: {e}")
+            return False, "注册过程中发生服务器错误。"
+        _users_index[username] = [username, hashed_password]
+    logging.info(f"新用户注册成功: {username}")
+    return True, "注册成功！"
 
 
 @app.route('/api/register', methods=['POST'])
@@ -299,7 +1473,6 @@ def handle_register():
 
 @app.route('/api/login', methods=['POST'])
 def handle_login():
-    global current_logged_in_user, config # 引入 config
     data = request.json
     username = data.get('username')
     hashed_password_from_client = data.get('password') # 前端已经哈希过了
@@ -317,61 +1490,64 @@ def handle_login():
     if stored_hashed_password == hashed_password_from_client:
         logging.info(f"用户登录成功: {username}")
 
-        # --- 更新并保存 Uconfig.json ---
-        current_logged_in_user = username
+        # **修改：** 签发认证 token，之后的请求通过它找到该用户自己的状态
+        token, _ = create_user_state(username)
+
+        # --- 更新并保存 Uconfig.json (记录上次登录的用户，桌面模式下用于自动登录) ---
         config["logged_in_user"] = username
-        save_config(config) # 保存到 Uconfig.json
+        save_config({"logged_in_user": username}) # 保存到 Uconfig.json
 
-        # --- 应用用户特定的 API Key 配置并重启服务 ---
-        logging.info(f"正在为用户 {username} 应用 API Key 配置...")
-        if merge_config_with_user_keys(username):
-            restart_api_server() # 成功合并配置后重启服务
-        else:
-            logging.error(f"未能为用户 {username} 正确加载 API Key 配置！服务可能使用旧配置或默认配置。")
-            # 可以考虑是否返回错误给前端
-            # return jsonify({'success': False, 'error': '加载用户API配置时出错'}), 500
+        # **修改：** 用户的 API Key 在每次调用时按请求注入，登录不再改写配置、重启服务
 
-        return jsonify({'success': True, 'username': username})
+        return set_auth_cookie(jsonify({'success': True, 'username': username, 'token': token}), token)
     else:
         logging.warning(f"用户登录失败（密码错误）: {username}")
         return jsonify({'success': False, 'error': '密码错误'}), 401
 
+def set_auth_cookie(response, token):
+    """把认证 token 写入 Cookie (前端的 fetch 请求会自动带上)"""
+    response.set_cookie(AUTH_COOKIE_NAME, token, max_age=get_state_store_settings()["ttl_seconds"],
+                        httponly=True, samesite="Lax")
+    return response
+
 # 登出
 @app.route('/api/logout', methods=['POST'])
 def handle_logout():
-    global current_logged_in_user, config # 引入 config
-    logged_out_user = current_logged_in_user
+    token, state = get_request_state()
+    logged_out_user = state["username"] if state else None
     logging.info(f"用户 {logged_out_user} 请求退出登录")
+    delete_user_state(token) # **修改：** 只注销当前 token，不影响其他用户
 
     # --- 清除 Uconfig.json 中的登录状态 ---
-    current_logged_in_user = None
-    config["logged_in_user"] = None
-    save_config(config) # 保存到 Uconfig.json
+    if logged_out_user and config.get("logged_in_user") == logged_out_user:
+        config["logged_in_user"] = None
+        save_config({"logged_in_user": None}) # 保存到 Uconfig.json
 
-    # --- 恢复默认 API 配置并重启服务 ---
-    logging.info("正在恢复默认 API Key 配置...")
-    if apply_default_config():
-        restart_api_server() # 成功恢复默认配置后重启服务
-    else:
-        logging.error("未能恢复默认 API 配置！服务可能仍在运行用户配置。")
+    # **修改：** 活动配置中从不包含用户密钥，登出无需恢复配置、重启服务
 
-    return jsonify({'success': True})
+    response = jsonify({'success': True})
+    response.delete_cookie(AUTH_COOKIE_NAME)
+    return response
 
 # --- 检查认证状态 API 端点 ---
 @app.route('/api/check_auth', methods=['GET'])
 def check_auth():
-    """检查当前后端记录的登录状态"""
-    if current_logged_in_user:
-        logging.debug(f"检查认证状态：用户 '{current_logged_in_user}' 已登录")
-        return jsonify({'isLoggedIn': True, 'username': current_logged_in_user})
-    else:
-        logging.debug("检查认证状态：无用户登录")
-        return jsonify({'isLoggedIn': False})
-
-# 回答函数 (不变)
-def ai_call(text):
-    client = OpenAI(base_url=BASE_URL, api_key="sk-123456") # key "sk-123456" 可能是 simple-one-api 需要的固定值，或者会被忽略
-    model_name = MODEL_MAPPING.get(current_api) # 从当前 API 标识符获取模型名称
+    """检查当前请求的登录状态 (**修改：** 按认证 token 判断)"""
+    token, state = get_request_state()
+    if state:
+        logging.debug(f"检查认证状态：用户 '{state['username']}' 已登录")
+        return jsonify({'isLoggedIn': True, 'username': state['username']})
+
+    last_user = config.get("logged_in_user")
+    if (last_user and get_state_store_settings()["restore_last_login"]
+            and request.remote_addr in LOOPBACK_ADDRESSES and find_user(last_user)):
+        # 桌面单用户模式：重启后恢复上次登录的用户
+        token, state = create_user_state(last_user)
+        logging.info(f"检查认证状态：恢复上次登录的用户 '{last_user}'")
+        return set_auth_cookie(jsonify({'isLoggedIn': True, 'username': last_user}), token)
+
+    logging.debug("检查认证状态：无用户登录")
+    return jsonify({'isLoggedIn': False})
 
 # 利用flask的jsonify的框架，将后端处理转发到前端
 @app.route('/api/send', methods=['POST'])
@@ -380,20 +1556,31 @@ def handle_message():
     user_input = data.get('message', '')
     username = data.get('username') # **新增：** 获取用户名
 
-    if not username:
-         logging.warning("收到发送消息请求，但缺少用户名")
+    _, state = get_request_state(username) # **新增：** 取得该用户自己的会话、模型和温度
+    if not username or state is None:
+         logging.warning("收到发送消息请求，但缺少用户名或认证无效")
          return jsonify({'success': False, 'error': '用户未登录或请求无效'}), 401
+    if not ensure_upstream_ready(state):
+        return upstream_not_ready_response()
+    exceeded = check_usage_quota(username) # 新增：token 配额
+    if exceeded:
+        return quota_exceeded_response(exceeded)
+    ticket, rejection = admit_request(state) # 新增：准入控制，可能排队等待
+    if rejection:
+        return admission_rejected_response(rejection)
 
     logging.info(f"用户 {username} 发送消息: {user_input[:50]}...") # 日志记录
 
     try:
-        response = ai_call(user_input)
-        # **修改：** 传递用户名给 save_chat
-        save_chat(username, user_input, response)
+        response = ai_call(user_input, state)
+        # **修改：** 记录保存到发送时所在的会话
+        save_chat(username, user_input, response, state["session_id"])
         return jsonify({'success': True, 'response': response})
     except Exception as e:
         logging.error(f"处理用户 {username} 消息时出错: {e}")
         return jsonify({'success': False, 'error': f'处理消息时出错: {e}'}), 500
+    finally:
+        release_admission(ticket)
 
 '''
 @app.route('/api/switch', methods=['POST'])
@@ -418,13 +1605,14 @@ def switch_api():
 # 温度设置类似，也应该是登录后操作  b
 @app.route('/api/temperature', methods=['POST'])
 def set_temperature():
-    global temperature
-    # 同样可以添加登录验证
+    token, state = get_request_state() # **修改：** 温度保存在用户自己的状态中
+    if state is None:
+        return jsonify({'success': False, 'error': '用户未登录或认证失败'}), 401
     try:
         new_temp = float(request.json.get('temp', 1.0))
         if 0 <= new_temp <= 2:
-            temperature = new_temp
-            logging.info(f"温度已设置为: {temperature}")
+            update_user_state(token, temperature=new_temp)
+            logging.info(f"用户 {state['username']} 的温度已设置为: {new_temp}")
             return jsonify({'success': True})
         logging.warning(f"尝试设置无效温度值: {new_temp}")
         return jsonify({'success': False, 'error': '温度值必须在 0 和 2 之间'}), 400
@@ -440,284 +1628,2543 @@ def new_chat():
     # username = data.get('username') # 如果需要记录
     # if not username: return jsonify({'success': False, 'error': '需要登录'}), 401
 
-    global current_session
-    old_session = current_session
-    current_session = str(uuid.uuid4()) # 生成新的全局 session_id
-    logging.info(f"创建新会话 ID: {current_session} (旧: {old_session})")
-    # 注意：这个全局 current_session 可能在多用户场景下不是最佳实践
-    # 但对于单用户本地运行或前端驱动会话切换的场景是可行的
+    token, state = get_request_state() # **修改：** 只切换当前用户的会话
+    if state is None:
+        return jsonify({'success': False, 'error': '用户未登录或认证失败'}), 401
+    old_session = state["session_id"]
+    state = update_user_state(token, session_id=str(uuid.uuid4())) # 生成新的 session_id
+    logging.info(f"用户 {state['username']} 创建新会话 ID: {state['session_id']} (旧: {old_session})")
     return jsonify({'success': True})
 
-# 回答函数 (不变)
-def ai_call(text):
-    client = OpenAI(base_url=BASE_URL, api_key="sk-123456")
-    model_name = MODEL_MAPPING.get(current_api) # 从当前 API 标识符获取模型名称
+def resolve_model_name(api):
+    """根据 API 标识符获取模型名称"""
+    model_name = MODEL_MAPPING.get(api) # 从 API 标识符获取模型名称
 
     if not model_name:
-         logging.error(f"无法找到 API 标识符 '{current_api}' 对应的模型名称！请检查 MODEL_MAPPING。")
+         logging.error(f"无法找到 API 标识符 '{api}' 对应的模型名称！请检查 MODEL_MAPPING。")
          # 可以抛出异常或返回错误信息
-         raise ValueError(f"Invalid API identifier: {current_api}")
+         raise ValueError(f"Invalid API identifier: {api}")
          # return "Error: Backend model mapping configuration issue."
+    return model_name
+
+# --- 新增：进程级共享的 OpenAI 客户端 ---
+# 以前每条消息都新建一个 OpenAI 客户端，httpx 连接池、keep-alive 连接都用完即弃。
+# 现在全进程复用同一个客户端；连接池参数可在 Uconfig.json 的 "http_client" 中覆盖。
+HTTP_CLIENT_DEFAULTS = {
+    "max_connections": 100,          # 连接池最大连接数
+    "max_keepalive_connections": 20, # 最多保留的空闲 keep-alive 连接
+    "keepalive_expiry": 30.0,        # 空闲连接保留秒数
+    "connect_timeout": 5.0,          # 建立连接超时 (秒)
+    "read_timeout": 120.0,           # 等待上游响应超时 (秒)，长回答需要留足时间
+    "max_retries": 0,                # openai 库内置的重试次数 (**修改：** 重试改由容错层负责，见 run_with_retries)
+}
+SIDECAR_API_KEY = "sk-123456" # simple-one-api 配置中的固定 key
+_openai_client_entry = None # (client, base_url)，整体赋值，读取时不会拿到不匹配的一对
+_openai_client_lock = threading.Lock()
+_openai_client_generation = 0 # 每次重置加一，异步客户端据此判断是否需要重建
+
+def get_http_client_settings():
+    """默认连接池参数，叠加 Uconfig.json 中的覆盖项"""
+    settings = dict(HTTP_CLIENT_DEFAULTS)
+    overrides = config.get("http_client") or {}
+    settings.update({k: v for k, v in overrides.items() if k in HTTP_CLIENT_DEFAULTS})
+    return settings
+
+def _http_client_options(settings):
+    """httpx.Client / httpx.AsyncClient 共用的连接池与超时参数"""
+    import httpx
+    return {
+        "limits": httpx.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive_connections"],
+            keepalive_expiry=settings["keepalive_expiry"],
+        ),
+        "timeout": httpx.Timeout(settings["read_timeout"], connect=settings["connect_timeout"]),
+    }
+
+def build_openai_client(base_url, api_key=SIDECAR_API_KEY):
+    """按当前连接池参数创建一个 OpenAI 客户端"""
+    import httpx
+    from openai import OpenAI # 延迟导入，见文件开头
+    settings = get_http_client_settings()
+    http_client = httpx.Client(**_http_client_options(settings))
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client, max_retries=settings["max_retries"])
+
+def build_async_openai_client(base_url, api_key=SIDECAR_API_KEY):
+    """异步服务模式使用的 AsyncOpenAI 客户端，参数与同步客户端一致"""
+    import httpx
+    from openai import AsyncOpenAI
+    settings = get_http_client_settings()
+    http_client = httpx.AsyncClient(**_http_client_options(settings))
+    return AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client, max_retries=settings["max_retries"])
+
+def get_openai_client_entry():
+    """获取共享客户端及其 base_url；首次调用或 BASE_URL 变化后重新创建"""
+    global _openai_client_entry
+    entry = _openai_client_entry
+    if entry is not None and entry[1] == BASE_URL:
+        return entry
+    with _openai_client_lock:
+        base_url = BASE_URL
+        if _openai_client_entry is None or _openai_client_entry[1] != base_url:
+            old_entry = _openai_client_entry
+            _openai_client_entry = (build_openai_client(base_url), base_url)
+            logging.info(f"已创建共享 OpenAI 客户端 (base_url: {base_url})")
+            if old_entry is not None:
+                retire_openai_client(old_entry[0])
+        return _openai_client_entry
+
+def get_openai_client():
+    """获取共享客户端"""
+    return get_openai_client_entry()[0]
+
+def retire_openai_client(client):
+    """延迟关闭旧客户端：在途请求仍持有它的引用，等超过读超时后再关闭连接池"""
+    grace = get_http_client_settings()["read_timeout"] + 5
+    timer = threading.Timer(grace, client.close)
+    timer.daemon = True
+    timer.start()
+
+def reset_openai_client():
+    """sidecar 重启后调用：丢弃指向旧进程的 keep-alive 连接，下次调用时重建客户端"""
+    global _openai_client_entry, _openai_client_generation
+    with _openai_client_lock:
+        old_entry = _openai_client_entry
+        _openai_client_entry = None
+        _openai_client_generation += 1
+    if old_entry is not None:
+        retire_openai_client(old_entry[0])
+        logging.info("共享 OpenAI 客户端已重置，旧连接池将在在途请求结束后关闭")
+
+# --- 新增：在途请求登记 ---
+# 蓝绿切换 sidecar 时，旧进程要等指向它的请求都结束后再停止
+_inflight_upstream = {} # base_url -> 在途请求数
+_inflight_lock = threading.Lock()
+
+@contextmanager
+def track_inflight(base_url):
+    """登记一次发往 base_url 的在途请求"""
+    with _inflight_lock:
+        _inflight_upstream[base_url] = _inflight_upstream.get(base_url, 0) + 1
+    try:
+        yield
+    finally:
+        with _inflight_lock:
+            _inflight_upstream[base_url] -= 1
+
+def get_inflight_count(base_url):
+    with _inflight_lock:
+        return _inflight_upstream.get(base_url, 0)
+
+def _collect_inflight_metrics():
+    with _inflight_lock:
+        return [("chatapp_upstream_in_flight", (base_url,), count) for base_url, count in _inflight_upstream.items()]
+
+_gauge_collectors.append(_collect_inflight_metrics)
+
+# --- 新增：按请求注入用户密钥的路由层 ---
+# 用户为模型保存了 key 且该模型由 OpenAI 兼容服务提供时，直接带着用户的 key 调用服务商；
+# 否则走 simple-one-api (使用模板中的默认 key)。
+DIRECT_CLIENT_CACHE_SIZE = 64 # 直连客户端缓存上限 (按 服务地址 + key 区分)
+_direct_clients = {} # (base_url, api_key) -> OpenAI 客户端
+_direct_clients_lock = threading.Lock()
+
+def get_provider_base_url(model_name):
+    """模型对应的 OpenAI 兼容服务地址 (来自模型索引)，不能直连时返回 None"""
+    try:
+        info = get_model_info(model_name)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logging.error(f"读取模型配置失败: {e}。请求将经由 simple-one-api。")
+        return None
+    return info["provider_base_url"] if info else None
 
-    logging.info(f"使用模型 '{model_name}' (API标识: {current_api}, 温度: {temperature}) 进行调用")
-    
-  
-    response = client.chat.completions.create(
-        model=model_name, # 使用映射得到的模型名称
-        messages=[{"role": "user", "content": text}],
-        # temperature=temperature
-    )
-    return response.choices[0].message.content
-
-
-## 保存历史文件 (**修改：** 添加 username 参数和列)
-def save_chat(username, user_msg, ai_msg):
-    global current_session # 需要访问全局会话ID
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") # 使用 datetime 获取更精确的时间
+def get_direct_route(username, model_name):
+    """返回 (base_url, api_key)；用户没有 key 或模型不支持直连时返回 None"""
+    api_key = get_user_key(username, model_name)
+    if not api_key:
+        return None
+    base_url = get_provider_base_url(model_name)
+    if not base_url:
+        logging.warning(f"模型 {model_name} 不是 OpenAI 兼容服务，无法注入用户 {username} 的密钥，改用默认配置")
+        return None
+    return base_url, api_key
+
+def get_direct_client(base_url, api_key):
+    """获取 (服务地址, key) 对应的直连客户端，超出缓存上限时淘汰最早创建的"""
+    key = (base_url, api_key)
+    with _direct_clients_lock:
+        client = _direct_clients.get(key)
+        if client is None:
+            if len(_direct_clients) >= DIRECT_CLIENT_CACHE_SIZE:
+                oldest_key = next(iter(_direct_clients))
+                retire_openai_client(_direct_clients.pop(oldest_key))
+            client = build_openai_client(base_url, api_key=api_key)
+            _direct_clients[key] = client
+        return client
+
+@contextmanager
+def upstream_call(username, model_name):
+    """按用户选择上游并登记在途请求，用法：with upstream_call(user, model) as client: ..."""
+    route = get_direct_route(username, model_name)
+    if route:
+        base_url, api_key = route
+        client = get_direct_client(base_url, api_key)
+    else:
+        client, base_url = get_openai_client_entry()
+    with track_inflight(base_url):
+        yield client
+
+# --- 新增：上游容错 (延迟统计 + 熔断 + 重试 + 对冲/备用模型) ---
+# 某个服务商变慢或出错时，以前每次 /api/send 都要等到超时。现在每次上游调用都经过这一层：
+#   - 按模型统计最近的调用延迟 (p50/p95)
+#   - 熔断：连续失败 (超时、连接错误、429、5xx) 达到阈值后暂停调用该模型，open_seconds 后放行一个探测请求
+#   - 重试：指数退避 + 随机抖动，上游返回 Retry-After 时按其等待
+#   - 备用模型：Mconfig.json 中为公司配置 "fallback_model"。主模型熔断或重试耗尽时改用备用模型；
+#     开启 hedge 后，主模型超过 p95 延迟仍未返回就同时请求备用模型，采用先返回的结果。
+#     同步模式下落后的请求无法中断，会在后台继续执行并消耗上游额度 (计入 hedge_abandoned)
+# 参数可在 Uconfig.json 的 "fault_tolerance" 中覆盖。
+FAULT_TOLERANCE_DEFAULTS = {
+    "max_retries": 2,              # 每个模型的重试次数 (不含首次)
+    "backoff_base_ms": 200,        # 退避基数，第 n 次重试最多等待 base * 2^n
+    "backoff_max_ms": 5000,        # 单次退避上限
+    "retry_after_max_seconds": 10, # Retry-After 超过该值时不再重试，直接失败/改用备用模型
+    "breaker_failure_threshold": 5,# 连续失败多少次后熔断
+    "breaker_open_seconds": 30,    # 熔断持续时间
+    "hedge": False,                # 是否开启对冲请求 (会增加调用量)
+    "hedge_min_delay_ms": 500,     # 对冲等待时间下限
+    "hedge_default_delay_ms": 3000,# 延迟样本不足时的对冲等待时间
+}
+LATENCY_SAMPLE_SIZE = 200 # 每个模型保留的延迟样本数
+HEDGE_MIN_SAMPLES = 20    # 样本数达到该值后才用 p95 决定对冲等待时间
+HEDGE_MAX_WORKERS = 32
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+_latency_samples = {} # model_name -> deque[秒]
+_breakers = {} # model_name -> {"state": "closed"/"open"/"half_open", "failures", "opened_at", "probe_at"}
+_fault_stats = {} # model_name -> 计数
+_fault_lock = threading.Lock()
+_hedge_executor = None
+
+def get_fault_tolerance_settings():
+    """默认容错参数，叠加 Uconfig.json 中 "fault_tolerance" 的覆盖项"""
+    settings = dict(FAULT_TOLERANCE_DEFAULTS)
+    overrides = config.get("fault_tolerance") or {}
+    settings.update({k: v for k, v in overrides.items() if k in FAULT_TOLERANCE_DEFAULTS})
+    return settings
+
+def _count_fault_event_locked(model_name, event):
+    stats = _fault_stats.setdefault(model_name, {"calls": 0, "failures": 0, "retries": 0, "breaker_opens": 0,
+                                                 "fallbacks": 0, "hedges": 0, "hedge_wins": 0, "hedge_abandoned": 0})
+    stats[event] += 1
+
+def count_fault_event(model_name, event):
+    with _fault_lock:
+        _count_fault_event_locked(model_name, event)
+
+def record_latency(model_name, seconds):
+    with _fault_lock:
+        _latency_samples.setdefault(model_name, deque(maxlen=LATENCY_SAMPLE_SIZE)).append(seconds)
+
+def get_latency_percentile(model_name, percentile):
+    """最近样本的百分位延迟 (秒)，没有样本时返回 None"""
+    with _fault_lock:
+        samples = sorted(_latency_samples.get(model_name, ()))
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+def _breaker_locked(model_name):
+    return _breakers.setdefault(model_name, {"state": "closed", "failures": 0, "opened_at": 0.0, "probe_at": 0.0})
+
+def breaker_allow(model_name):
+    """是否允许调用该模型；熔断到期后只放行一个探测请求"""
+    open_seconds = get_fault_tolerance_settings()["breaker_open_seconds"]
+    now = time.monotonic()
+    with _fault_lock:
+        breaker = _breaker_locked(model_name)
+        if breaker["state"] == "closed":
+            return True
+        if breaker["state"] == "open" and now - breaker["opened_at"] < open_seconds:
+            return False
+        if breaker["state"] == "half_open" and now - breaker["probe_at"] < open_seconds:
+            return False # 已有探测请求在进行
+        breaker["state"] = "half_open"
+        breaker["probe_at"] = now
+        return True
+
+def breaker_is_open(model_name):
+    """该模型当前是否处于熔断 (不占用探测名额)"""
+    open_seconds = get_fault_tolerance_settings()["breaker_open_seconds"]
+    now = time.monotonic()
+    with _fault_lock:
+        breaker = _breaker_locked(model_name)
+        if breaker["state"] == "open":
+            return now - breaker["opened_at"] < open_seconds
+        if breaker["state"] == "half_open":
+            return now - breaker["probe_at"] < open_seconds
+        return False
+
+def breaker_record_success(model_name):
+    with _fault_lock:
+        breaker = _breaker_locked(model_name)
+        if breaker["state"] != "closed":
+            logging.info(f"模型 '{model_name}' 探测成功，解除熔断")
+        breaker["state"] = "closed"
+        breaker["failures"] = 0
+
+def breaker_record_failure(model_name):
+    threshold = get_fault_tolerance_settings()["breaker_failure_threshold"]
+    with _fault_lock:
+        breaker = _breaker_locked(model_name)
+        breaker["failures"] += 1
+        _count_fault_event_locked(model_name, "failures")
+        if breaker["state"] == "half_open" or (breaker["state"] == "closed" and breaker["failures"] >= threshold):
+            breaker["state"] = "open"
+            breaker["opened_at"] = time.monotonic()
+            _count_fault_event_locked(model_name, "breaker_opens")
+            logging.warning(f"模型 '{model_name}' 连续失败 {breaker['failures']} 次，熔断")
+
+def is_retryable_error(error):
+    """超时、连接错误、429、5xx 等暂时性错误可以重试 (也计入熔断)；401/400 等不可以"""
+    import httpx
+    from openai import APIConnectionError, APIStatusError # 能走到这里说明客户端已创建，导入只是查缓存
+    if isinstance(error, APIConnectionError): # 包括 APITimeoutError
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+def retry_after_seconds(error):
+    """解析上游返回的 Retry-After (秒数或 HTTP 日期)，没有时返回 None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
     try:
-        # 确保文件存在且有表头，如果需要的话（initialize_files 应该已处理）
-        if not os.path.exists(HISTORY_PATH):
-             initialize_files()
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-        with open(HISTORY_PATH, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow([current_session, username, user_msg, ai_msg, timestamp])
-        # logging.info(f"聊天记录已保存 (用户: {username}, 会话: {current_session})")
-    except IOError as e:
-        logging.error(f"保存聊天记录时出错 (用户: {username}, 会话: {current_session}): {e}")
+def backoff_delay(retry_index, error, settings):
+    """第 retry_index 次重试前的等待秒数；Retry-After 超过上限时返回 None 表示不再重试"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return retry_after if retry_after <= settings["retry_after_max_seconds"] else None
+    cap = min(settings["backoff_max_ms"], settings["backoff_base_ms"] * (2 ** retry_index))
+    return random.uniform(0, cap) / 1000 # full jitter，避免大量请求同时重试
+
+def get_fallback_model(model_name):
+    """Mconfig.json 中为该模型所属公司配置的备用模型"""
+    try:
+        info = get_model_info(model_name)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    fallback = (info or {}).get("fallback_model")
+    return fallback if fallback and fallback != model_name else None
+
+def run_with_retries(model_name, attempt):
+    """对单个模型调用 attempt(model_name)，暂时性错误按退避重试，并更新熔断和延迟统计"""
+    settings = get_fault_tolerance_settings()
+    for retry_index in range(settings["max_retries"] + 1):
+        if not breaker_allow(model_name):
+            raise RuntimeError(f"模型 '{model_name}' 暂时不可用 (熔断中)")
+        count_fault_event(model_name, "calls")
+        start = time.perf_counter()
+        try:
+            result = attempt(model_name)
+        except Exception as e:
+            observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, model_name, "error")
+            if not is_retryable_error(e):
+                raise
+            breaker_record_failure(model_name)
+            delay = backoff_delay(retry_index, e, settings)
+            if retry_index == settings["max_retries"] or delay is None:
+                raise
+            count_fault_event(model_name, "retries")
+            logging.warning(f"调用模型 '{model_name}' 失败 ({e})，{delay:.2f} 秒后重试")
+            time.sleep(delay)
+            continue
+        elapsed = time.perf_counter() - start
+        record_latency(model_name, elapsed)
+        observe("chatapp_upstream_request_duration_seconds", elapsed, model_name, "success")
+        breaker_record_success(model_name)
+        return result
+
+def get_hedge_delay(model_name, settings):
+    """对冲等待时间：主模型的 p95 延迟 (不低于下限)，样本不足时用默认值"""
+    with _fault_lock:
+        sample_count = len(_latency_samples.get(model_name, ()))
+    if sample_count < HEDGE_MIN_SAMPLES:
+        return settings["hedge_default_delay_ms"] / 1000
+    return max(settings["hedge_min_delay_ms"] / 1000, get_latency_percentile(model_name, 0.95))
+
+def get_hedge_executor():
+    global _hedge_executor
+    with _fault_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+        return _hedge_executor
+
+def hedged_call(model_name, fallback_model, attempt, settings):
+    """先请求主模型，超过对冲等待时间仍未返回时同时请求备用模型，返回先成功的结果"""
+    executor = get_hedge_executor()
+    primary = executor.submit(run_with_retries, model_name, attempt)
+    done, _ = wait_futures([primary], timeout=get_hedge_delay(model_name, settings))
+    if done and primary.exception() is None:
+        return primary.result()
+    if done and not (is_retryable_error(primary.exception()) or breaker_is_open(model_name)):
+        raise primary.exception() # 400/401 等错误换备用模型也没有用，与 resilient_call 一致
+    if not done:
+        logging.info(f"模型 '{model_name}' 响应较慢，同时请求备用模型 '{fallback_model}'")
+        count_fault_event(model_name, "hedges")
+    else:
+        count_fault_event(model_name, "fallbacks") # 主模型在对冲前就失败了
+    hedge = executor.submit(run_with_retries, fallback_model, attempt)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    count_fault_event(model_name, "hedge_wins")
+                for other in pending:
+                    if not other.cancel(): # 还在排队的直接取消；已经在请求上游的无法中断，在后台结束，结果丢弃
+                        count_fault_event(model_name, "hedge_abandoned")
+                return future.result()
+    raise primary.exception()
+
+def resilient_call(model_name, attempt):
+    """带容错地调用 attempt(target_model)：重试、熔断，必要时改用 (或对冲到) 备用模型"""
+    settings = get_fault_tolerance_settings()
+    fallback = get_fallback_model(model_name)
+    if fallback and breaker_is_open(model_name):
+        logging.warning(f"模型 '{model_name}' 熔断中，改用备用模型 '{fallback}'")
+        count_fault_event(model_name, "fallbacks")
+        return run_with_retries(fallback, attempt)
+    if fallback and settings["hedge"] and not breaker_is_open(fallback):
+        return hedged_call(model_name, fallback, attempt, settings)
+    try:
+        return run_with_retries(model_name, attempt)
     except Exception as e:
-         logging.error(f"保存聊天时发生未知错误: {e}")
+        if not fallback or not (is_retryable_error(e) or breaker_is_open(model_name)):
+            raise
+        logging.warning(f"模型 '{model_name}' 调用失败 ({e})，改用备用模型 '{fallback}'")
+        count_fault_event(model_name, "fallbacks")
+        return run_with_retries(fallback, attempt)
+
+def resilient_stream(model_name, make_stream):
+    """
+    流式版本：make_stream(target_model) 返回增量文本的迭代器。
+    收到第一段之前失败可以重试或改用备用模型；已经输出内容后失败则直接抛出 (不能重发)。
+    """
+    settings = get_fault_tolerance_settings()
+    fallback = get_fallback_model(model_name)
+    candidates = [model_name] + ([fallback] if fallback else [])
+    if fallback and breaker_is_open(model_name):
+        logging.warning(f"模型 '{model_name}' 熔断中，改用备用模型 '{fallback}'")
+        candidates = [fallback]
+    last_error = None
+    for target in candidates:
+        if target != model_name:
+            count_fault_event(model_name, "fallbacks")
+        for retry_index in range(settings["max_retries"] + 1):
+            if not breaker_allow(target):
+                last_error = RuntimeError(f"模型 '{target}' 暂时不可用 (熔断中)")
+                break
+            count_fault_event(target, "calls")
+            started = False
+            start = time.perf_counter()
+            stream = make_stream(target)
+            try:
+                for delta in stream:
+                    started = True
+                    yield delta
+            except Exception as e:
+                observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, target, "error")
+                if not is_retryable_error(e):
+                    raise
+                breaker_record_failure(target)
+                delay = backoff_delay(retry_index, e, settings)
+                if started:
+                    raise
+                last_error = e
+                if retry_index == settings["max_retries"] or delay is None:
+                    break
+                count_fault_event(target, "retries")
+                logging.warning(f"流式调用模型 '{target}' 失败 ({e})，{delay:.2f} 秒后重试")
+                time.sleep(delay)
+                continue
+            finally:
+                stream.close()
+            observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, target, "success")
+            breaker_record_success(target)
+            return
+    raise last_error
+
+def get_upstream_health():
+    """各模型的延迟、熔断状态和容错计数"""
+    result = {}
+    with _fault_lock:
+        models = set(_latency_samples) | set(_breakers) | set(_fault_stats)
+    for model_name in models:
+        p50 = get_latency_percentile(model_name, 0.5)
+        p95 = get_latency_percentile(model_name, 0.95)
+        with _fault_lock:
+            breaker = dict(_breaker_locked(model_name))
+            stats = dict(_fault_stats.get(model_name, {}))
+        result[model_name] = {
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "breaker": breaker["state"],
+            "consecutive_failures": breaker["failures"],
+            **stats,
+        }
+    return result
+
+@app.route('/api/upstream_health')
+def upstream_health():
+    return jsonify(get_upstream_health())
+
+# --- 新增：多轮对话上下文 ---
+# 以前每次只发送当前这一句，模型看不到同一会话的前文。现在把会话历史按模型的 token 预算
+# 截取最近的若干轮一起发送。每个会话的上下文窗口缓存在内存 LRU 中，save_chat 时增量追加，
+# 组装上下文时不需要重新读取、重新估算整段历史。其他进程写入过该用户的记录时重新读取 (见 history_cache_version)。
+DEFAULT_CONTEXT_TOKENS = 4000       # Mconfig.json 未配置 "context_tokens" 时的默认预算
+CONTEXT_WINDOW_MAX_TOKENS = 32000   # 缓存窗口最多保留的 token 数 (各模型预算的上限)
+CONTEXT_CACHE_SIZE = 256            # 最多缓存的会话数
+MESSAGE_OVERHEAD_TOKENS = 4         # 每条消息的格式开销 (role 等)
+_context_cache = OrderedDict() # (username, session_id) -> {"turns": deque[(user_msg, ai_msg, tokens)], "tokens": 总数, "version"}
+_context_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余约 4 个字符 1 token"""
+    cjk = sum(1 for ch in text if '\u3040' <= ch <= '\u30ff' or '\u3400' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af')
+    return cjk + (len(text) - cjk + 3) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+def get_context_budget(model_name):
+    """模型可用于上下文的 token 预算"""
+    try:
+        info = get_model_info(model_name)
+    except (FileNotFoundError, json.JSONDecodeError):
+        info = None
+    budget = (info or {}).get("context_tokens") or DEFAULT_CONTEXT_TOKENS
+    return min(budget, CONTEXT_WINDOW_MAX_TOKENS)
+
+def _trim_context_window(window):
+    while window["tokens"] > CONTEXT_WINDOW_MAX_TOKENS and window["turns"]:
+        window["tokens"] -= window["turns"].popleft()[2]
+
+def _load_context_window(username, session_id):
+    """从数据库倒序读取会话最近的若干轮 (不持锁调用)"""
+    # 等本进程已入队的记录写完，数据库里就包含了它们；先读版本号，读完之前其他进程的写入会让下次使用时重新读取
+    start = time.perf_counter()
+    flush_history()
+    version = get_history_version(username)
+    turns = deque()
+    total = 0
+    rows = get_history_db().execute(
+        "SELECT id, timestamp, user_msg, ai_msg FROM chat_history WHERE session_id = ? AND username = ? ORDER BY timestamp DESC, id DESC",
+        (session_id, username))
+    oldest = None
+    full = False
+    for row_id, timestamp, user_msg, ai_msg in rows: # 从最新一轮往前读，超出窗口上限即停止
+        tokens = estimate_tokens(user_msg) + estimate_tokens(ai_msg)
+        if total + tokens > CONTEXT_WINDOW_MAX_TOKENS:
+            full = True
+            break
+        turns.appendleft((user_msg, ai_msg, tokens))
+        total += tokens
+        oldest = (timestamp, row_id)
+    if not full:
+        # 热数据读完窗口仍未满：继续从归档中读更早的轮次 (会话没有归档时只多一次索引查询)
+        for row_id, timestamp, user_msg, ai_msg in load_archived_session_rows(username, session_id, oldest):
+            tokens = estimate_tokens(user_msg) + estimate_tokens(ai_msg)
+            if total + tokens > CONTEXT_WINDOW_MAX_TOKENS:
+                break
+            turns.appendleft((user_msg, ai_msg, tokens))
+            total += tokens
+    observe("chatapp_history_read_duration_seconds", time.perf_counter() - start, "context")
+    return {"turns": turns, "tokens": total, "version": version}
+
+def get_context_window(username, session_id):
+    """
+    取得会话的上下文窗口：缓存仍有效时直接返回，否则从数据库读取后放入缓存。
+    读取数据库时不持有 _context_lock，冷会话不会阻塞其他用户组装上下文和 save_chat。
+    """
+    key = (username, session_id)
+    with _context_lock:
+        window = _context_cache.get(key)
+        seq = history_write_seq(username)
+    if window is not None:
+        version = history_cache_version(username, window["version"])
+        if version is not None:
+            with _context_lock:
+                window["version"] = max(window["version"], version)
+                if _context_cache.get(key) is window:
+                    _context_cache.move_to_end(key)
+            return window
+
+    window = _load_context_window(username, session_id)
+    with _context_lock:
+        if history_write_seq(username) == seq: # 读取期间本进程又有写入时，读到的结果可能缺少它，不放入缓存
+            _context_cache[key] = window
+            _context_cache.move_to_end(key)
+            if len(_context_cache) > CONTEXT_CACHE_SIZE:
+                _context_cache.popitem(last=False) # 淘汰最久未使用的会话
+    return window
+
+def _append_context_turn_locked(username, session_id, user_msg, ai_msg):
+    """save_chat 时把新的一轮追加到已缓存的窗口 (调用方需持有 _context_lock)"""
+    window = _context_cache.get((username, session_id))
+    if window is None:
+        return # 未缓存，下次用到时会从数据库读取
+    tokens = estimate_tokens(user_msg) + estimate_tokens(ai_msg)
+    window["turns"].append((user_msg, ai_msg, tokens))
+    window["tokens"] += tokens
+    _trim_context_window(window)
+
+def build_chat_messages(username, session_id, text, model_name):
+    """组装发送给模型的消息列表：预算内最近的若干轮历史 + 本次输入"""
+    budget = get_context_budget(model_name) - estimate_tokens(text)
+    history = []
+    if username and session_id and budget > 0:
+        window = get_context_window(username, session_id)
+        with _context_lock: # save_chat 会向缓存的窗口追加
+            used = 0
+            for user_msg, ai_msg, tokens in reversed(window["turns"]):
+                if used + tokens > budget:
+                    break
+                used += tokens
+                history.append((user_msg, ai_msg))
+    messages = []
+    for user_msg, ai_msg in reversed(history):
+        messages.append({"role": "user", "content": user_msg})
+        messages.append({"role": "assistant", "content": ai_msg})
+    messages.append({"role": "user", "content": text})
+    return messages
+
+# --- 新增：回答缓存 ---
+# 重试、共用模板、演示时经常出现完全相同的请求。以 (模型, 温度, 完整消息列表) 的哈希为键缓存回答，
+# 命中时直接返回，不再请求上游。内存层为带 TTL 的 LRU，可选启用 SQLite 磁盘层 (重启后仍有效)。
+# 只有 Mconfig.json 中设置了 "cache": true 的公司的模型才会缓存。
+COMPLETION_CACHE_DEFAULTS = {
+    "enabled": True,
+    "ttl_seconds": 3600,   # 缓存有效期
+    "max_entries": 1024,   # 内存层最多条目数
+    "max_chars": 4000000,  # 内存层回答总字符数上限
+    "disk": False,         # 是否启用磁盘层
+}
+_completion_cache = OrderedDict() # key -> (created_at, model_name, text)
+_completion_cache_chars = 0
+_completion_cache_lock = threading.Lock()
+_completion_cache_stats = {} # model_name -> {"memory_hits", "disk_hits", "misses", "stores"}
+_completion_cache_db_local = threading.local()
+_completion_cache_db_ready = False
+
+def get_completion_cache_settings():
+    """默认缓存参数，叠加 Uconfig.json 中 "completion_cache" 的覆盖项"""
+    settings = dict(COMPLETION_CACHE_DEFAULTS)
+    overrides = config.get("completion_cache") or {}
+    settings.update({k: v for k, v in overrides.items() if k in COMPLETION_CACHE_DEFAULTS})
+    return settings
+
+def is_cacheable_model(model_name):
+    """该模型是否开启了回答缓存"""
+    if not get_completion_cache_settings()["enabled"]:
+        return False
+    try:
+        info = get_model_info(model_name)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return bool(info and info.get("cache"))
+
+def completion_cache_key(model_name, temp, messages):
+    """(模型, 温度, 消息列表) 的哈希"""
+    raw = json.dumps([model_name, temp, messages], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _count_cache_event(model_name, event):
+    with _completion_cache_lock:
+        stats = _completion_cache_stats.setdefault(
+            model_name, {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0})
+        stats[event] += 1
+
+def get_completion_cache_db():
+    """获取当前线程的磁盘缓存连接（首次调用时建表）"""
+    global _completion_cache_db_ready
+    conn = getattr(_completion_cache_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(COMPLETION_CACHE_DB_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not _completion_cache_db_ready:
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS completion_cache (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL
+                    )""")
+            _completion_cache_db_ready = True
+        _completion_cache_db_local.conn = conn
+    return conn
+
+def _memory_cache_put_locked(key, model_name, text, created_at, settings):
+    """写入内存层并按条目数、字符数淘汰最久未使用的条目 (调用方需持有 _completion_cache_lock)"""
+    global _completion_cache_chars
+    old = _completion_cache.pop(key, None)
+    if old:
+        _completion_cache_chars -= len(old[2])
+    _completion_cache[key] = (created_at, model_name, text)
+    _completion_cache_chars += len(text)
+    while _completion_cache and (len(_completion_cache) > settings["max_entries"]
+                                 or _completion_cache_chars > settings["max_chars"]):
+        _, (_, _, evicted) = _completion_cache.popitem(last=False)
+        _completion_cache_chars -= len(evicted)
+
+def completion_cache_get(model_name, temp, messages):
+    """查询缓存，命中返回回答文本，否则返回 None"""
+    global _completion_cache_chars
+    if not is_cacheable_model(model_name):
+        return None
+    settings = get_completion_cache_settings()
+    key = completion_cache_key(model_name, temp, messages)
+    now = time.time()
+    with _completion_cache_lock:
+        entry = _completion_cache.get(key)
+        if entry is not None:
+            if now - entry[0] <= settings["ttl_seconds"]:
+                _completion_cache.move_to_end(key)
+                stats_event = "memory_hits"
+            else:
+                del _completion_cache[key] # 已过期
+                _completion_cache_chars -= len(entry[2])
+                entry = None
+    if entry is not None:
+        _count_cache_event(model_name, stats_event)
+        return entry[2]
+
+    if settings["disk"]:
+        try:
+            row = get_completion_cache_db().execute(
+                "SELECT response, created_at FROM completion_cache WHERE key = ? AND created_at >= ?",
+                (key, now - settings["ttl_seconds"])).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"读取回答缓存失败: {e}")
+            row = None
+        if row:
+            with _completion_cache_lock:
+                _memory_cache_put_locked(key, model_name, row[0], row[1], settings) # 回填内存层
+            _count_cache_event(model_name, "disk_hits")
+            return row[0]
+
+    _count_cache_event(model_name, "misses")
+    return None
+
+def completion_cache_put(model_name, temp, messages, text):
+    """保存一次完整的回答"""
+    if not text or not is_cacheable_model(model_name):
+        return
+    settings = get_completion_cache_settings()
+    key = completion_cache_key(model_name, temp, messages)
+    now = time.time()
+    with _completion_cache_lock:
+        _memory_cache_put_locked(key, model_name, text, now, settings)
+    if settings["disk"]:
+        try:
+            conn = get_completion_cache_db()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO completion_cache (key, model, response, created_at) VALUES (?, ?, ?, ?)",
+                             (key, model_name, text, now))
+                conn.execute("DELETE FROM completion_cache WHERE created_at < ?", (now - settings["ttl_seconds"],))
+        except sqlite3.Error as e:
+            logging.error(f"写入回答缓存失败: {e}")
+    _count_cache_event(model_name, "stores")
+
+def get_completion_cache_stats():
+    """各模型的命中/未命中次数及内存层占用"""
+    with _completion_cache_lock:
+        return {
+            "entries": len(_completion_cache),
+            "chars": _completion_cache_chars,
+            "models": {name: dict(stats) for name, stats in _completion_cache_stats.items()},
+        }
+
+@app.route('/api/cache_stats')
+def completion_cache_stats():
+    return jsonify(get_completion_cache_stats())
+
+# --- 新增：相同请求合并 (single-flight) ---
+# 多个完全相同的请求 (模型、温度、消息列表都相同，例如双击发送、多人同时发送同一模板) 同时进行时，
+# 只有第一个 (leader) 真正请求上游，其余请求等待并得到同一个结果；每个调用方仍然各自 save_chat。
+# 流式请求同理：后来者先补发 leader 已收到的片段，再跟随 leader 接收后续片段。
+# leader 的客户端中途断开时，如果还有跟随者，上游流转到后台继续读完，跟随者不受影响。
+# 合并键为回答缓存键 (completion_cache_key) 加上请求将使用的上游凭据，只有会用同一个 key 调用上游的请求才合并，
+# 不会出现一个用户的请求由另一个用户的 key 付费 (或继承其认证错误) 的情况。
+_singleflight_calls = {} # key -> {"done": threading.Event, "result", "error"}
+_singleflight_streams = {} # key -> {"parts": [...], "done": bool, "error", "followers": int, "cond": threading.Condition}
+_singleflight_lock = threading.Lock()
+_singleflight_stats = {} # model_name -> {"upstream_calls": 真正发出的调用, "coalesced": 被合并的请求}
+
+def _count_singleflight(model_name, event):
+    with _singleflight_lock:
+        stats = _singleflight_stats.setdefault(model_name, {"upstream_calls": 0, "coalesced": 0})
+        stats[event] += 1
+
+def get_singleflight_stats():
+    with _singleflight_lock:
+        return {
+            "in_flight": len(_singleflight_calls) + len(_singleflight_streams),
+            "models": {name: dict(stats) for name, stats in _singleflight_stats.items()},
+        }
+
+def coalesce_key(username, model_name, cache_key):
+    """合并键：走 simple-one-api 的请求共用 "shared"，直连的请求按 (服务地址, 用户 key) 的哈希区分"""
+    route = get_direct_route(username, model_name)
+    credential = hashlib.sha256("\n".join(route).encode("utf-8")).hexdigest() if route else "shared"
+    return f"{cache_key}:{credential}"
+
+def share_usage_tracker(call, tracker):
+    """跟随者成功拿到共享结果后，复制发起方的用量记录 (由调用方通过 record_shared_usage 计入)"""
+    if tracker is not None and call["tracker"] is not None:
+        tracker["tokens"] = list(call["tracker"]["tokens"])
+        tracker["shared"] = True
+
+def singleflight(key, model_name, fn, tracker=None):
+    """
+    相同 key 的并发调用只执行一次 fn()，所有调用方得到同一个结果 (或同一个异常)。
+    tracker 为 new_usage_tracker() 的返回值：发起方的 fn 把用量写入自己的 tracker，跟随者成功时得到其副本。
+    """
+    with _singleflight_lock:
+        call = _singleflight_calls.get(key)
+        leader = call is None
+        if leader:
+            call = {"done": threading.Event(), "result": None, "error": None, "tracker": tracker}
+            _singleflight_calls[key] = call
+    _count_singleflight(model_name, "upstream_calls" if leader else "coalesced")
+
+    if not leader:
+        logging.info(f"模型 '{model_name}' 的相同请求正在进行，等待共享结果")
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        share_usage_tracker(call, tracker)
+        return call["result"]
+
+    try:
+        call["result"] = fn()
+        return call["result"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _singleflight_lock:
+            _singleflight_calls.pop(key, None)
+        call["done"].set()
+
+def singleflight_stream(key, model_name, make_stream, tracker=None):
+    """流式版本：相同 key 的并发请求共享 make_stream() 产生的同一个上游流 (tracker 同 singleflight)"""
+    with _singleflight_lock:
+        call = _singleflight_streams.get(key)
+        leader = call is None
+        if leader:
+            call = {"parts": [], "done": False, "error": None, "followers": 0, "tracker": tracker,
+                    "cond": threading.Condition(_singleflight_lock)}
+            _singleflight_streams[key] = call
+        else:
+            call["followers"] += 1
+    _count_singleflight(model_name, "upstream_calls" if leader else "coalesced")
+
+    if not leader:
+        logging.info(f"模型 '{model_name}' 的相同流式请求正在进行，跟随其输出")
+        index = 0
+        try:
+            while True:
+                with call["cond"]:
+                    call["cond"].wait_for(lambda: len(call["parts"]) > index or call["done"])
+                    new_parts = call["parts"][index:]
+                    done = call["done"] # 片段和结束标记在同一把锁下写入，done 时 new_parts 已是全部剩余片段
+                index += len(new_parts)
+                yield from new_parts
+                if done:
+                    if call["error"] is not None:
+                        raise call["error"]
+                    share_usage_tracker(call, tracker)
+                    return
+        finally:
+            with call["cond"]:
+                call["followers"] -= 1
+
+    stream = make_stream()
+    handed_off = False
+    try:
+        for delta in stream:
+            with call["cond"]:
+                call["parts"].append(delta)
+                call["cond"].notify_all()
+            yield delta
+    except GeneratorExit:
+        # leader 的客户端断开：还有跟随者时交给后台线程读完上游流；否则不再接受新的跟随者，直接关闭
+        with call["cond"]:
+            handed_off = call["followers"] > 0
+            if not handed_off:
+                _singleflight_streams.pop(key, None)
+        if handed_off:
+            logging.info(f"模型 '{model_name}' 的共享流式请求发起方已断开，继续为 {call['followers']} 个跟随者读取")
+            threading.Thread(target=_drain_shared_stream, args=(key, call, stream), name="singleflight-drain", daemon=True).start()
+        raise
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        if not handed_off:
+            _finish_shared_stream(key, call, stream)
+
+def _finish_shared_stream(key, call, stream):
+    stream.close()
+    with call["cond"]:
+        _singleflight_streams.pop(key, None)
+        call["done"] = True
+        call["cond"].notify_all()
+
+def _drain_shared_stream(key, call, stream):
+    """leader 断开后在后台继续读取上游流；跟随者也全部断开时停止"""
+    try:
+        for delta in stream:
+            with call["cond"]:
+                call["parts"].append(delta)
+                call["cond"].notify_all()
+                if call["followers"] == 0:
+                    _singleflight_streams.pop(key, None) # 不再有人需要，停止读取
+                    break
+    except Exception as e:
+        call["error"] = e
+    finally:
+        _finish_shared_stream(key, call, stream)
+
+@app.route('/api/coalesce_stats')
+def coalesce_stats():
+    """查看相同请求合并的计数"""
+    return jsonify(get_singleflight_stats())
+
+# --- 新增：上游调用准入控制 (按用户令牌桶 + 按模型并发上限 + 加权公平排队) ---
+# 以前同一个用户的脚本可以同时发起任意多个 ai_call，占满 simple-one-api 和服务商的限流额度，其他用户全部变慢。
+# 现在 /api/send、/api/send_stream、/api/send_batch 调用模型前先经过准入控制：
+#   - 每个用户一个令牌桶 (每分钟补充 user_rate_per_minute 个，最多攒 user_burst 个)，用完立即返回 429
+#   - 每个模型 (MODEL_MAPPING 中的模型名) 同时在途的调用数有上限，超出的请求进入该模型的等待队列
+#   - 队列按用户加权公平调度 (start-time fair queueing)：名额空出时优先给已用份额最少的用户，
+#     一个用户排再多请求也只能按权重分到相应比例；批量任务的权重再乘以 batch_weight，交互请求优先
+#   - 队列已满时立即返回 429，排队超过 max_wait_seconds 也返回 429，两者都带 Retry-After
+# 统计见 /api/admission_stats 和 /metrics；参数可在 Uconfig.json 的 "admission" 中覆盖。
+ADMISSION_DEFAULTS = {
+    "enabled": True,
+    "user_rate_per_minute": 60,  # 令牌桶补充速度
+    "user_burst": 10,            # 令牌桶容量 (允许的突发请求数)
+    "model_max_concurrency": 8,  # 每个模型同时在途的调用数
+    "model_concurrency": {},     # 按模型覆盖并发上限，如 {"glm-4-flash": 16}
+    "max_queue": 64,             # 每个模型最多排队的请求数
+    "max_queue_per_user": 8,     # 每个用户在一个模型上最多排队的请求数
+    "max_wait_seconds": 15,      # 排队等待上限
+    "user_weights": {},          # 按用户设置权重 (默认 1)，权重越大分到的名额越多
+    "batch_weight": 0.25,        # 批量任务的权重系数
+}
+ADMISSION_REJECT_MESSAGES = {
+    "rate_limited": "请求过于频繁，请稍后重试",
+    "queue_full": "当前请求过多，请稍后重试",
+    "timeout": "排队等待超时，请稍后重试",
+}
+ADMISSION_MAX_TRACKED_USERS = 10000 # 令牌桶和公平队列记录的用户数上限，超出时清理空闲用户
+ADMISSION_WAIT_SAMPLE_SIZE = 500    # 每个模型保留的排队耗时样本数
+_admission_lock = threading.Lock()
+_user_buckets = {} # username -> {"tokens", "updated"}
+_admission_models = {} # model_name -> 见 _admission_model_locked
+
+register_metric("chatapp_admission_wait_seconds", "histogram", "Time spent waiting for an upstream slot", ("model",))
+register_metric("chatapp_admission_rejected_total", "counter", "Requests rejected by admission control", ("model", "reason"))
+register_metric("chatapp_admission_queue_depth", "gauge", "Requests waiting for an upstream slot", ("model",))
+register_metric("chatapp_admission_in_use", "gauge", "Upstream slots in use", ("model",))
+
+def get_admission_settings():
+    """默认准入参数，叠加 Uconfig.json 中 "admission" 的覆盖项"""
+    settings = dict(ADMISSION_DEFAULTS)
+    overrides = config.get("admission") or {}
+    settings.update({k: v for k, v in overrides.items() if k in ADMISSION_DEFAULTS})
+    return settings
+
+def get_model_concurrency_limit(model_name, settings):
+    return max(1, int(settings["model_concurrency"].get(model_name, settings["model_max_concurrency"])))
+
+def _admission_model_locked(model_name):
+    return _admission_models.setdefault(model_name, {
+        "in_use": 0,
+        "queue": [],          # 堆: (结束标签, 序号, 等待者)，取消的等待者惰性删除
+        "queued": 0,          # 仍在等待的请求数
+        "user_queued": {},    # username -> 等待数
+        "virtual_time": 0.0,  # 最近一次放行的开始标签
+        "user_finish": {},    # username -> 该用户最后一个请求的结束标签
+        "seq": 0,
+        "hold_avg": 1.0,      # 名额平均占用时间 (秒，指数平均)，用于估算 Retry-After
+        "admitted": 0,
+        "rejected": {},
+        "waits": deque(maxlen=ADMISSION_WAIT_SAMPLE_SIZE),
+    })
+
+def _take_user_token_locked(username, settings, now):
+    """从用户的令牌桶取一个令牌；令牌不足时返回需要等待的秒数，否则返回 None"""
+    rate = settings["user_rate_per_minute"] / 60
+    burst = settings["user_burst"]
+    bucket = _user_buckets.get(username)
+    if bucket is None:
+        if len(_user_buckets) >= ADMISSION_MAX_TRACKED_USERS:
+            # 已经攒满的令牌桶与新建的没有区别，可以丢掉
+            for name in [name for name, b in _user_buckets.items() if b["tokens"] + (now - b["updated"]) * rate >= burst]:
+                del _user_buckets[name]
+        bucket = _user_buckets[username] = {"tokens": burst, "updated": now}
+    bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+    bucket["updated"] = now
+    if bucket["tokens"] >= 1:
+        bucket["tokens"] -= 1
+        return None
+    return (1 - bucket["tokens"]) / rate if rate > 0 else settings["max_wait_seconds"]
+
+def _fair_tags_locked(model, username, weight):
+    """计算请求的开始/结束标签：结束标签越小越先放行，每个请求让该用户的标签前进 1/weight"""
+    if len(model["user_finish"]) >= ADMISSION_MAX_TRACKED_USERS:
+        # 标签不超过虚拟时间的用户与新用户没有区别
+        model["user_finish"] = {name: tag for name, tag in model["user_finish"].items() if tag > model["virtual_time"]}
+    start = max(model["virtual_time"], model["user_finish"].get(username, 0.0))
+    finish = start + 1 / weight
+    model["user_finish"][username] = finish
+    return start, finish
+
+def _estimate_retry_after_locked(model, limit):
+    """按排队长度和名额平均占用时间估算多久后再试 (1~60 秒)"""
+    return min(60.0, max(1.0, (model["queued"] + 1) * model["hold_avg"] / limit))
+
+def _reject_locked(model, model_name, reason, retry_after):
+    model["rejected"][reason] = model["rejected"].get(reason, 0) + 1
+    inc_counter("chatapp_admission_rejected_total", model_name, reason)
+    return {"reason": reason, "retry_after": retry_after}
+
+def _grant_locked(model, model_name, ticket, start_tag, now, enqueued_at):
+    model["in_use"] += 1
+    model["virtual_time"] = max(model["virtual_time"], start_tag)
+    model["admitted"] += 1
+    model["waits"].append(now - enqueued_at)
+    observe("chatapp_admission_wait_seconds", now - enqueued_at, model_name)
+    ticket["granted_at"] = now
+
+def _unqueue_locked(model, username):
+    model["queued"] -= 1
+    remaining = model["user_queued"][username] - 1
+    if remaining:
+        model["user_queued"][username] = remaining
+    else:
+        del model["user_queued"][username]
+
+def _dispatch_locked(model, model_name, limit, now):
+    """把空出的名额按结束标签从小到大分给等待者"""
+    while model["in_use"] < limit and model["queue"]:
+        _, _, waiter = heapq.heappop(model["queue"])
+        if waiter["cancelled"]:
+            continue
+        _unqueue_locked(model, waiter["username"])
+        _grant_locked(model, model_name, waiter["ticket"], waiter["start"], now, waiter["enqueued_at"])
+        waiter["event"].set()
+    if len(model["queue"]) > 2 * model["queued"] + 64: # 超时取消的等待者太多时整理一次堆
+        model["queue"] = [entry for entry in model["queue"] if not entry[2]["cancelled"]]
+        heapq.heapify(model["queue"])
+
+def check_user_rate(state):
+    """只检查令牌桶 (提交批量任务时使用)，返回拒绝信息或 None"""
+    settings = get_admission_settings()
+    if not settings["enabled"]:
+        return None
+    model_name = MODEL_MAPPING.get(state["api"], state["api"])
+    with _admission_lock:
+        retry_after = _take_user_token_locked(state["username"], settings, time.monotonic())
+        if retry_after is None:
+            return None
+        return _reject_locked(_admission_model_locked(model_name), model_name, "rate_limited", retry_after)
+
+def admit_request(state, batch=False):
+    """
+    调用模型前的准入检查，可能阻塞最多 max_wait_seconds，返回 (ticket, rejection)：
+    通过时用完后必须调用 release_admission(ticket)；被拒绝时 rejection 为 {"reason", "retry_after"}。
+    batch=True 用于批量任务中的单条提示词：不扣令牌 (提交时已检查)，权重乘以 batch_weight。
+    """
+    settings = get_admission_settings()
+    if not settings["enabled"]:
+        return None, None
+    username = state["username"]
+    model_name = MODEL_MAPPING.get(state["api"], state["api"])
+    limit = get_model_concurrency_limit(model_name, settings)
+    weight = max(0.01, float(settings["user_weights"].get(username, 1)) * (settings["batch_weight"] if batch else 1))
+    now = time.monotonic()
+    with _admission_lock:
+        model = _admission_model_locked(model_name)
+        must_wait = model["queued"] > 0 or model["in_use"] >= limit
+        if must_wait and (model["queued"] >= settings["max_queue"]
+                          or model["user_queued"].get(username, 0) >= settings["max_queue_per_user"]):
+            return None, _reject_locked(model, model_name, "queue_full", _estimate_retry_after_locked(model, limit))
+        if not batch:
+            retry_after = _take_user_token_locked(username, settings, now)
+            if retry_after is not None:
+                return None, _reject_locked(model, model_name, "rate_limited", retry_after)
+        start_tag, finish_tag = _fair_tags_locked(model, username, weight)
+        ticket = {"model": model_name, "granted_at": None, "released": False}
+        if not must_wait:
+            _grant_locked(model, model_name, ticket, start_tag, now, now)
+            return ticket, None
+        waiter = {"ticket": ticket, "username": username, "start": start_tag, "enqueued_at": now,
+                  "event": threading.Event(), "cancelled": False}
+        model["seq"] += 1
+        heapq.heappush(model["queue"], (finish_tag, model["seq"], waiter))
+        model["queued"] += 1
+        model["user_queued"][username] = model["user_queued"].get(username, 0) + 1
+
+    if waiter["event"].wait(settings["max_wait_seconds"]):
+        return ticket, None
+    with _admission_lock:
+        if ticket["granted_at"] is not None: # 超时的同时刚好被放行
+            return ticket, None
+        waiter["cancelled"] = True
+        _unqueue_locked(model, username)
+        logging.warning(f"用户 {username} 调用模型 '{model_name}' 排队超过 {settings['max_wait_seconds']} 秒，返回 429")
+        return None, _reject_locked(model, model_name, "timeout", _estimate_retry_after_locked(model, limit))
+
+def release_admission(ticket):
+    """归还名额并放行下一个等待者 (重复调用无害)"""
+    if ticket is None:
+        return
+    now = time.monotonic()
+    with _admission_lock:
+        if ticket["released"]:
+            return
+        ticket["released"] = True
+        model = _admission_models[ticket["model"]]
+        model["in_use"] -= 1
+        model["hold_avg"] = 0.8 * model["hold_avg"] + 0.2 * (now - ticket["granted_at"])
+        _dispatch_locked(model, ticket["model"], get_model_concurrency_limit(ticket["model"], get_admission_settings()), now)
+
+def get_admission_stats():
+    """按模型汇总：并发上限、在途数、排队数、放行/拒绝计数、排队耗时 (毫秒)"""
+    settings = get_admission_settings()
+    stats = {}
+    with _admission_lock:
+        for model_name in list(MODEL_MAPPING.values()) + [m for m in _admission_models if m not in MODEL_MAPPING.values()]:
+            model = _admission_model_locked(model_name)
+            waits = sorted(model["waits"])
+            stats[model_name] = {
+                "limit": get_model_concurrency_limit(model_name, settings),
+                "in_use": model["in_use"],
+                "queued": model["queued"],
+                "queued_users": len(model["user_queued"]),
+                "admitted": model["admitted"],
+                "rejected": dict(model["rejected"]),
+                "wait_p50_ms": round(waits[int(0.50 * (len(waits) - 1))] * 1000, 1) if waits else None,
+                "wait_p95_ms": round(waits[int(0.95 * (len(waits) - 1))] * 1000, 1) if waits else None,
+                "wait_max_ms": round(waits[-1] * 1000, 1) if waits else None,
+            }
+        tracked_users = len(_user_buckets)
+    return {"enabled": settings["enabled"], "models": stats, "tracked_users": tracked_users}
+
+def _collect_admission_metrics():
+    with _admission_lock:
+        snapshot = [(name, model["queued"], model["in_use"]) for name, model in _admission_models.items()]
+    return ([("chatapp_admission_queue_depth", (name,), queued) for name, queued, _ in snapshot]
+            + [("chatapp_admission_in_use", (name,), in_use) for name, _, in_use in snapshot])
+
+_gauge_collectors.append(_collect_admission_metrics)
+
+def admission_rejected_response(rejection):
+    """准入被拒绝时的 429 响应"""
+    retry_after = math.ceil(rejection["retry_after"])
+    response = jsonify({'success': False, 'error': ADMISSION_REJECT_MESSAGES[rejection["reason"]], 'retry_after': retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+@app.route('/api/admission_stats')
+def admission_stats():
+    """查看准入控制的排队和拒绝统计"""
+    return jsonify(get_admission_stats())
+
+# --- 新增：token 用量统计与配额 ---
+# 以前 ai_call 只取回答内容，丢掉了 response.usage，看不出是哪些用户、哪些模型在消耗额度。
+# 现在每次上游调用成功后记录提示/回答/总 token 数和耗时 (流式调用请求上游在最后一个分片中返回 usage；
+# 上游没有返回时按 estimate_tokens 估算，并计入 estimated_calls)。
+# 流式调用中途失败被重试时，没有产出内容、上游也没返回 usage 的那次尝试不计入。
+# 被合并的请求 (见 singleflight) 不调用上游，但按发起方那次调用的 token 数同样计入自己的用量和配额，
+# 记在 coalesced_calls 中，不计入 calls 和耗时。
+# 记录先在内存中按 (用户, 小时, 模型) 累加，后台线程每隔 flush_interval_seconds 合并写入 usage_hourly 表。
+# 配置了配额时，发送前检查该用户当天/当月已用的 token 数，超出返回 429 (在途请求可能让用量略超配额)。
+# 用户通过 /api/usage 查看自己的用量；参数可在 Uconfig.json 的 "usage" 中覆盖。
+USAGE_DEFAULTS = {
+    "flush_interval_seconds": 60, # 内存中的用量写入数据库的间隔
+    "stream_include_usage": True, # 流式调用时请求上游返回 usage (stream_options.include_usage)
+    "daily_token_quota": 0,       # 每个用户每天可用的 token 数，0 表示不限
+    "monthly_token_quota": 0,     # 每个用户每月可用的 token 数，0 表示不限
+    "user_quotas": {},            # 按用户覆盖，如 {"alice": {"daily_token_quota": 200000}}
+}
+USAGE_MAX_REPORT_DAYS = 90
+USAGE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "total_tokens", "latency_ms", "estimated_calls", "coalesced_calls")
+_usage_pending = {} # (username, hour, model) -> 按 USAGE_FIELDS 顺序的累计值
+_usage_totals = {} # username -> {"day", "day_tokens", "month", "month_tokens"}，配额检查用，每次写库后清空重新加载
+_usage_lock = threading.Lock()
+_usage_flush_thread = None
+
+register_metric("chatapp_upstream_tokens_total", "counter", "Tokens reported by the upstream", ("model", "type"))
+
+def get_usage_settings():
+    """默认用量参数，叠加 Uconfig.json 中 "usage" 的覆盖项"""
+    settings = dict(USAGE_DEFAULTS)
+    overrides = config.get("usage") or {}
+    settings.update({k: v for k, v in overrides.items() if k in USAGE_DEFAULTS})
+    return settings
+
+def usage_hour(now=None):
+    return (now or datetime.now()).strftime("%Y-%m-%d %H:00")
+
+def stream_usage_options():
+    """流式调用的额外参数：请求上游在最后一个分片中返回 usage"""
+    return {"stream_options": {"include_usage": True}} if get_usage_settings()["stream_include_usage"] else {}
+
+def new_usage_tracker():
+    """一次 ai_call 的用量记录：发起方的各次尝试写入 "tokens"，被合并的调用方收到发起方的副本并标记 shared"""
+    return {"tokens": [], "shared": False}
+
+def record_usage(username, model_name, latency, usage=None, messages=(), completion="", tracker=None):
+    """记录一次上游调用的用量；usage 为上游返回的 usage 对象，缺失时按消息和回答估算"""
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    estimated = prompt_tokens is None or completion_tokens is None
+    if estimated:
+        prompt_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+        completion_tokens = estimate_tokens(completion)
+    total_tokens = getattr(usage, "total_tokens", None) or prompt_tokens + completion_tokens
+    if tracker is not None:
+        tracker["tokens"].append((model_name, prompt_tokens, completion_tokens, total_tokens))
+    _add_usage(username, model_name, (1, prompt_tokens, completion_tokens, total_tokens, latency * 1000, int(estimated), 0))
+    inc_counter("chatapp_upstream_tokens_total", model_name, "prompt", amount=prompt_tokens)
+    inc_counter("chatapp_upstream_tokens_total", model_name, "completion", amount=completion_tokens)
+
+def record_shared_usage(username, tracker):
+    """被合并的调用方按发起方的 token 数计入用量 (没有调用上游，不计 calls 和耗时)"""
+    for model_name, prompt_tokens, completion_tokens, total_tokens in tracker["tokens"]:
+        _add_usage(username, model_name, (0, prompt_tokens, completion_tokens, total_tokens, 0.0, 0, 1))
+
+def _add_usage(username, model_name, values):
+    """按 USAGE_FIELDS 顺序累加一组用量"""
+    total_tokens = values[3]
+    hour = usage_hour()
+    with _usage_lock:
+        entry = _usage_pending.setdefault((username, hour, model_name), [0, 0, 0, 0, 0.0, 0, 0])
+        for i, value in enumerate(values):
+            entry[i] += value
+        totals = _usage_totals.get(username)
+        if totals is not None:
+            if totals["day"] == hour[:10]:
+                totals["day_tokens"] += total_tokens
+                totals["month_tokens"] += total_tokens
+            else:
+                del _usage_totals[username] # 跨天后重新加载
+
+def flush_usage():
+    """把内存中的用量合并写入 usage_hourly (后台线程定时调用，程序退出时也会调用)"""
+    with _usage_lock: # 写库期间持有锁，配额检查不会漏算正在写入的用量
+        if not _usage_pending:
+            return
+        pending = dict(_usage_pending)
+        try:
+            conn = get_history_db()
+            with conn:
+                conn.executemany("""
+                    INSERT INTO usage_hourly (username, hour, model, calls, prompt_tokens, completion_tokens,
+                                              total_tokens, latency_ms, estimated_calls, coalesced_calls)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (username, hour, model) DO UPDATE SET
+                        calls = calls + excluded.calls,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        total_tokens = total_tokens + excluded.total_tokens,
+                        latency_ms = latency_ms + excluded.latency_ms,
+                        estimated_calls = estimated_calls + excluded.estimated_calls,
+                        coalesced_calls = coalesced_calls + excluded.coalesced_calls""",
+                    [key + tuple(entry) for key, entry in pending.items()])
+        except sqlite3.Error as e:
+            logging.error(f"写入 token 用量时出错 (下次重试): {e}")
+            return
+        _usage_pending.clear()
+        _usage_totals.clear() # 重新从数据库加载，顺便带上其他进程写入的用量
+
+def _usage_flush_loop():
+    while True:
+        time.sleep(get_usage_settings()["flush_interval_seconds"])
+        flush_usage()
+
+def start_usage_flusher():
+    """启动后台用量写入线程 (已在运行则忽略)"""
+    global _usage_flush_thread
+    if _usage_flush_thread is not None and _usage_flush_thread.is_alive():
+        return
+    _usage_flush_thread = threading.Thread(target=_usage_flush_loop, name="usage-flusher", daemon=True)
+    _usage_flush_thread.start()
+
+atexit.register(flush_usage)
+
+def _load_usage_totals_locked(username, day, month):
+    """该用户当天和当月已用的 token 数 (数据库 + 尚未写入的部分)"""
+    day_tokens, month_tokens = get_history_db().execute("""
+        SELECT COALESCE(SUM(CASE WHEN hour >= ? THEN total_tokens END), 0), COALESCE(SUM(total_tokens), 0)
+        FROM usage_hourly WHERE username = ? AND hour >= ?""", (day, username, month)).fetchone()
+    for (user, hour, _), entry in _usage_pending.items():
+        if user == username and hour.startswith(month):
+            month_tokens += entry[3]
+            if hour.startswith(day):
+                day_tokens += entry[3]
+    return {"day": day, "day_tokens": day_tokens, "month": month, "month_tokens": month_tokens}
+
+def get_usage_totals(username, now=None):
+    day = usage_hour(now)[:10]
+    with _usage_lock:
+        totals = _usage_totals.get(username)
+        if totals is None or totals["day"] != day:
+            totals = _usage_totals[username] = _load_usage_totals_locked(username, day, day[:7])
+        return dict(totals)
+
+def get_user_quota(username, settings):
+    """返回 (每日配额, 每月配额)，0 表示不限"""
+    quota = dict(settings["user_quotas"].get(username) or {})
+    return (quota.get("daily_token_quota", settings["daily_token_quota"]) or 0,
+            quota.get("monthly_token_quota", settings["monthly_token_quota"]) or 0)
+
+def check_usage_quota(username):
+    """调用上游前检查配额，超出时返回 {"period", "limit", "used", "retry_after"}，否则返回 None"""
+    daily, monthly = get_user_quota(username, get_usage_settings())
+    if not daily and not monthly:
+        return None
+    now = datetime.now()
+    try:
+        totals = get_usage_totals(username, now)
+    except sqlite3.Error as e:
+        logging.error(f"读取用户 {username} 的 token 用量时出错，跳过配额检查: {e}")
+        return None
+    if daily and totals["day_tokens"] >= daily:
+        reset_at = datetime(now.year, now.month, now.day) + timedelta(days=1)
+        return {"period": "daily", "limit": daily, "used": totals["day_tokens"], "retry_after": (reset_at - now).total_seconds()}
+    if monthly and totals["month_tokens"] >= monthly:
+        reset_at = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        return {"period": "monthly", "limit": monthly, "used": totals["month_tokens"], "retry_after": (reset_at - now).total_seconds()}
+    return None
+
+def quota_exceeded_message(exceeded):
+    period = "今日" if exceeded["period"] == "daily" else "本月"
+    return f'{period} token 用量已达上限 ({exceeded["used"]}/{exceeded["limit"]})'
+
+def quota_exceeded_response(exceeded):
+    """超出配额时的 429 响应"""
+    logging.warning(quota_exceeded_message(exceeded))
+    retry_after = math.ceil(exceeded["retry_after"])
+    response = jsonify({'success': False, 'error': quota_exceeded_message(exceeded), 'retry_after': retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+def get_usage_report(username, days):
+    """最近 days 天的用量：按小时和模型的明细、按模型汇总、总计"""
+    flush_usage() # 确保刚完成的调用也能查到
+    since = usage_hour(datetime.now() - timedelta(days=days - 1))[:10]
+    rows = get_history_db().execute(f"""
+        SELECT hour, model, {", ".join(USAGE_FIELDS)} FROM usage_hourly
+        WHERE username = ? AND hour >= ? ORDER BY hour, model""", (username, since)).fetchall()
+    hourly = []
+    by_model = {}
+    totals = dict.fromkeys(USAGE_FIELDS, 0)
+    for hour, model, *values in rows:
+        item = dict(zip(USAGE_FIELDS, values))
+        hourly.append(dict(item, hour=hour, model=model))
+        model_totals = by_model.setdefault(model, dict.fromkeys(USAGE_FIELDS, 0))
+        for field, value in item.items():
+            model_totals[field] += value
+            totals[field] += value
+    for item in [*hourly, *by_model.values(), totals]:
+        latency_ms = item.pop("latency_ms")
+        item["avg_latency_ms"] = round(latency_ms / item["calls"], 1) if item["calls"] else None
+    return {"since": since, "hourly": hourly, "by_model": by_model, "totals": totals}
+
+@app.route('/api/usage')
+def usage():
+    """查看当前用户的 token 用量和配额 (参数 user，可选 days，默认 7 天)"""
+    username = request.args.get('user')
+    if not username or get_request_state(username)[1] is None:
+        return jsonify({"success": False, "error": "用户未登录或认证失败"}), 401
+    try:
+        days = min(USAGE_MAX_REPORT_DAYS, max(1, int(request.args.get('days', 7))))
+    except ValueError:
+        return jsonify({"success": False, "error": "days 必须是整数"}), 400
+
+    try:
+        report = get_usage_report(username, days)
+        daily, monthly = get_user_quota(username, get_usage_settings())
+        used = get_usage_totals(username)
+    except sqlite3.Error as e:
+        logging.error(f"读取 token 用量时出错 (用户 {username}): {e}")
+        return jsonify({"success": False, "error": f"读取用量时出错: {e}"}), 500
+    report["quota"] = {"daily_token_quota": daily, "monthly_token_quota": monthly,
+                       "day_tokens": used["day_tokens"], "month_tokens": used["month_tokens"]}
+    return jsonify(dict(report, success=True))
+
+# 回答函数 (**修改：** 复用共享客户端，按用户注入密钥，带上会话上下文，命中缓存时不请求上游，合并相同的并发请求)
+# state 为用户状态 (见 create_user_state)，决定使用的模型、温度和会话
+def ai_call(text, state):
+    username = state["username"]
+    model_name = resolve_model_name(state["api"])
+    messages = build_chat_messages(username, state["session_id"], text, model_name)
+    cached = completion_cache_get(model_name, state["temperature"], messages)
+    if cached is not None:
+        logging.info(f"模型 '{model_name}' 命中回答缓存")
+        return cached
+
+    def attempt(target_model): # 主模型或备用模型的一次调用
+        logging.info(f"使用模型 '{target_model}' (API标识: {state['api']}, 温度: {state['temperature']}, 上下文 {len(messages) // 2} 轮) 进行调用")
+        with upstream_call(username, target_model) as client:
+            start = time.perf_counter()
+            response = client.chat.completions.create(
+                model=target_model, # 使用映射得到的模型名称
+                messages=messages,
+                # temperature=temperature
+            )
+        content = response.choices[0].message.content
+        record_usage(username, target_model, time.perf_counter() - start, response.usage, messages, content, tracker) # 新增：用量统计
+        return content
+
+    def call_upstream():
+        content = resilient_call(model_name, attempt)
+        completion_cache_put(model_name, state["temperature"], messages, content)
+        return content
+
+    tracker = new_usage_tracker()
+    key = coalesce_key(username, model_name, completion_cache_key(model_name, state["temperature"], messages))
+    content = singleflight(key, model_name, call_upstream, tracker)
+    if tracker["shared"]:
+        record_shared_usage(username, tracker) # 合并到他人请求的调用方同样计费
+    return content
+
+# --- 新增：流式回答 ---
+# 首字延迟 (time to first token) 统计：每个模型保留最近 TTFT_SAMPLE_SIZE 个样本
+TTFT_SAMPLE_SIZE = 500
+_ttft_samples = {} # model_name -> deque[秒]
+_ttft_lock = threading.Lock()
+
+def record_ttft(model_name, seconds):
+    """记录一次首字延迟"""
+    with _ttft_lock:
+        _ttft_samples.setdefault(model_name, deque(maxlen=TTFT_SAMPLE_SIZE)).append(seconds)
+    observe("chatapp_upstream_ttft_seconds", seconds, model_name)
+
+def get_ttft_stats():
+    """按模型汇总首字延迟 (毫秒)：样本数、平均值、p50、p95"""
+    stats = {}
+    with _ttft_lock:
+        snapshot = {model: sorted(samples) for model, samples in _ttft_samples.items()}
+    for model, samples in snapshot.items():
+        if not samples:
+            continue
+        count = len(samples)
+        stats[model] = {
+            "count": count,
+            "avg_ms": round(sum(samples) / count * 1000, 1),
+            "p50_ms": round(samples[int(0.50 * (count - 1))] * 1000, 1),
+            "p95_ms": round(samples[int(0.95 * (count - 1))] * 1000, 1),
+        }
+    return stats
+
+def ai_call_stream(text, state):
+    """流式调用模型，逐段 yield 增量文本"""
+    username = state["username"]
+    model_name = resolve_model_name(state["api"])
+    messages = build_chat_messages(username, state["session_id"], text, model_name)
+    cached = completion_cache_get(model_name, state["temperature"], messages)
+    if cached is not None:
+        logging.info(f"模型 '{model_name}' 命中回答缓存")
+        yield cached # 命中时整段一次输出
+        return
+
+    def open_stream(target_model): # 主模型或备用模型的一次流式调用
+        logging.info(f"使用模型 '{target_model}' (API标识: {state['api']}, 温度: {state['temperature']}) 进行流式调用")
+        with upstream_call(username, target_model) as client: # 整个流式输出期间都算在途请求
+            start = time.perf_counter()
+            stream = client.chat.completions.create(
+                model=target_model,
+                messages=messages,
+                stream=True,
+                **stream_usage_options(),
+            )
+            first_token = True
+            usage = None
+            parts = []
+            try:
+                for chunk in stream:
+                    usage = getattr(chunk, "usage", None) or usage # 开启 include_usage 时在最后一个分片中返回
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    if first_token:
+                        ttft = time.perf_counter() - start
+                        record_ttft(target_model, ttft)
+                        logging.info(f"模型 '{target_model}' 首字延迟: {ttft * 1000:.0f} ms")
+                        first_token = False
+                    parts.append(delta)
+                    yield delta
+            finally:
+                stream.close() # 客户端断开时也要及时关闭上游连接
+                # 中途断开的调用同样消耗了额度，按已输出的部分记录；没有输出也没有返回 usage 的失败尝试 (随后会被重试) 不计
+                if usage is not None or parts:
+                    record_usage(username, target_model, time.perf_counter() - start, usage, messages, "".join(parts), tracker)
+
+    def upstream_stream():
+        parts = []
+        for delta in resilient_stream(model_name, open_stream):
+            parts.append(delta)
+            yield delta
+        completion_cache_put(model_name, state["temperature"], messages, "".join(parts)) # 只缓存完整输出的回答
+
+    tracker = new_usage_tracker()
+    key = coalesce_key(username, model_name, completion_cache_key(model_name, state["temperature"], messages))
+    yield from singleflight_stream(key, model_name, upstream_stream, tracker)
+    if tracker["shared"]:
+        record_shared_usage(username, tracker)
+
+def sse_event(payload, event=None):
+    """按 Server-Sent Events 格式编码一条消息"""
+    data = json.dumps(payload, ensure_ascii=False)
+    return (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+
+@app.route('/api/send_stream', methods=['POST'])
+def handle_message_stream():
+    """/api/send 的流式版本：以 SSE 逐段推送回答，结束后整段保存到历史"""
+    data = request.json
+    user_input = data.get('message', '')
+    username = data.get('username')
+
+    _, state = get_request_state(username)
+    if not username or state is None:
+         logging.warning("收到流式发送消息请求，但缺少用户名或认证无效")
+         return jsonify({'success': False, 'error': '用户未登录或请求无效'}), 401
+    if not ensure_upstream_ready(state):
+        return upstream_not_ready_response()
+    exceeded = check_usage_quota(username)
+    if exceeded:
+        return quota_exceeded_response(exceeded)
+    ticket, rejection = admit_request(state)
+    if rejection:
+        return admission_rejected_response(rejection)
+
+    logging.info(f"用户 {username} 发送消息 (流式): {user_input[:50]}...")
+
+    def generate():
+        parts = []
+        try:
+            for delta in ai_call_stream(user_input, state):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        except Exception as e:
+            logging.error(f"处理用户 {username} 流式消息时出错: {e}")
+            yield sse_event({"error": f"处理消息时出错: {e}"}, event="error")
+            return
+        save_chat(username, user_input, "".join(parts), state["session_id"])
+        yield sse_event({"done": True}, event="done")
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: release_admission(ticket)) # 整个流式输出期间占用名额，客户端断开时也会归还
+    return response
+
+@app.route('/api/stream_stats', methods=['GET'])
+def stream_stats():
+    """查看各模型的首字延迟统计"""
+    return jsonify(get_ttft_stats())
+
+
+# --- 新增：后台批量写入聊天历史 (write-behind + group commit) ---
+# save_chat 只把记录放进队列就返回，请求耗时不再包含磁盘 I/O。
+# 写线程收到第一条记录后最多再等 flush_interval_ms 收集更多记录，一个事务批量提交。
+# fsync 策略 (Uconfig.json 的 "history_writer.fsync")：
+#   "batch"    每批提交都 fsync (SQLite synchronous=FULL)
+#   "interval" 至多每 fsync_interval_ms 对 WAL 文件 fsync 一次 (synchronous=NORMAL，checkpoint 时仍会同步，断电不会损坏数据库)
+#   "never"    不主动 fsync，交给操作系统 (synchronous=OFF，断电可能损坏数据库)
+HISTORY_WRITER_DEFAULTS = {
+    "flush_interval_ms": 20,
+    "max_batch": 500,
+    "fsync": "interval",
+    "fsync_interval_ms": 1000,
+}
+HISTORY_UPSERT_SESSION_SQL = """
+    INSERT INTO chat_sessions (username, session_id, last_time, preview, message_count)
+    VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT (username, session_id) DO UPDATE SET
+        message_count = message_count + 1,
+        preview = CASE WHEN excluded.last_time >= last_time THEN excluded.preview ELSE preview END,
+        last_time = MAX(last_time, excluded.last_time)"""
+_history_queue = queue.Queue()
+_history_writer_thread = None
+_history_writer_stopped = False
+_history_progress = threading.Condition() # 保护下面两个计数
+_history_enqueued = 0  # 已入队的记录数
+_history_processed = 0 # 写线程已处理 (提交或放弃) 的记录数
+_HISTORY_STOP = object() # 队列中的停止标记
+
+def get_history_writer_settings():
+    """默认写入参数，叠加 Uconfig.json 中 "history_writer" 的覆盖项"""
+    settings = dict(HISTORY_WRITER_DEFAULTS)
+    overrides = config.get("history_writer") or {}
+    settings.update({k: v for k, v in overrides.items() if k in HISTORY_WRITER_DEFAULTS})
+    return settings
+
+def write_history_batch(conn, records):
+    """在一个事务中写入一批记录：明细、会话摘要和搜索索引一起提交，不会出现不一致"""
+    with conn:
+        conn.executemany(
+            "INSERT INTO chat_history (session_id, username, user_msg, ai_msg, timestamp) VALUES (?, ?, ?, ?, ?)",
+            records)
+        if _search_available:
+            # 持有写锁期间 AUTOINCREMENT 的 id 是连续的，这一批就是最后插入的 len(records) 条
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            index_history_rows(conn, last_id - len(records) + 1, last_id)
+        conn.executemany(
+            HISTORY_UPSERT_SESSION_SQL,
+            [(username, session_id, timestamp, make_preview(user_msg))
+             for session_id, username, user_msg, ai_msg, timestamp in records])
+        bumped = bump_history_versions(conn, {record[1] for record in records})
+    remember_local_history_versions(bumped)
+
+def _fsync_history_wal():
+    """把 WAL 文件刷到磁盘 (interval 策略下使用)"""
+    try:
+        with open(HISTORY_DB_PATH + "-wal", "ab") as f:
+            os.fsync(f.fileno())
+    except OSError as e:
+        logging.warning(f"fsync 聊天历史 WAL 文件失败: {e}")
+
+def _extend_history_batch(batch, item):
+    """队列中的元素是单条记录 (tuple) 或一组必须在同一事务中写入的记录 (list)"""
+    if isinstance(item, list):
+        batch.extend(item)
+    else:
+        batch.append(item)
+
+def _history_writer_loop():
+    global _history_processed
+    settings = get_history_writer_settings()
+    flush_interval = settings["flush_interval_ms"] / 1000
+    fsync_interval = settings["fsync_interval_ms"] / 1000
+    policy = settings["fsync"]
+    conn = get_history_db()
+    conn.execute({"batch": "PRAGMA synchronous=FULL", "never": "PRAGMA synchronous=OFF"}.get(policy, "PRAGMA synchronous=NORMAL"))
+    last_fsync = time.monotonic()
+    dirty = False # interval 策略下是否有尚未 fsync 的提交
+    stopping = False
+
+    while not stopping:
+        try:
+            first = _history_queue.get(timeout=fsync_interval if dirty else None)
+        except queue.Empty:
+            first = None
+        batch = []
+        if first is _HISTORY_STOP:
+            stopping = True
+        elif first is not None:
+            _extend_history_batch(batch, first)
+            # group commit：在 flush_interval 内尽量多收集几条
+            deadline = time.monotonic() + flush_interval
+            while len(batch) < settings["max_batch"]:
+                remaining = deadline - time.monotonic()
+                try:
+                    record = _history_queue.get(timeout=remaining) if remaining > 0 else _history_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is _HISTORY_STOP:
+                    stopping = True
+                    break
+                _extend_history_batch(batch, record)
+        if stopping:
+            # 停止前把队列里剩下的记录全部写完
+            while True:
+                try:
+                    record = _history_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is not _HISTORY_STOP:
+                    _extend_history_batch(batch, record)
 
+        if batch:
+            for attempt in range(3):
+                try:
+                    with observe_duration("chatapp_history_write_batch_duration_seconds"):
+                        write_history_batch(conn, batch)
+                    dirty = policy == "interval"
+                    break
+                except sqlite3.Error as e:
+                    logging.error(f"批量写入 {len(batch)} 条聊天记录失败 (第 {attempt + 1} 次): {e}")
+                    time.sleep(0.1 * (attempt + 1))
+            else:
+                logging.error(f"放弃写入 {len(batch)} 条聊天记录")
+            with _history_progress:
+                _history_processed += len(batch)
+                _history_progress.notify_all()
+
+        if dirty and (stopping or time.monotonic() - last_fsync >= fsync_interval):
+            _fsync_history_wal()
+            last_fsync = time.monotonic()
+            dirty = False
+
+def _collect_history_queue_metrics():
+    with _history_progress:
+        return [("chatapp_history_queue_depth", (), _history_enqueued - _history_processed)]
+
+_gauge_collectors.append(_collect_history_queue_metrics)
+
+def start_history_writer():
+    """启动后台写线程 (已在运行则忽略)"""
+    global _history_writer_thread, _history_writer_stopped
+    with _history_progress:
+        if _history_writer_thread is not None and _history_writer_thread.is_alive():
+            return
+        _history_writer_stopped = False
+        _history_writer_thread = threading.Thread(target=_history_writer_loop, name="history-writer", daemon=True)
+        _history_writer_thread.start()
+
+def stop_history_writer(timeout=10):
+    """写完队列中所有记录后停止写线程 (与停止 simple-one-api 在同一退出路径上调用)"""
+    global _history_writer_stopped
+    with _history_progress:
+        thread = _history_writer_thread
+        if _history_writer_stopped or thread is None:
+            return
+        _history_writer_stopped = True
+    _history_queue.put(_HISTORY_STOP)
+    thread.join(timeout)
+    if thread.is_alive():
+        logging.error(f"聊天历史写线程未在 {timeout} 秒内结束，可能有记录未写入")
+    else:
+        logging.info("聊天历史写线程已停止，队列中的记录已全部写入")
+
+atexit.register(stop_history_writer) # 兜底：非 __main__ 方式运行时也要写完队列
+
+def enqueue_history(record):
+    """把一条记录交给写线程；写线程已停止时直接同步写入"""
+    global _history_enqueued
+    with _history_progress:
+        stopped = _history_writer_stopped
+        if not stopped:
+            _history_enqueued += 1
+    if stopped:
+        write_history_batch(get_history_db(), [record])
+        return
+    if _history_writer_thread is None:
+        start_history_writer()
+    _history_queue.put(record)
+
+def enqueue_history_batch(records):
+    """把一组记录作为一个整体交给写线程，保证它们在同一个事务中写入"""
+    global _history_enqueued
+    if not records:
+        return
+    with _history_progress:
+        stopped = _history_writer_stopped
+        if not stopped:
+            _history_enqueued += len(records)
+    if stopped:
+        write_history_batch(get_history_db(), records)
+        return
+    if _history_writer_thread is None:
+        start_history_writer()
+    _history_queue.put(list(records))
+
+def flush_history(timeout=5):
+    """等待调用前已入队的记录全部写入 (读历史前调用，保证读到自己刚写的记录)"""
+    with _history_progress:
+        target = _history_enqueued
+        if _history_processed >= target:
+            return True
+        return _history_progress.wait_for(lambda: _history_processed >= target, timeout)
+
+## 保存历史记录 (**修改：** 放入后台写入队列，并立即更新内存中的会话摘要)
+# session_id 由调用方传入 (发送消息时用户所在的会话)，回答期间切换会话也不会存错位置
+def save_chat(username, user_msg, ai_msg, session_id):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") # 使用 datetime 获取更精确的时间
+    start = time.perf_counter()
+    try:
+        # 在同一把锁内更新摘要、计数并入队，保证 get_user_sessions 加载时不会漏掉这条记录
+        # 上下文窗口同理 (加锁顺序固定为 _session_index_lock -> _context_lock)
+        with _session_index_lock, _context_lock:
+            _update_session_index_locked(username, session_id, user_msg, timestamp)
+            _count_history_write_locked(username)
+            enqueue_history((session_id, username, user_msg, ai_msg, timestamp))
+            _append_context_turn_locked(username, session_id, user_msg, ai_msg)
+        # logging.info(f"聊天记录已保存 (用户: {username}, 会话: {session_id})")
+    except sqlite3.Error as e:
+        logging.error(f"保存聊天记录时出错 (用户: {username}, 会话: {session_id}): {e}")
+    except Exception as e:
+         logging.error(f"保存聊天时发生未知错误: {e}")
+    observe("chatapp_save_chat_duration_seconds", time.perf_counter() - start)
+
+
+# --- 新增：批量发送 ---
+# 评测任务一次提交几百条提示词：在有界线程池中并发调用 ai_call，每完成一条就以 NDJSON 返回一行。
+# 每个用户同时在途的调用数受 per_user_concurrency 限制 (同一用户的多个批次共享名额)；
+# 名额由提交任务的请求线程获取，线程池中的线程不会因为等名额而被占住。
+# 批量提示词彼此独立，不带会话上下文；全部结果存入一个新会话，作为一个整体在同一个事务中写入历史。
+# 参数可在 Uconfig.json 的 "batch" 中覆盖。
+BATCH_DEFAULTS = {
+    "max_workers": 16,         # 所有批次共享的线程池大小
+    "per_user_concurrency": 4, # 每个用户同时在途的调用数
+    "max_prompts": 500,        # 单个批次允许的最多提示词数
+}
+_batch_executor = None
+_batch_user_slots = {} # username -> BoundedSemaphore
+_batch_lock = threading.Lock()
+
+def get_batch_settings():
+    """默认批量参数，叠加 Uconfig.json 中 "batch" 的覆盖项"""
+    settings = dict(BATCH_DEFAULTS)
+    overrides = config.get("batch") or {}
+    settings.update({k: v for k, v in overrides.items() if k in BATCH_DEFAULTS})
+    return settings
+
+def get_batch_executor():
+    global _batch_executor
+    with _batch_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=get_batch_settings()["max_workers"], thread_name_prefix="batch")
+        return _batch_executor
+
+def get_batch_user_slots(username):
+    with _batch_lock:
+        slots = _batch_user_slots.get(username)
+        if slots is None:
+            slots = _batch_user_slots[username] = threading.BoundedSemaphore(get_batch_settings()["per_user_concurrency"])
+        return slots
+
+def save_chat_batch(username, turns, session_id):
+    """把一组 (user_msg, ai_msg) 存入会话：摘要一次更新，记录作为一个整体入队"""
+    if not turns:
+        return
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    start = time.perf_counter()
+    try:
+        with _session_index_lock, _context_lock:
+            for user_msg, ai_msg in turns:
+                _update_session_index_locked(username, session_id, user_msg, timestamp)
+                _append_context_turn_locked(username, session_id, user_msg, ai_msg)
+            _count_history_write_locked(username)
+            enqueue_history_batch([(session_id, username, user_msg, ai_msg, timestamp) for user_msg, ai_msg in turns])
+    except sqlite3.Error as e:
+        logging.error(f"批量保存聊天记录时出错 (用户: {username}, 会话: {session_id}): {e}")
+    observe("chatapp_save_chat_duration_seconds", time.perf_counter() - start)
+
+def run_batch_prompt(index, prompt, state):
+    """在线程池中执行一条提示词，返回 NDJSON 中的一行 (dict)"""
+    start = time.perf_counter()
+    exceeded = check_usage_quota(state["username"]) # 批次执行期间也可能用完配额
+    if exceeded:
+        return {"index": index, "success": False, "error": quota_exceeded_message(exceeded), "elapsed_ms": 0.0}
+    ticket, rejection = admit_request(state, batch=True) # 与交互请求共享模型名额，优先级更低
+    if rejection:
+        result = {"index": index, "success": False, "error": ADMISSION_REJECT_MESSAGES[rejection["reason"]]}
+    else:
+        try:
+            response = ai_call(prompt, state)
+            result = {"index": index, "success": True, "response": response}
+        except Exception as e:
+            logging.error(f"批量任务中第 {index} 条提示词处理失败 (用户 {state['username']}): {e}")
+            result = {"index": index, "success": False, "error": f"处理消息时出错: {e}"}
+        finally:
+            release_admission(ticket)
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
 
-# 会话管理接口 (**修改：** 过滤用户)
+def save_batch_when_done(username, prompts, completed, running, session_id):
+    """
+    客户端断开时已经在请求上游的任务无法中断，额度已经消耗：等它们全部结束后，
+    连同已完成的结果一起保存 (仍然是一个整体写入)，不阻塞关闭连接的线程
+    """
+    lock = threading.Lock()
+    remaining = [len(running)]
+
+    def on_done(future):
+        result = None if future.cancelled() or future.exception() is not None else future.result()
+        with lock:
+            if result and result["success"]:
+                completed[result["index"]] = result["response"]
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            save_chat_batch(username, [(prompts[i], completed[i]) for i in sorted(completed)], session_id)
+            logging.info(f"用户 {username} 已断开的批量任务结束，保存 {len(completed)} 条结果 (会话 {session_id})")
+
+    for future in running:
+        future.add_done_callback(on_done)
+
+def stream_batch_results(username, prompts, state, session_id):
+    """按完成顺序逐行输出结果，最后输出汇总行；结束 (或客户端断开) 时一次性保存已完成的结果"""
+    executor = get_batch_executor()
+    slots = get_batch_user_slots(username)
+    pending = set()
+    next_index = 0
+    completed = {} # index -> 回答
+    failed = 0
+    try:
+        while next_index < len(prompts) or pending:
+            # 有在途任务时只用空闲名额；没有在途任务 (名额被该用户的其他批次占满) 时阻塞等待
+            while next_index < len(prompts) and slots.acquire(blocking=not pending):
+                future = executor.submit(run_batch_prompt, next_index, prompts[next_index], state)
+                future.add_done_callback(lambda f: slots.release())
+                pending.add(future)
+                next_index += 1
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            results = [future.result() for future in done]
+            for result in results: # 先记下全部结果再输出，输出中途断开也不会丢
+                if result["success"]:
+                    completed[result["index"]] = result["response"]
+                else:
+                    failed += 1
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+    finally:
+        # 客户端断开：尚未开始的任务不再执行 (取消同样会触发回调归还名额)，剩下的提示词也不再提交
+        running = [future for future in pending if not future.cancel()]
+        if running:
+            logging.info(f"用户 {username} 的批量任务被中断，已取消 {len(pending) - len(running)} 条，"
+                         f"等待 {len(running)} 条进行中的调用结束后保存")
+            save_batch_when_done(username, prompts, completed, running, session_id)
+        else:
+            save_chat_batch(username, [(prompts[i], completed[i]) for i in sorted(completed)], session_id)
+    logging.info(f"用户 {username} 的批量任务完成: 成功 {len(completed)}，失败 {failed} (会话 {session_id})")
+    yield json.dumps({"done": True, "session_id": session_id, "total": len(prompts),
+                      "succeeded": len(completed), "failed": failed}, ensure_ascii=False) + "\n"
+
+@app.route('/api/send_batch', methods=['POST'])
+def handle_send_batch():
+    data = request.json or {}
+    username = data.get('username')
+    prompts = data.get('prompts')
+    model_name = data.get('model') # 可选，不填时使用该用户当前选择的模型
+
+    _, state = get_request_state(username)
+    if not username or state is None:
+        logging.warning("收到批量发送请求，但缺少用户名或认证无效")
+        return jsonify({'success': False, 'error': '用户未登录或请求无效'}), 401
+    settings = get_batch_settings()
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) for p in prompts):
+        return jsonify({'success': False, 'error': 'prompts 必须是非空的字符串列表'}), 400
+    if len(prompts) > settings["max_prompts"]:
+        return jsonify({'success': False, 'error': f'单次最多提交 {settings["max_prompts"]} 条提示词'}), 400
+
+    api = state["api"]
+    if model_name:
+        try:
+            model_info = get_model_info(model_name)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logging.error(f"检查模型映射时出错: {e}")
+            return jsonify({'success': False, 'error': '检查模型有效性时出错'}), 500
+        if not model_info or not model_info["api_identifier"]:
+            return jsonify({'success': False, 'error': f'无效的模型名称: {model_name}'}), 400
+        api = model_info["api_identifier"]
+
+    session_id = str(uuid.uuid4()) # 结果存入一个新会话，不打乱用户当前的对话
+    batch_state = dict(state, api=api, session_id=None) # session_id 为空：不带历史上下文
+    if not ensure_upstream_ready(batch_state):
+        return upstream_not_ready_response()
+    exceeded = check_usage_quota(username)
+    if exceeded:
+        return quota_exceeded_response(exceeded)
+    rejection = check_user_rate(batch_state) # 一个批次只扣一个令牌，单条提示词在执行时排队
+    if rejection:
+        return admission_rejected_response(rejection)
+    logging.info(f"用户 {username} 提交批量任务: {len(prompts)} 条提示词 (API 标识: {api}，会话 {session_id})")
+    response = Response(stream_batch_results(username, prompts, batch_state, session_id), mimetype='application/x-ndjson')
+    response.headers["X-Batch-Session-Id"] = session_id
+    return response
+
+
+# 会话管理接口 (**修改：** 直接读取内存中的会话摘要，开销只与会话数有关)
 @app.route('/api/sessions')
 def get_sessions():
     username = request.args.get('user') # **新增：** 从查询参数获取用户名
     if not username:
         logging.warning("获取会话列表请求缺少用户名")
         return jsonify({"error": "需要提供用户名"}), 400
+    if get_request_state(username)[1] is None:
+        return jsonify({"error": "用户未登录或认证失败"}), 401
 
     logging.info(f"用户 {username} 请求会话列表")
-    sessions = {}
-    if os.path.exists(HISTORY_PATH):
-        try:
-            with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-                reader = csv.reader(f)
-                try:
-                    header = next(reader) # 读取表头
-                    # 验证表头是否符合预期
-                    if header != ["session_id", "username", "user_msg", "ai_msg", "timestamp"]:
-                         logging.error(f"历史文件表头不匹配: {header}")
-                         return jsonify({"error": "历史文件格式错误"}), 500
-                except StopIteration:
-                    logging.info("历史文件为空")
-                    return jsonify([]) # 空文件，返回空列表
-
-                for row in reader:
-                    # **修改：** 检查列数和用户名匹配
-                    if len(row) == 5 and row[1] == username:
-                        session_id = row[0]
-                        user_msg = row[2] # 用户消息用于预览
-                        timestamp_str = row[4]
-
-                        current_session_data = sessions.get(session_id, {"last_time": "1970-01-01 00:00:00"})
-
-                        try:
-                            # 比较时间戳，保留最新的
-                            row_time = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                            current_time = datetime.strptime(current_session_data["last_time"], "%Y-%m-%d %H:%M:%S")
-                            if row_time >= current_time:
-                                sessions[session_id] = {
-                                    "last_time": timestamp_str,
-                                    "preview": user_msg[:30] + "..." if len(user_msg) > 30 else user_msg
-                                }
-                        except ValueError:
-                             logging.warning(f"会话 {session_id} (用户 {username}) 的时间戳格式无效: {timestamp_str}")
-                             continue
-                    elif len(row) != 5:
-                        logging.warning(f"跳过格式不正确的行 (用户 {username}): {row}")
-
-        except IOError as e:
-            logging.error(f"读取历史记录时出错 (用户 {username}): {e}")
-            return jsonify({"error": f"读取历史记录时出错: {e}"}), 500
-        except Exception as e:
-             logging.error(f"处理历史记录时发生未知错误 (用户 {username}): {e}")
-             return jsonify({"error": f"处理历史记录时出错: {e}"}), 500
-
-
-    session_items = list(sessions.items())
-    # 按最后时间排序
     try:
-        session_items.sort(key=lambda item: datetime.strptime(item[1]['last_time'], "%Y-%m-%d %H:%M:%S"), reverse=True)
-    except ValueError as e:
-        logging.error(f"排序会话时时间格式转换失败 (用户 {username}): {e}. 返回未排序列表。")
+        user_sessions = get_user_sessions(username)
+    except sqlite3.Error as e:
+        logging.error(f"读取会话摘要时出错 (用户 {username}): {e}")
+        return jsonify({"error": f"读取历史记录时出错: {e}"}), 500
+
+    with _session_index_lock:
+        session_items = [
+            (session_id, {"last_time": entry["last_time"], "preview": entry["preview"], "message_count": entry["message_count"]})
+            for session_id, entry in user_sessions.items()
+        ]
+    # 时间戳格式为 "%Y-%m-%d %H:%M:%S"，字符串顺序即时间顺序，无需再解析
+    session_items.sort(key=lambda item: item[1]['last_time'], reverse=True)
 
     logging.info(f"为用户 {username} 返回 {len(session_items)} 个会话")
     return jsonify(session_items)
 
-# 加载特定会话内容 (**修改：** 增加用户验证)
+# --- 新增：会话分页加载 ---
+# 打开会话时只返回最近的若干轮，更早的消息通过 before=<cursor> 翻页获取。
+# 每页都走 (session_id, timestamp) 索引倒序读取固定条数，打开长会话与短会话的开销相同。
+SESSION_PAGE_SIZE = 50      # 默认每页的轮数
+SESSION_PAGE_MAX_SIZE = 500 # 单页允许的最大轮数
+
+def encode_history_cursor(timestamp, row_id):
+    """把 (timestamp, id) 编码为不透明的分页游标"""
+    return base64.urlsafe_b64encode(f"{timestamp}|{row_id}".encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor):
+    """解析分页游标，格式不正确时抛出 ValueError"""
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").rsplit("|", 1)
+        return timestamp, int(row_id)
+    except (UnicodeError, binascii.Error, ValueError) as e:
+        raise ValueError(f"无效的游标: {cursor}") from e
+
+def load_session_page(username, session_id, limit, before=None):
+    """倒序读取 before 之前的最多 limit 轮 (热数据不够时继续读归档)，返回 (按时间正序的行, 是否还有更早的消息)"""
+    sql = "SELECT id, timestamp, user_msg, ai_msg FROM chat_history WHERE session_id = ? AND username = ?"
+    params = [session_id, username]
+    if before:
+        timestamp, row_id = before
+        sql += " AND (timestamp < ? OR (timestamp = ? AND id < ?))"
+        params += [timestamp, timestamp, row_id]
+    sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit + 1) # 多读一条用于判断是否还有下一页
+    with observe_duration("chatapp_history_read_duration_seconds", "load_session"):
+        rows = get_history_db().execute(sql, params).fetchall()
+    if len(rows) <= limit:
+        # 热数据不够一页：更早的轮次可能已归档，从最旧的一条热数据 (或游标) 处接着往前读
+        oldest = (rows[-1][1], rows[-1][0]) if rows else before
+        rows += load_archived_session_rows(username, session_id, oldest, limit + 1 - len(rows))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+def stream_session_page(rows, has_more):
+    """以流的方式逐条输出 JSON，不在内存中拼出完整的响应体"""
+    yield '{"success": true, "messages": ['
+    for i, (row_id, timestamp, user_msg, ai_msg) in enumerate(rows):
+        prefix = "," if i else ""
+        yield prefix + json.dumps({"sender": "user", "text": user_msg, "timestamp": timestamp}, ensure_ascii=False)
+        yield "," + json.dumps({"sender": "ai", "text": ai_msg, "timestamp": timestamp}, ensure_ascii=False)
+    next_cursor = encode_history_cursor(rows[0][1], rows[0][0]) if has_more and rows else None
+    yield '], "has_more": ' + json.dumps(has_more) + ', "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+# 加载特定会话内容 (**修改：** 游标分页，最新的消息优先返回)
 @app.route('/api/load_session')
 def load_session_content():
-    global current_session # 声明我们要修改全局变量
     session_id = request.args.get('session')
     username = request.args.get('user') # **新增：** 获取用户名
+    before_cursor = request.args.get('before') # **新增：** 上一页返回的 next_cursor
 
     if not session_id or not username:
         logging.warning("加载会话请求缺少 session_id 或 username")
         return jsonify({"success": False, "error": "缺少 session ID 或用户名"}), 400
+    token, state = get_request_state(username)
+    if state is None:
+        return jsonify({"success": False, "error": "用户未登录或认证失败"}), 401
 
-    logging.info(f"用户 {username} 请求加载会话: {session_id}")
+    try:
+        limit = int(request.args.get('limit', SESSION_PAGE_SIZE))
+        before = decode_history_cursor(before_cursor) if before_cursor else None
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"分页参数无效: {e}"}), 400
+    limit = max(1, min(limit, SESSION_PAGE_MAX_SIZE))
 
-    messages = []
-    session_found_for_user = False # 标记是否找到了属于该用户的此会话记录
-    if os.path.exists(HISTORY_PATH):
+    logging.info(f"用户 {username} 请求加载会话: {session_id} (before={before_cursor}, limit={limit})")
+
+    try:
+        flush_history() # 确保刚发送的消息已写入
+        rows, has_more = load_session_page(username, session_id, limit, before)
+
+        if not rows and before is None:
+            owner = get_history_db().execute("""
+                SELECT username FROM chat_history WHERE session_id = ?
+                UNION ALL SELECT username FROM chat_archive_rows WHERE session_id = ? LIMIT 1""",
+                (session_id, session_id)).fetchone()
+            if owner:
+                # 找到了 session 但不属于此用户
+                logging.warning(f"用户 {username} 尝试加载不属于自己的会话 {session_id} (属于 {owner[0]})")
+            else:
+                logging.warning(f"用户 {username} 尝试加载的会话 {session_id} 不存在")
+            # 如果 session 存在但不属于该用户，或者根本找不到该 session，都返回错误
+            return jsonify({"success": False, "error": "无法加载该会话或会话不存在"}), 404 # 404 Not Found
+    except sqlite3.Error as e:
+        logging.error(f"加载会话 {session_id} (用户 {username}) 时读取数据库出错: {e}")
+        return jsonify({"success": False, "error": f"加载会话时出错: {e}"}), 500
+
+    if before is None:
+        # 打开会话 (第一页) 时切换该用户的当前会话 ID，翻页不改变
+        update_user_state(token, session_id=session_id)
+        logging.info(f"用户 {username} 成功加载会话 {session_id}，后端会话已切换")
+    return Response(stream_session_page(rows, has_more), mimetype='application/json')
+
+# --- 新增：聊天记录搜索 ---
+# 在 chat_search 索引中取该用户最近的命中记录 (最多 candidate_limit 条)，
+# 按 BM25 相关度乘以时间权重排序：越新的记录加权越多，半衰期后加权减半。
+SEARCH_MAX_RESULTS = 100  # 单次请求允许返回的最大条数
+SEARCH_SNIPPET_CHARS = 40 # 摘要中命中位置前后各保留的字符数
+
+def make_search_snippet(text, runs):
+    """截取第一个命中位置附近的文本；没有直接命中 (如全角/半角差异) 时取开头"""
+    lowered = text.lower()
+    positions = [pos for pos in (lowered.find(run) for run in runs) if pos >= 0]
+    pos = min(positions) if positions else 0
+    start = max(0, pos - SEARCH_SNIPPET_CHARS)
+    end = min(len(text), pos + SEARCH_SNIPPET_CHARS * (1 if positions else 2))
+    return ("..." if start > 0 else "") + text[start:end] + ("..." if end < len(text) else "")
+
+def rank_search_rows(username, rows, runs, limit, settings):
+    """
+    rows: (id, session_id, timestamp, user_msg, ai_msg, 相关度)，已归档的记录 user_msg/ai_msg 为 None。
+    先按综合得分排序取前 limit 条，再只为其中已归档的记录读取归档段。
+    """
+    now = datetime.now()
+    half_life = max(settings["recency_half_life_days"], 0.001)
+    scored = []
+    for row in rows:
         try:
-            with open(HISTORY_PATH, "r", encoding="utf-8") as f:
-                reader = csv.reader(f)
-                try:
-                    next(reader) # 跳过表头
-                except StopIteration:
-                    pass # 文件为空
+            age_days = max(0.0, (now - datetime.strptime(row[2], "%Y-%m-%d %H:%M:%S")).total_seconds() / 86400)
+        except ValueError:
+            age_days = 0.0
+        scored.append((row[5] * (1 + settings["recency_weight"] * 0.5 ** (age_days / half_life)), row))
+    scored.sort(key=lambda item: (item[0], item[1][2]), reverse=True)
+    scored = scored[:limit]
+
+    archived_refs = {}
+    for _, (row_id, session_id, timestamp, user_msg, _, _) in scored:
+        if user_msg is None:
+            archived_refs.setdefault((username, session_id, timestamp[:7]), set()).add(row_id)
+    archived = read_archived_turns(archived_refs) if archived_refs else {}
+
+    results = []
+    for score, (row_id, session_id, timestamp, user_msg, ai_msg, _) in scored:
+        if user_msg is None:
+            if row_id not in archived:
+                continue # 归档段缺失或损坏
+            user_msg, ai_msg = archived[row_id]
+        results.append({
+            "session_id": session_id,
+            "timestamp": timestamp,
+            "user_msg": make_search_snippet(user_msg, runs),
+            "ai_msg": make_search_snippet(ai_msg, runs),
+            "score": round(score, 4),
+        })
+    return results
+
+def search_history(username, query, limit):
+    """搜索该用户的聊天记录，返回 (结果列表, 索引是否已补建完整)"""
+    settings = get_search_settings()
+    runs = search_text_runs(query)
+    if not runs:
+        return [], True
+    conn = get_history_db()
+    if _search_available:
+        # 子查询按 rowid 倒序流式取命中记录，只为这 candidate_limit 条计算 bm25
+        # 命中的记录可能在热数据中，也可能已经归档 (此时内容稍后从归档段读取)
+        rows = conn.execute("""
+            SELECT s.rowid, COALESCE(h.session_id, a.session_id), COALESCE(h.timestamp, a.timestamp),
+                   h.user_msg, h.ai_msg, -s.score
+            FROM (SELECT rowid, bm25(chat_search, 0.0, 1.0) AS score FROM chat_search
+                  WHERE chat_search MATCH ? ORDER BY rowid DESC LIMIT ?) AS s
+            LEFT JOIN chat_history h ON h.id = s.rowid
+            LEFT JOIN chat_archive_rows a ON a.id = s.rowid
+            WHERE COALESCE(h.username, a.username) = ?""",
+            (build_search_query(username, query), settings["candidate_limit"], username)).fetchall()
+        return rank_search_rows(username, rows, runs, limit, settings), is_search_index_complete()
+
+    # 没有 FTS5：在该用户最近的热数据中逐条匹配 (不含归档)，相关度都记为 1，只按时间排序
+    sql = "SELECT id, session_id, timestamp, user_msg, ai_msg, 1.0 FROM chat_history WHERE username = ?"
+    params = [username]
+    for run in runs:
+        sql += " AND instr(lower(user_msg || ' ' || ai_msg), ?) > 0"
+        params.append(run)
+    sql += " ORDER BY timestamp DESC LIMIT ?"
+    params.append(settings["candidate_limit"])
+    return rank_search_rows(username, conn.execute(sql, params).fetchall(), runs, limit, settings), True
+
+@app.route('/api/search')
+def search_chats():
+    username = request.args.get('user')
+    query = (request.args.get('q') or '').strip()
+    if not username or not query:
+        return jsonify({"success": False, "error": "缺少用户名或搜索内容"}), 400
+    if get_request_state(username)[1] is None:
+        return jsonify({"success": False, "error": "用户未登录或认证失败"}), 401
+    try:
+        limit = int(request.args.get('limit', get_search_settings()["max_results"]))
+    except ValueError:
+        return jsonify({"success": False, "error": "limit 参数无效"}), 400
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
 
-                for row in reader:
-                    # **修改：** 检查列数、session_id 和 username 匹配
-                    if len(row) == 5 and row[0] == session_id:
-                         if row[1] == username:
-                             session_found_for_user = True
-                             messages.append({"sender": "user", "text": row[2]})
-                             messages.append({"sender": "ai", "text": row[3]})
-                         else:
-                             # 找到了 session 但不属于此用户，记录但不添加到 messages
-                              logging.warning(f"用户 {username} 尝试加载不属于自己的会话 {session_id} (属于 {row[1]})")
-                              # 可以选择立即返回错误，或继续检查完文件后判断
-
-            if not session_found_for_user:
-                 logging.warning(f"用户 {username} 尝试加载的会话 {session_id} 不存在或不属于该用户")
-                 # 如果 session 存在但不属于该用户，或者根本找不到该 session，都返回错误
-                 return jsonify({"success": False, "error": "无法加载该会话或会话不存在"}), 404 # 404 Not Found
-
-
-            # 如果找到了属于该用户的会话记录
-            current_session = session_id # 切换后端的当前会话 ID
-            logging.info(f"用户 {username} 成功加载会话 {session_id}，后端会话已切换")
-            return jsonify({"success": True, "messages": messages})
+    try:
+        flush_history() # 确保刚发送的消息也能搜到
+        with observe_duration("chatapp_history_read_duration_seconds", "search"):
+            results, complete = search_history(username, query, limit)
+    except sqlite3.Error as e:
+        logging.error(f"搜索聊天记录时出错 (用户 {username}): {e}")
+        return jsonify({"success": False, "error": f"搜索时出错: {e}"}), 500
+
+    logging.info(f"用户 {username} 搜索 '{query[:30]}'，返回 {len(results)} 条结果")
+    return jsonify({"success": True, "results": results, "index_complete": complete})
+
+# --- 新增：simple-one-api 进程管理 (蓝绿切换) ---
+# 重启时先在另一个端口启动新进程，确认 /v1/models 可以响应后再切换 BASE_URL，
+# 旧进程等在途请求排空后才停止，切换期间的 /api/send 不会失败。
+SIDECAR_READY_TIMEOUT = 15   # 等待新进程就绪的最长时间 (秒)
+SIDECAR_DRAIN_TIMEOUT = 120  # 等待旧进程在途请求结束的最长时间 (秒)
+_sidecar_switch_lock = threading.Lock() # 同一时间只允许一次切换
+_draining_sidecars = {} # port -> 正在排空的旧进程
+_upstream_ready = threading.Event() # 当前 BASE_URL 上的 simple-one-api 已确认可以响应
+_sidecar_starting = threading.Event() # 启动线程仍在等待 simple-one-api 就绪
+
+def sidecar_base_url(port):
+    return f"http://localhost:{port}/v1"
+
+def is_port_in_use(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(0.5)
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+def prepare_sidecar_config(port):
+    """基于活动 config.json 生成监听指定端口的配置文件，返回文件名 (相对 API_FOLDER_PATH)"""
+    # 检查活动配置文件是否存在，如果不存在则尝试应用默认配置
+    if not os.path.exists(CONFIG_ACTIVE_PATH):
+         logging.warning(f"活动配置文件 {CONFIG_ACTIVE_PATH} 不存在。尝试应用默认配置。")
+         if not apply_default_config():
+             logging.error("无法应用默认配置。API 服务无法启动。")
+             return None
+    try:
+        with open(CONFIG_ACTIVE_PATH, 'r', encoding='utf-8') as f:
+            port_config = json.load(f)
+        port_config["server_port"] = f":{port}"
+        config_name = f"config_{port}.json"
+        write_json_atomic(os.path.join(API_FOLDER_PATH, config_name), port_config, indent=2)
+        return config_name
+    except (json.JSONDecodeError, OSError) as e:
+        logging.error(f"生成端口 {port} 的 simple-one-api 配置失败: {e}")
+        return None
 
-        except IOError as e:
-            logging.error(f"加载会话 {session_id} (用户 {username}) 时读取文件出错: {e}")
-            return jsonify({"success": False, "error": f"加载会话时出错: {e}"}), 500
-        except Exception as e:
-             logging.error(f"加载会话 {session_id} (用户 {username}) 时发生未知错误: {e}")
-             return jsonify({"success": False, "error": f"加载会话时出错: {e}"}), 500
-    else:
-        # 历史文件不存在
-        logging.warning(f"历史文件 {HISTORY_PATH} 不存在，无法加载会话 {session_id}")
-        return jsonify({"success": False, "error": "历史记录文件不存在"}), 404
+def probe_upstream(base_url, timeout=1.0):
+    """GET {base_url}/models 返回 200 即认为上游可以处理请求"""
+    import httpx
+    try:
+        return httpx.get(f"{base_url}/models", headers={"Authorization": f"Bearer {SIDECAR_API_KEY}"},
+                         timeout=timeout).status_code == 200
+    except httpx.HTTPError:
+        return False # 尚未开始监听
+
+def launch_sidecar(port):
+    """在指定端口启动一个 simple-one-api 进程，失败返回 None"""
+    exe_path = os.path.join(API_FOLDER_PATH, "simple-one-api.exe")
+    if not os.path.exists(exe_path):
+        logging.warning(f"simple-one-api.exe 未找到于: {exe_path}")
+        return None
+
+    config_name = prepare_sidecar_config(port)
+    if not config_name:
+        return None
+
+    import subprocess
+    logging.info(f"尝试在目录 {API_FOLDER_PATH} 启动 simple-one-api.exe (端口 {port}，读取 {config_name})")
+    try:
+        # 使用 cwd 指定工作目录，creationflags 避免 Windows 弹窗；第一个参数为配置文件名
+        process = subprocess.Popen([exe_path, config_name], cwd=API_FOLDER_PATH, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        logging.info(f"simple-one-api 进程已启动 (PID: {process.pid}, 端口: {port})")
+        return process
+    except Exception as e:
+        logging.error(f"启动 simple-one-api.exe 失败: {e}")
+        return None
+
+def wait_sidecar_ready(process, port, timeout=SIDECAR_READY_TIMEOUT):
+    """轮询 /v1/models 直到新进程可以响应；进程提前退出或超时返回 False"""
+    deadline = time.monotonic() + timeout
+    base_url = sidecar_base_url(port)
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            logging.error(f"simple-one-api 进程 (端口 {port}) 启动后退出，返回码: {process.returncode}")
+            return False
+        if probe_upstream(base_url):
+            return True
+        time.sleep(0.2)
+    logging.error(f"simple-one-api 进程 (端口 {port}) 在 {timeout} 秒内未就绪")
+    return False
+
+def stop_sidecar(process):
+    """终止一个 simple-one-api 进程：先友好终止，超时后强制结束"""
+    if process is None:
+        return
+    import subprocess
+    try:
+        # 检查进程是否还在运行
+        if process.poll() is None:
+             process.terminate() # 尝试友好终止
+             process.wait(timeout=5) # 等待最多5秒
+             logging.info(f"simple-one-api 进程 (PID: {process.pid}) 已终止。")
+        else:
+             logging.info(f"simple-one-api 进程 (PID: {process.pid}) 已经结束，无需终止。")
+    except subprocess.TimeoutExpired:
+        logging.warning("simple-one-api 进程未在超时内终止，强制结束...")
+        if process.poll() is None: # 再次检查是否需要kill
+            process.kill() # 强制终止
+            try:
+                process.wait(timeout=2) # 等待强制结束后确认
+            except: pass # 忽略等待错误
+        logging.info("simple-one-api 进程已被强制结束。")
+    except Exception as e:
+        logging.warning(f"终止 simple-one-api 时发生错误: {e}")
+
+def drain_and_stop_sidecar(process, port, timeout=SIDECAR_DRAIN_TIMEOUT):
+    """等待指向旧进程的在途请求结束 (最多 timeout 秒) 后停止它"""
+    base_url = sidecar_base_url(port)
+    deadline = time.monotonic() + timeout
+    while get_inflight_count(base_url) > 0 and time.monotonic() < deadline:
+        time.sleep(0.2)
+    remaining = get_inflight_count(base_url)
+    if remaining:
+        logging.warning(f"旧 simple-one-api 进程 (端口 {port}) 排空超时，仍有 {remaining} 个请求未结束")
+    stop_sidecar(process)
+    with _sidecar_switch_lock:
+        if _draining_sidecars.get(port) is process:
+            del _draining_sidecars[port]
+
+def pick_standby_port():
+    """选择一个既不是当前端口、也没有旧进程在排空的端口"""
+    for port in SIDECAR_PORTS:
+        if port != api_port and port not in _draining_sidecars and not is_port_in_use(port):
+            return port
+    return None
 
-# 启动 simple-one-api (辅助函数，不变)
+# 启动 simple-one-api (**修改：** 在 api_port 上启动并同步 BASE_URL)
 def start_api_server():
-    global api_process # 确保修改全局变量
+    global api_process, BASE_URL # 确保修改全局变量
 
     # 先尝试终止现有进程（如果存在且仍在运行）
     if api_process and api_process.poll() is None: # poll() 返回 None 表示进程仍在运行
         logging.warning("start_api_server 被调用，但似乎已有进程在运行。将尝试终止现有进程。")
-        try:
-            api_process.terminate()
-            api_process.wait(timeout=5)
-        except Exception as e:
-            logging.warning(f"尝试终止现有进程时出错: {e}")
-            try:
-                 api_process.kill() # 强制结束
-                 api_process.wait(timeout=2)
-            except: pass # 忽略错误
-        api_process = None
-
-    exe_path = os.path.join(API_FOLDER_PATH, "simple-one-api.exe")
-    active_config_path = CONFIG_ACTIVE_PATH # 使用活动配置路径
-
-    # 检查活动配置文件是否存在，如果不存在则尝试应用默认配置
-    if not os.path.exists(active_config_path):
-         logging.warning(f"活动配置文件 {active_config_path} 不存在。尝试应用默认配置。")
-         if not apply_default_config():
-             logging.error("无法应用默认配置。API 服务无法启动。")
-             return # 无法启动
-
-    if os.path.exists(exe_path):
-        logging.info(f"尝试在目录 {API_FOLDER_PATH} 启动 simple-one-api.exe (读取 {active_config_path})")
-        try:
-            # 使用 cwd 指定工作目录，creationflags 避免 Windows 弹窗
-            process = subprocess.Popen([exe_path], cwd=API_FOLDER_PATH, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
-            logging.info(f"simple-one-api 进程已启动 (PID: {process.pid})")
-            api_process = process # <-- 将新进程赋给全局变量
-        except Exception as e:
-            logging.error(f"启动 simple-one-api.exe 失败: {e}")
-            api_process = None
-    else:
-        logging.warning(f"simple-one-api.exe 未找到于: {exe_path}")
-        api_process = None
+        stop_sidecar(api_process)
+    _upstream_ready.clear() # 新进程就绪前 /api/send 会等待 (见 ensure_upstream_ready)
+    api_process = launch_sidecar(api_port)
+    BASE_URL = sidecar_base_url(api_port)
 
 def restart_api_server():
-    """停止并重新启动 simple-one-api 服务"""
+    """蓝绿切换重启 simple-one-api：新进程就绪后再切换，旧进程排空在途请求后停止"""
+    global api_process, api_port, BASE_URL
+    start = time.perf_counter()
+    with _sidecar_switch_lock:
+        old_process, old_port = api_process, api_port
+        if old_process is None or old_process.poll() is not None:
+            # 没有可用的旧进程，也就没有需要保持的流量，直接原地启动
+            logging.info("当前没有运行中的 simple-one-api 进程，直接启动...")
+            start_api_server()
+            reset_openai_client()
+            # 这种情况下从开始到新进程就绪的这段时间都没有可用的服务
+            ready = api_process is not None and wait_sidecar_ready(api_process, api_port)
+            if ready:
+                _upstream_ready.set()
+            inc_counter("chatapp_sidecar_restarts_total", "cold_start" if ready else "failed")
+            observe("chatapp_sidecar_downtime_seconds", time.perf_counter() - start)
+            return
+
+        new_port = pick_standby_port()
+        if new_port is None:
+            logging.error(f"没有可用的备用端口 (候选: {SIDECAR_PORTS})，放弃本次重启，继续使用旧进程")
+            inc_counter("chatapp_sidecar_restarts_total", "failed")
+            return
+
+        logging.info(f"正在端口 {new_port} 启动新的 simple-one-api 进程 (当前端口 {old_port})...")
+        new_process = launch_sidecar(new_port)
+        if new_process is None:
+            inc_counter("chatapp_sidecar_restarts_total", "failed")
+            return
+        if not wait_sidecar_ready(new_process, new_port):
+            logging.error("新 simple-one-api 进程未就绪，保留旧进程继续服务")
+            stop_sidecar(new_process)
+            inc_counter("chatapp_sidecar_restarts_total", "failed")
+            return
+
+        # 切换：之后的新请求都发往新进程，已发出的请求继续由旧进程处理
+        api_process, api_port = new_process, new_port
+        BASE_URL = sidecar_base_url(new_port)
+        reset_openai_client()
+        _draining_sidecars[old_port] = old_process
+        logging.info(f"simple-one-api 已切换到端口 {new_port}，旧进程 (端口 {old_port}) 排空后停止")
+        inc_counter("chatapp_sidecar_restarts_total", "switched")
+        observe("chatapp_sidecar_restart_duration_seconds", time.perf_counter() - start)
+        observe("chatapp_sidecar_downtime_seconds", 0.0) # 旧进程一直在服务，没有中断
+
+    threading.Thread(target=drain_and_stop_sidecar, args=(old_process, old_port), daemon=True).start()
+
+def stop_all_sidecars():
+    """程序退出时停止当前进程和所有正在排空的旧进程"""
     global api_process
-    if api_process:
-        logging.info(f"尝试终止现有的 simple-one-api 进程 (PID: {api_process.pid})")
-        try:
-            # 检查进程是否还在运行
-            if api_process.poll() is None:
-                 api_process.terminate() # 尝试友好终止
-                 api_process.wait(timeout=5) # 等待最多5秒
-                 logging.info("simple-one-api 进程已终止。")
+    for port, process in list(_draining_sidecars.items()):
+        stop_sidecar(process)
+    if api_process and api_process.poll() is None: # 检查进程是否存在且在运行
+        logging.info("正在尝试终止 simple-one-api 进程...")
+        stop_sidecar(api_process)
+    api_process = None
+
+# --- 新增：快速启动 (延迟导入 + 并行启动 + 就绪检查) ---
+# 以前导入本模块时就完成 openai 导入、CSV 导入、摘要表构建，之后才串行启动 simple-one-api，
+# 窗口要等几秒才出现。现在：
+#   - openai / httpx / subprocess 在第一次使用时才导入 (openai 在后台线程中预热)
+#   - simple-one-api 在后台线程中启动，与数据文件初始化、webview 创建同时进行
+#   - /api/send 等接口在 simple-one-api 就绪前最多等待 UPSTREAM_READY_WAIT 秒，仍未就绪返回 503
+#   - 各阶段耗时记录在日志、/api/startup_stats 和 /metrics 中
+UPSTREAM_READY_WAIT = 10 # 请求等待 simple-one-api 就绪的最长时间 (秒)
+_startup_phases = OrderedDict() # 阶段名 -> 耗时 (秒)，按开始顺序
+_startup_lock = threading.Lock()
+_app_initialized = False
+
+register_metric("chatapp_startup_phase_seconds", "gauge", "Duration of each startup phase", ("phase",))
+
+@contextmanager
+def startup_phase(name):
+    """用法：with startup_phase("files"): ...，记录该阶段耗时"""
+    start = time.perf_counter()
+    _startup_phases.setdefault(name, None) # 先占位，保持开始顺序
+    try:
+        yield
+    finally:
+        record_startup_phase(name, time.perf_counter() - start)
+
+def record_startup_phase(name, seconds):
+    _startup_phases[name] = seconds
+    set_gauge("chatapp_startup_phase_seconds", round(seconds, 6), name)
+    logging.info(f"启动阶段 {name} 耗时 {seconds:.3f} 秒")
+
+def get_startup_stats():
+    return {"phases": {name: round(seconds, 3) for name, seconds in _startup_phases.items() if seconds is not None},
+            "upstream_ready": _upstream_ready.is_set(), "sidecar_starting": _sidecar_starting.is_set()}
+
+def initialize_app():
+    """初始化数据文件和后台线程 (只执行一次)；run_startup 或第一个请求会调用它"""
+    global _app_initialized
+    if _app_initialized:
+        return
+    with _startup_lock:
+        if _app_initialized:
+            return
+        with startup_phase("files"):
+            initialize_files()
+        _app_initialized = True
+
+@app.before_request
+def _ensure_app_initialized():
+    initialize_app() # 没有经过 run_startup 的运行方式 (如 flask run、测试) 在第一个请求时初始化
+
+def start_sidecar_in_background():
+    """同步活动配置、启动 simple-one-api 并等待就绪 (在后台线程中运行)"""
+    try:
+        with startup_phase("sidecar"):
+            # **修改：** 活动配置始终与模板一致 (用户密钥改为按请求注入，不再写入 config.json)，
+            # 同时清掉旧版本遗留在 config.json 中的某个用户的密钥
+            if apply_default_config():
+                logging.info(f"活动配置文件 {CONFIG_ACTIVE_PATH} 已与模板同步。")
             else:
-                 logging.info("simple-one-api 进程已经结束，无需终止。")
-        except subprocess.TimeoutExpired:
-            logging.warning("simple-one-api 进程未在超时内终止，强制结束...")
-            if api_process.poll() is None: # 再次检查是否需要kill
-                api_process.kill() # 强制终止
-                try:
-                    api_process.wait(timeout=2) # 等待强制结束后确认
-                except: pass # 忽略等待错误
-            logging.info("simple-one-api 进程已被强制结束。")
-        except Exception as e:
-            logging.warning(f"终止 simple-one-api 时发生错误: {e}")
-        finally:
-             api_process = None # 清除旧的进程对象引用
+                logging.error(f"无法创建活动配置文件 {CONFIG_ACTIVE_PATH}！API 服务可能无法启动。")
+            with _sidecar_switch_lock:
+                start_api_server()
+                process, port = api_process, api_port
+            if process is not None and wait_sidecar_ready(process, port):
+                _upstream_ready.set()
+                logging.info(f"simple-one-api 已就绪 (端口 {port})")
+    finally:
+        _sidecar_starting.clear()
+
+def prewarm_openai_client():
+    """在后台导入 openai 并创建共享客户端，第一个请求不必再等"""
+    with startup_phase("openai_import"):
+        get_openai_client()
+
+def run_startup(launch_sidecar=True):
+    """
+    启动流程：simple-one-api 和 openai 预热放到后台线程，主线程初始化数据文件后立即返回，
+    调用方可以马上创建窗口 / 开始监听。launch_sidecar=False 时不启动 simple-one-api，只检查当前 BASE_URL。
+    """
+    if launch_sidecar:
+        _sidecar_starting.set()
+        threading.Thread(target=start_sidecar_in_background, name="sidecar-startup", daemon=True).start()
+    elif probe_upstream(BASE_URL):
+        _upstream_ready.set()
+    threading.Thread(target=prewarm_openai_client, name="openai-prewarm", daemon=True).start()
+    initialize_app()
+    record_startup_phase("ready_to_serve", time.perf_counter() - _MODULE_LOAD_START)
+
+def wait_upstream_ready(timeout=UPSTREAM_READY_WAIT):
+    """等待 simple-one-api 就绪；启动线程已结束 (外部启动或启动失败) 时直接探测一次"""
+    if _upstream_ready.is_set():
+        return True
+    if _sidecar_starting.is_set() and _upstream_ready.wait(timeout):
+        return True
+    if not _sidecar_starting.is_set() and probe_upstream(BASE_URL):
+        _upstream_ready.set()
+        return True
+    return False
+
+def ensure_upstream_ready(state):
+    """发送消息前的就绪检查：直连服务商的请求不经过 simple-one-api，不需要等待"""
+    if _upstream_ready.is_set():
+        return True
+    if get_direct_route(state["username"], resolve_model_name(state["api"])):
+        return True
+    return wait_upstream_ready()
+
+def upstream_not_ready_response():
+    logging.warning("simple-one-api 尚未就绪，拒绝发送请求")
+    response = jsonify({'success': False, 'error': 'AI 服务正在启动，请稍后重试'})
+    response.headers["Retry-After"] = "2"
+    return response, 503
 
-    logging.info("正在重新启动 simple-one-api 服务...")
-    start_api_server() # 启动新的实例
+@app.route('/api/startup_stats', methods=['GET'])
+def startup_stats():
+    """查看启动各阶段耗时和 simple-one-api 就绪状态"""
+    return jsonify(get_startup_stats())
 
 # 获取模型列表 (修改 require_key 逻辑)
 @app.route('/api/get_models', methods=['GET'])
 def get_models():
     username = request.args.get('user')
-    if not username or username != current_logged_in_user:
+    if not username or get_request_state(username)[1] is None:
         return jsonify({"error": "用户未登录或认证失败"}), 401
 
     models_structure = []
     try:
-        # 1. 读取 Mconfig.json 获取公司和模型名称
-        if not os.path.exists(MCONFIG_PATH):
-            logging.error(f"模型元数据文件 {MCONFIG_PATH} 未找到！")
-            return jsonify({"error": "服务器模型配置缺失"}), 500
-        with open(MCONFIG_PATH, 'r', encoding='utf-8') as f:
-            mconfig = json.load(f)
-
-        # 2. 读取用户密钥数据
-        all_user_keys = load_user_keys()
-        user_specific_keys = all_user_keys.get(username, {}) # 获取当前用户的密钥
-         # +++ 新增：读取 config_template.json 的内容 +++
-        config_template_data = None
-        if not os.path.exists(CONFIG_TEMPLATE_PATH):
-             logging.warning(f"配置模板文件 {CONFIG_TEMPLATE_PATH} 未找到！无法检查默认 Key。")
-             # 即使模板不存在，也应该继续执行，只是无法判断模板是否有 Key
-        else:
-             try:
-                 with open(CONFIG_TEMPLATE_PATH, 'r', encoding='utf-8') as f_template:
-                     config_template_data = json.load(f_template)
-             except (json.JSONDecodeError, IOError) as e:
-                 logging.error(f"读取配置模板 {CONFIG_TEMPLATE_PATH} 失败: {e}。无法检查默认 Key。")
-                 # 出错时也继续，当作模板没有 Key 处理
+        # 1. 模型索引 (内含 Mconfig.json 的公司和模型名称，以及模板中的默认 Key)
+        model_index = get_model_index()
+        models_info = model_index["models"]
+
+        # 2. 读取用户密钥数据 (内存)
+        user_specific_keys = get_user_keys(username) # 获取当前用户的密钥
 
         # 3. 构建返回给前端的数据结构
-        for company_name, company_data in mconfig.items():
+        for company_name, company_data in model_index["mconfig"].items():
             company_models = []
             model_names_in_company = company_data.get("models", [])
 
@@ -725,14 +4172,11 @@ def get_models():
                 # **修改判断逻辑:** requires_key is True if user hasn't provided a non-empty key for this model
                 user_has_key = model_name in user_specific_keys and user_specific_keys[model_name]
     
-                # b. ++ 新增：检查 config_template.json 中是否有非空默认 Key ++
-                template_default_key = get_default_key_from_template(model_name, config_template_data)
-                template_has_key = bool(template_default_key) # 如果找到了非空 Key，则为 True
+                # b. 检查 config_template.json 中是否有非空默认 Key (来自索引)
+                template_has_key = bool(models_info[model_name]["default_key"])
 
-                # c. ++ 修改：重新计算 requires_key ++
-                # 只有当用户没存 Key 且模板也没预设 Key 时，才为 True
+                # c. 只有当用户没存 Key 且模板也没预设 Key 时，才为 True
                 requires_key_now = (not user_has_key) and (not template_has_key)
-                # --- 判断逻辑修改结束 ---
 
                 # 记录日志，方便调试
                 logging.debug(f"模型: {model_name}, 用户有Key: {user_has_key}, 模板有Key: {template_has_key}, 最终需要Key: {requires_key_now}")
@@ -749,8 +4193,11 @@ def get_models():
 
         return jsonify(models_structure)
 
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logging.error(f"读取模型或用户密钥配置文件失败: {e}")
+    except FileNotFoundError as e:
+        logging.error(f"模型元数据文件 {MCONFIG_PATH} 未找到！{e}")
+        return jsonify({"error": "服务器模型配置缺失"}), 500
+    except json.JSONDecodeError as e:
+        logging.error(f"读取模型配置文件失败: {e}")
         return jsonify({"error": "读取配置时出错"}), 500
     except Exception as e:
          logging.exception(f"构建模型列表时发生未知错误: {e}") # Use exception for stacktrace
@@ -764,7 +4211,8 @@ def save_api_key():
     model_name = data.get('model_name')
     api_key = data.get('api_key') # 注意：前端传过来时可能是空字符串
 
-    if not username or username != current_logged_in_user:
+    token, state = get_request_state(username)
+    if not username or state is None:
         return jsonify({"success": False, "error": "用户未登录或认证失败"}), 401
     if not model_name: # API Key 可以是空字符串，表示清除
         return jsonify({"success": False, "error": "缺少模型名称"}), 400
@@ -773,68 +4221,20 @@ def save_api_key():
     logging.info(f"用户 {username} 正在为模型 {model_name} 保存 API Key (长度: {len(api_key)})...")
 
     try:
-        # 1. 更新 user_api_keys.json
-        all_user_keys = load_user_keys()
-        if username not in all_user_keys:
-            all_user_keys[username] = {}
-        all_user_keys[username][model_name] = api_key # 保存 key (可能是空字符串)
-        save_user_keys(all_user_keys)
-        logging.info(f"用户 {username} 的模型 {model_name} 的密钥已更新到 {USER_KEYS_PATH}。")
-
-        # 2. 更新当前活动的 config.json
-        # 不需要从模板重新合并，直接修改当前活动的即可
-        try:
-            with open(CONFIG_ACTIVE_PATH, 'r', encoding='utf-8') as f:
-                current_active_config = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError, IOError) as e:
-             logging.error(f"读取活动配置文件 {CONFIG_ACTIVE_PATH} 以更新密钥时失败: {e}")
-             # 理论上活动配置文件应该存在，如果不存在则服务有问题
-             return jsonify({"success": False, "error": "无法读取活动配置以应用新密钥"}), 500
-
-        # 查找并更新活动配置中的密钥
-        found_and_updated = False
-        key_to_set = api_key if api_key else "xxx" # 如果用户保存空key，在config.json中写回占位符 "xxx"
-        if 'services' in current_active_config:
-            for service_type, service_list in current_active_config['services'].items():
-                for i, service_instance in enumerate(service_list): # Need index to modify in place
-                    if model_name in service_instance.get("models", []):
-                        if "credentials" not in current_active_config['services'][service_type][i]:
-                            current_active_config['services'][service_type][i]["credentials"] = {}
-                        current_active_config['services'][service_type][i]["credentials"]["api_key"] = key_to_set
-                        found_and_updated = True
-                        logging.debug(f"在活动配置中更新了模型 {model_name} 的 Key。")
-                        break # 假设一个服务实例共享一个 key
-                if found_and_updated:
-                    break
-
-        if not found_and_updated:
-            logging.error(f"尝试更新活动配置 {CONFIG_ACTIVE_PATH} 时未找到模型 {model_name}。配置可能已损坏或与 Mconfig 不一致。")
-            return jsonify({"success": False, "error": f"配置错误：无法在活动配置中定位模型 '{model_name}'。"}), 500
-
-        # 写回更新后的活动配置
-        try:
-            with open(CONFIG_ACTIVE_PATH, 'w', encoding='utf-8') as f:
-                json.dump(current_active_config, f, indent=2, ensure_ascii=False)
-            logging.info(f"活动配置文件 {CONFIG_ACTIVE_PATH} 已更新。")
-        except IOError as e:
-            logging.error(f"保存更新后的活动配置文件 {CONFIG_ACTIVE_PATH} 失败: {e}")
-            return jsonify({"success": False, "error": "保存配置更新失败"}), 500
-
-        # 3. 重启 API 服务
-        logging.info("准备重启 simple-one-api 服务以应用更改...")
-        restart_api_server()
+        # 1. 更新内存中的用户密钥 (O(1))，后台写回 user_api_keys.json
+        # **修改：** 不再改写活动 config.json，也不再重启 simple-one-api；下一次调用即使用新 key
+        set_user_key(username, model_name, api_key) # 保存 key (可能是空字符串)
+        logging.info(f"用户 {username} 的模型 {model_name} 的密钥已更新。")
+        if api_key and not get_provider_base_url(model_name):
+            logging.warning(f"模型 {model_name} 不是 OpenAI 兼容服务，调用时无法注入用户密钥，将使用默认配置。")
 
         # 4. （可选）自动切换到该模型 
         if api_key: # 只有在提供了有效 key 时才自动切换
-             global current_api
-             found_api_identifier = None
-             for api_id, mapped_model in MODEL_MAPPING.items():
-                  if mapped_model == model_name:
-                      found_api_identifier = api_id
-                      break
+             model_info = get_model_info(model_name)
+             found_api_identifier = model_info["api_identifier"] if model_info else None
              if found_api_identifier:
-                  current_api = found_api_identifier
-                  logging.info(f"API Key 保存成功，后端当前 API 自动切换为: {current_api} (模型: {model_name})")
+                  update_user_state(token, api=found_api_identifier)
+                  logging.info(f"API Key 保存成功，用户 {username} 的当前 API 自动切换为: {found_api_identifier} (模型: {model_name})")
              else:
                   logging.warning(f"保存 Key 后尝试自动切换，但未在 MODEL_MAPPING 中找到模型 {model_name} 对应的 API 标识符。")
 
@@ -847,58 +4247,46 @@ def save_api_key():
 # 选择模型 (仅切换后端状态)
 @app.route('/api/select_model', methods=['POST'])
 def select_model():
-    global current_api # 只需要修改 current_api
     data = request.json
     username = data.get('username')
     model_name = data.get('model_name')
 
-    if not username or username != current_logged_in_user:
+    token, state = get_request_state(username) # **修改：** 只修改该用户自己的模型选择
+    if not username or state is None:
         return jsonify({"success": False, "error": "用户未登录或认证失败"}), 401
     if not model_name:
         return jsonify({"success": False, "error": "缺少模型名称"}), 400
 
-    # 在 MODEL_MAPPING 中查找与 model_name 对应的 api 标识符
-    found_api_identifier = None
-    for api_identifier, mapped_model_name in MODEL_MAPPING.items():
-        if mapped_model_name == model_name:
-            found_api_identifier = api_identifier
-            break
+    # 在模型索引中查找与 model_name 对应的 api 标识符
+    try:
+        model_info = get_model_info(model_name)
+    except Exception as e:
+        logging.error(f"检查模型映射时出错: {e}")
+        return jsonify({"success": False, "error": "检查模型有效性时出错"}), 500
+    found_api_identifier = model_info["api_identifier"] if model_info else None
 
     if found_api_identifier:
         # 检查用户是否已为此模型提供 Key
-        all_user_keys = load_user_keys()
-        user_keys = all_user_keys.get(username, {})
-        if model_name not in user_keys or not user_keys[model_name]:
+        if not get_user_key(username, model_name):
              # 用户选择了模型，但尚未提供 key (理论上前端不应调用此接口，除非requires_key=false)
              logging.warning(f"用户 {username} 尝试选择模型 {model_name} 但尚未提供有效 Key。")
              # 允许切换，但前端应该阻止无 Key 调用
-             # 或者返回错误？ return jsonify({"success": False, "error": f"模型 '{model_name}' 需要 API Key"}), 400
              # 决定允许切换，由发送消息时 ai_call 依赖的配置决定是否能成功
              pass # 允许切换，但后续调用可能失败
 
-        current_api = found_api_identifier # 更新全局状态
-        logging.info(f"用户 {username} 选择模型 {model_name}，后端 API 标识切换为: {current_api}")
-        return jsonify({"success": True, "selected_api": current_api})
+        update_user_state(token, api=found_api_identifier) # 更新该用户的状态
+        logging.info(f"用户 {username} 选择模型 {model_name}，API 标识切换为: {found_api_identifier}")
+        return jsonify({"success": True, "selected_api": found_api_identifier})
     else:
         logging.warning(f"用户 {username} 尝试选择未映射的模型: {model_name}")
         # 检查 Mconfig.json 是否包含该模型
-        try:
-            # 修正缩进
-            with open(MCONFIG_PATH, 'r', encoding='utf-8') as f:
-                mconfig = json.load(f)
-            model_exists_in_mconfig = any(model_name in company_data.get("models", []) for company_data in mconfig.values())
-            if model_exists_in_mconfig:
-                # 模型在 Mconfig 中，但不在 MODEL_MAPPING 里，这是后端配置问题
-                logging.error(f"模型 {model_name} 存在于 Mconfig.json 但未在 chatapp_new.py 的 MODEL_MAPPING 中定义！")
-                return jsonify({"success": False, "error": f"服务器内部配置错误：模型 '{model_name}' 无法被后端处理。"}), 500
-            else:
-                # 模型根本没定义
-                return jsonify({"success": False, "error": f"无效的模型名称: {model_name}"}), 400
-        except Exception as e:
-            # 修正缩进
-            logging.error(f"检查模型映射时出错: {e}")
-            return jsonify({"success": False, "error": "检查模型有效性时出错"}), 500
-
+        if model_info and model_info["company"]:
+            # 模型在 Mconfig 中，但不在 MODEL_MAPPING 里，这是后端配置问题
+            logging.error(f"模型 {model_name} 存在于 Mconfig.json 但未在 chatapp_new.py 的 MODEL_MAPPING 中定义！")
+            return jsonify({"success": False, "error": f"服务器内部配置错误：模型 '{model_name}' 无法被后端处理。"}), 500
+        else:
+            # 模型根本没定义
+            return jsonify({"success": False, "error": f"无效的模型名称: {model_name}"}), 400
 
 
 
@@ -928,25 +4316,584 @@ def index():
     # 总是返回 chat.html，由前端 JS 决定显示登录还是主界面
     return send_from_directory('static', 'chat.html')
 
-# 主程序入口 (修改 webview.start)
-if __name__ == '__main__':
-    import webview
-    start_api_server() # <--- 在这里启动
-    # 启动 Flask app (webview 会处理)
-    logging.info("启动 Flask 应用和 webview 窗口...")
-    window = webview.create_window('FLYINGPIG-Chatbox', app, width=1000, height=700)
+# --- 新增：异步服务模式 (ASGI) ---
+# Flask 同步视图在等待上游回答期间会一直占着一个工作线程，并发数受线程数限制。
+# 异步模式下 /api/send 和 /api/send_stream 由原生 asyncio 处理 (AsyncOpenAI)，
+# 其余接口仍交给 Flask (通过 asgiref 的 WsgiToAsgi 适配)。
+# 需要额外安装：pip install asgiref uvicorn，启动方式：python chatapp_new.py --asgi
+ASYNC_SERVING_DEFAULTS = {
+    "host": "127.0.0.1",
+    "port": 5000,
+    "max_inflight": 200, # 同时进行中的上游调用上限，超出的请求排队等待
+}
+_async_openai_client = None
+_async_openai_client_key = None # (base_url, generation)
+_async_direct_clients = {} # (base_url, api_key) -> AsyncOpenAI 客户端
+_upstream_semaphore = None
+
+def get_async_serving_settings():
+    """默认异步服务参数，叠加 Uconfig.json 中 "async_serving" 的覆盖项"""
+    settings = dict(ASYNC_SERVING_DEFAULTS)
+    overrides = config.get("async_serving") or {}
+    settings.update({k: v for k, v in overrides.items() if k in ASYNC_SERVING_DEFAULTS})
+    return settings
+
+def get_async_openai_client():
+    """获取事件循环内共享的 AsyncOpenAI 客户端及其 base_url (只在事件循环线程中调用，无需加锁)"""
+    global _async_openai_client, _async_openai_client_key
+    key = (BASE_URL, _openai_client_generation)
+    if _async_openai_client is None or _async_openai_client_key != key:
+        old_client = _async_openai_client
+        _async_openai_client = build_async_openai_client(key[0])
+        _async_openai_client_key = key
+        logging.info(f"已创建共享 AsyncOpenAI 客户端 (base_url: {key[0]})")
+        if old_client is not None:
+            # 与同步客户端相同：等在途请求结束后再关闭旧连接池
+            grace = get_http_client_settings()["read_timeout"] + 5
+            asyncio.get_running_loop().call_later(grace, lambda: asyncio.ensure_future(old_client.close()))
+    return _async_openai_client, _async_openai_client_key[0]
+
+def get_async_upstream(username, model_name):
+    """get_direct_route 的异步版本：返回 (AsyncOpenAI 客户端, base_url)"""
+    route = get_direct_route(username, model_name)
+    if not route:
+        return get_async_openai_client()
+    if route not in _async_direct_clients:
+        if len(_async_direct_clients) >= DIRECT_CLIENT_CACHE_SIZE:
+            old_client = _async_direct_clients.pop(next(iter(_async_direct_clients)))
+            grace = get_http_client_settings()["read_timeout"] + 5
+            asyncio.get_running_loop().call_later(grace, lambda: asyncio.ensure_future(old_client.close()))
+        _async_direct_clients[route] = build_async_openai_client(route[0], api_key=route[1])
+    return _async_direct_clients[route], route[0]
+
+def get_upstream_semaphore():
+    """限制同时进行的上游调用数量"""
+    global _upstream_semaphore
+    if _upstream_semaphore is None:
+        _upstream_semaphore = asyncio.Semaphore(get_async_serving_settings()["max_inflight"])
+    return _upstream_semaphore
+
+# 异步模式下的相同请求合并，规则与 singleflight / singleflight_stream 相同。
+# 这两张表只在事件循环线程中访问，不需要加锁；计数与同步模式共用。
+_async_singleflight_calls = {} # key -> {"future": asyncio.Future, "tracker"}
+_async_singleflight_streams = {} # key -> {"parts": [...], "done": bool, "error", "followers": int, "tracker", "changed": asyncio.Event}
+_async_drain_tasks = set() # 保留后台读取任务的引用，避免被垃圾回收
+
+async def async_singleflight(key, model_name, make_coro, tracker=None):
+    """相同 key 的并发调用只 await 一次 make_coro()，所有调用方得到同一个结果 (tracker 同 singleflight)"""
+    call = _async_singleflight_calls.get(key)
+    if call is not None:
+        _count_singleflight(model_name, "coalesced")
+        result = await asyncio.shield(call["future"]) # 某个等待者被取消不影响其他调用方
+        share_usage_tracker(call, tracker)
+        return result
+    _count_singleflight(model_name, "upstream_calls")
+    future = asyncio.get_running_loop().create_future()
+    _async_singleflight_calls[key] = {"future": future, "tracker": tracker}
+    try:
+        result = await make_coro()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else RuntimeError("共享的上游请求已被取消"))
+        future.exception() # 没有等待者时避免 "exception was never retrieved" 警告
+        raise
+    finally:
+        _async_singleflight_calls.pop(key, None)
+
+async def async_singleflight_stream(key, model_name, make_stream, tracker=None):
+    """流式版本：相同 key 的并发请求共享 make_stream() 产生的同一个上游流 (tracker 同 singleflight)"""
+    call = _async_singleflight_streams.get(key)
+    if call is not None:
+        _count_singleflight(model_name, "coalesced")
+        call["followers"] += 1
+        index = 0
+        try:
+            while True:
+                if len(call["parts"]) == index and not call["done"]:
+                    call["changed"].clear()
+                    await call["changed"].wait()
+                    continue
+                new_parts = call["parts"][index:]
+                index += len(new_parts)
+                for delta in new_parts:
+                    yield delta
+                if call["done"] and index == len(call["parts"]):
+                    if call["error"] is not None:
+                        raise call["error"]
+                    share_usage_tracker(call, tracker)
+                    return
+        finally:
+            call["followers"] -= 1
 
-    webview.start(debug=False) # <-- 移除 storage_path
+    _count_singleflight(model_name, "upstream_calls")
+    call = {"parts": [], "done": False, "error": None, "followers": 0, "tracker": tracker, "changed": asyncio.Event()}
+    _async_singleflight_streams[key] = call
+    stream = make_stream()
+    handed_off = False
+    try:
+        async for delta in stream:
+            call["parts"].append(delta)
+            call["changed"].set()
+            yield delta
+    except asyncio.CancelledError:
+        # 取消发生在读取上游的 await 处，上游流已随之中断，无法再交给跟随者
+        call["error"] = RuntimeError("共享的上游请求已被取消")
+        raise
+    except GeneratorExit:
+        # leader 的客户端断开 (停在 yield 处，上游流完好)：还有跟随者时交给后台任务读完，否则直接关闭
+        handed_off = call["followers"] > 0
+        if handed_off:
+            task = asyncio.get_running_loop().create_task(_async_drain_shared_stream(key, call, stream))
+            _async_drain_tasks.add(task)
+            task.add_done_callback(_async_drain_tasks.discard)
+        else:
+            _async_singleflight_streams.pop(key, None)
+        raise
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        if not handed_off:
+            await _async_finish_shared_stream(key, call, stream)
+
+async def _async_finish_shared_stream(key, call, stream):
+    await stream.aclose()
+    _async_singleflight_streams.pop(key, None)
+    call["done"] = True
+    call["changed"].set()
+
+async def _async_drain_shared_stream(key, call, stream):
+    """leader 断开后继续读取上游流；跟随者也全部断开时停止"""
+    try:
+        async for delta in stream:
+            call["parts"].append(delta)
+            call["changed"].set()
+            if call["followers"] == 0:
+                _async_singleflight_streams.pop(key, None)
+                break
+    except Exception as e:
+        call["error"] = e
+    finally:
+        await _async_finish_shared_stream(key, call, stream)
+
+# 异步模式下的上游容错，规则与 run_with_retries / resilient_call / resilient_stream 相同，
+# 熔断状态、延迟样本和计数与同步模式共用。
+async def async_run_with_retries(model_name, attempt):
+    """对单个模型 await attempt(model_name)，暂时性错误按退避重试"""
+    settings = get_fault_tolerance_settings()
+    for retry_index in range(settings["max_retries"] + 1):
+        if not breaker_allow(model_name):
+            raise RuntimeError(f"模型 '{model_name}' 暂时不可用 (熔断中)")
+        count_fault_event(model_name, "calls")
+        start = time.perf_counter()
+        try:
+            result = await attempt(model_name)
+        except Exception as e:
+            observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, model_name, "error")
+            if not is_retryable_error(e):
+                raise
+            breaker_record_failure(model_name)
+            delay = backoff_delay(retry_index, e, settings)
+            if retry_index == settings["max_retries"] or delay is None:
+                raise
+            count_fault_event(model_name, "retries")
+            logging.warning(f"调用模型 '{model_name}' 失败 ({e})，{delay:.2f} 秒后重试")
+            await asyncio.sleep(delay)
+            continue
+        elapsed = time.perf_counter() - start
+        record_latency(model_name, elapsed)
+        observe("chatapp_upstream_request_duration_seconds", elapsed, model_name, "success")
+        breaker_record_success(model_name)
+        return result
+
+async def async_hedged_call(model_name, fallback_model, attempt, settings):
+    """hedged_call 的异步版本，落后的请求会被取消"""
+    primary = asyncio.ensure_future(async_run_with_retries(model_name, attempt))
+    done, _ = await asyncio.wait({primary}, timeout=get_hedge_delay(model_name, settings))
+    if done and primary.exception() is None:
+        return primary.result()
+    if done and not (is_retryable_error(primary.exception()) or breaker_is_open(model_name)):
+        raise primary.exception()
+    if not done:
+        logging.info(f"模型 '{model_name}' 响应较慢，同时请求备用模型 '{fallback_model}'")
+        count_fault_event(model_name, "hedges")
+    else:
+        count_fault_event(model_name, "fallbacks")
+    hedge = asyncio.ensure_future(async_run_with_retries(fallback_model, attempt))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        count_fault_event(model_name, "hedge_wins")
+                    return task.result()
+        raise primary.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def async_resilient_call(model_name, attempt):
+    """resilient_call 的异步版本"""
+    settings = get_fault_tolerance_settings()
+    fallback = get_fallback_model(model_name)
+    if fallback and breaker_is_open(model_name):
+        logging.warning(f"模型 '{model_name}' 熔断中，改用备用模型 '{fallback}'")
+        count_fault_event(model_name, "fallbacks")
+        return await async_run_with_retries(fallback, attempt)
+    if fallback and settings["hedge"] and not breaker_is_open(fallback):
+        return await async_hedged_call(model_name, fallback, attempt, settings)
+    try:
+        return await async_run_with_retries(model_name, attempt)
+    except Exception as e:
+        if not fallback or not (is_retryable_error(e) or breaker_is_open(model_name)):
+            raise
+        logging.warning(f"模型 '{model_name}' 调用失败 ({e})，改用备用模型 '{fallback}'")
+        count_fault_event(model_name, "fallbacks")
+        return await async_run_with_retries(fallback, attempt)
+
+async def async_resilient_stream(model_name, make_stream):
+    """resilient_stream 的异步版本，make_stream(target_model) 返回异步迭代器"""
+    settings = get_fault_tolerance_settings()
+    fallback = get_fallback_model(model_name)
+    candidates = [model_name] + ([fallback] if fallback else [])
+    if fallback and breaker_is_open(model_name):
+        logging.warning(f"模型 '{model_name}' 熔断中，改用备用模型 '{fallback}'")
+        candidates = [fallback]
+    last_error = None
+    for target in candidates:
+        if target != model_name:
+            count_fault_event(model_name, "fallbacks")
+        for retry_index in range(settings["max_retries"] + 1):
+            if not breaker_allow(target):
+                last_error = RuntimeError(f"模型 '{target}' 暂时不可用 (熔断中)")
+                break
+            count_fault_event(target, "calls")
+            started = False
+            start = time.perf_counter()
+            stream = make_stream(target)
+            try:
+                async for delta in stream:
+                    started = True
+                    yield delta
+            except Exception as e:
+                observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, target, "error")
+                if not is_retryable_error(e):
+                    raise
+                breaker_record_failure(target)
+                delay = backoff_delay(retry_index, e, settings)
+                if started:
+                    raise
+                last_error = e
+                if retry_index == settings["max_retries"] or delay is None:
+                    break
+                count_fault_event(target, "retries")
+                logging.warning(f"流式调用模型 '{target}' 失败 ({e})，{delay:.2f} 秒后重试")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                await stream.aclose()
+            observe("chatapp_upstream_request_duration_seconds", time.perf_counter() - start, target, "success")
+            breaker_record_success(target)
+            return
+    raise last_error
+
+async def async_ai_call(text, state):
+    """ai_call 的异步版本"""
+    username = state["username"]
+    model_name = resolve_model_name(state["api"])
+    # 上下文未缓存时需要读数据库，放到线程池中执行
+    messages = await asyncio.to_thread(build_chat_messages, username, state["session_id"], text, model_name)
+    cached = await asyncio.to_thread(completion_cache_get, model_name, state["temperature"], messages) # 磁盘层可能需要读文件
+    if cached is not None:
+        return cached
+
+    async def attempt(target_model):
+        logging.info(f"使用模型 '{target_model}' (API标识: {state['api']}, 温度: {state['temperature']}) 进行异步调用")
+        async with get_upstream_semaphore():
+            client, base_url = get_async_upstream(username, target_model)
+            with track_inflight(base_url):
+                start = time.perf_counter()
+                response = await client.chat.completions.create(
+                    model=target_model,
+                    messages=messages,
+                )
+        content = response.choices[0].message.content
+        record_usage(username, target_model, time.perf_counter() - start, response.usage, messages, content, tracker)
+        return content
+
+    async def call_upstream():
+        content = await async_resilient_call(model_name, attempt)
+        await asyncio.to_thread(completion_cache_put, model_name, state["temperature"], messages, content)
+        return content
+
+    tracker = new_usage_tracker()
+    key = coalesce_key(username, model_name, completion_cache_key(model_name, state["temperature"], messages))
+    content = await async_singleflight(key, model_name, call_upstream, tracker)
+    if tracker["shared"]:
+        record_shared_usage(username, tracker)
+    return content
+
+async def async_ai_call_stream(text, state):
+    """ai_call_stream 的异步版本"""
+    username = state["username"]
+    model_name = resolve_model_name(state["api"])
+    messages = await asyncio.to_thread(build_chat_messages, username, state["session_id"], text, model_name)
+    cached = await asyncio.to_thread(completion_cache_get, model_name, state["temperature"], messages)
+    if cached is not None:
+        yield cached
+        return
+
+    async def open_stream(target_model):
+        logging.info(f"使用模型 '{target_model}' (API标识: {state['api']}, 温度: {state['temperature']}) 进行异步流式调用")
+        async with get_upstream_semaphore():
+            client, base_url = get_async_upstream(username, target_model)
+            with track_inflight(base_url):
+                start = time.perf_counter()
+                stream = await client.chat.completions.create(
+                    model=target_model,
+                    messages=messages,
+                    stream=True,
+                    **stream_usage_options(),
+                )
+                first_token = True
+                usage = None
+                parts = []
+                try:
+                    async for chunk in stream:
+                        usage = getattr(chunk, "usage", None) or usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if not delta:
+                            continue
+                        if first_token:
+                            record_ttft(target_model, time.perf_counter() - start)
+                            first_token = False
+                        parts.append(delta)
+                        yield delta
+                finally:
+                    await stream.close()
+                    if usage is not None or parts:
+                        record_usage(username, target_model, time.perf_counter() - start, usage, messages, "".join(parts), tracker)
+
+    async def upstream_stream():
+        parts = []
+        async for delta in async_resilient_stream(model_name, open_stream):
+            parts.append(delta)
+            yield delta
+        await asyncio.to_thread(completion_cache_put, model_name, state["temperature"], messages, "".join(parts))
+
+    tracker = new_usage_tracker()
+    key = coalesce_key(username, model_name, completion_cache_key(model_name, state["temperature"], messages))
+    async for delta in async_singleflight_stream(key, model_name, upstream_stream, tracker):
+        yield delta
+    if tracker["shared"]:
+        record_shared_usage(username, tracker)
+
+async def _asgi_read_json(receive):
+    """读取完整请求体并解析为 JSON"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return json.loads(body) if body else {}
+
+async def _asgi_request_state(scope, username):
+    """从 ASGI 请求的 Cookie / 请求头中取出 token 并读取用户状态 (与 get_request_state 规则相同)"""
+    token = None
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            cookie = http.cookies.SimpleCookie()
+            cookie.load(value.decode("latin-1"))
+            if AUTH_COOKIE_NAME in cookie:
+                token = cookie[AUTH_COOKIE_NAME].value
+        elif name == AUTH_HEADER_NAME.lower().encode() and not token:
+            token = value.decode("latin-1")
+    state = await asyncio.to_thread(load_user_state, token) # sqlite 后端需要读文件
+    if state is not None and state["username"] != username:
+        return None
+    return state
 
-    # 清理 simple-one-api 进程 (当 webview 关闭时)
-    if api_process and api_process.poll() is None: # 检查进程是否存在且在运行
-        logging.info("Webview 关闭，正在尝试终止 simple-one-api 进程...")
+async def _asgi_send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def async_admit_request(state):
+    """在线程中排队，不阻塞事件循环；请求被取消时，随后拿到的名额会立即归还"""
+    future = asyncio.ensure_future(asyncio.to_thread(admit_request, state))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        def release_late(f):
+            if not f.cancelled() and f.exception() is None:
+                release_admission(f.result()[0])
+        future.add_done_callback(release_late)
+        raise
+
+async def _asgi_send_rejected(send, rejection):
+    """与 admission_rejected_response 相同的 429 响应"""
+    retry_after = math.ceil(rejection["retry_after"])
+    await _asgi_send_json(send, {'success': False, 'error': ADMISSION_REJECT_MESSAGES[rejection["reason"]], 'retry_after': retry_after},
+                          429, headers=[(b"retry-after", str(retry_after).encode())])
+
+async def _asgi_send_quota_exceeded(send, exceeded):
+    """与 quota_exceeded_response 相同的 429 响应"""
+    logging.warning(quota_exceeded_message(exceeded))
+    retry_after = math.ceil(exceeded["retry_after"])
+    await _asgi_send_json(send, {'success': False, 'error': quota_exceeded_message(exceeded), 'retry_after': retry_after},
+                          429, headers=[(b"retry-after", str(retry_after).encode())])
+
+async def _asgi_send_not_ready(send):
+    """与 upstream_not_ready_response 相同的 503 响应"""
+    logging.warning("simple-one-api 尚未就绪，拒绝发送请求")
+    await _asgi_send_json(send, {'success': False, 'error': 'AI 服务正在启动，请稍后重试'}, 503,
+                          headers=[(b"retry-after", b"2")])
+
+async def async_handle_message(scope, receive, send):
+    """/api/send 的异步实现，请求/响应格式与 handle_message 相同"""
+    data = await _asgi_read_json(receive)
+    user_input = data.get('message', '')
+    username = data.get('username')
+
+    state = await _asgi_request_state(scope, username)
+    if not username or state is None:
+         logging.warning("收到发送消息请求，但缺少用户名或认证无效")
+         return await _asgi_send_json(send, {'success': False, 'error': '用户未登录或请求无效'}, 401)
+    if not await asyncio.to_thread(ensure_upstream_ready, state):
+        return await _asgi_send_not_ready(send)
+    exceeded = await asyncio.to_thread(check_usage_quota, username) # 可能需要读数据库
+    if exceeded:
+        return await _asgi_send_quota_exceeded(send, exceeded)
+    ticket, rejection = await async_admit_request(state)
+    if rejection:
+        return await _asgi_send_rejected(send, rejection)
+
+    logging.info(f"用户 {username} 发送消息: {user_input[:50]}...")
+    try:
+        response = await async_ai_call(user_input, state)
+        save_chat(username, user_input, response, state["session_id"]) # 只入队，不会阻塞事件循环
+        await _asgi_send_json(send, {'success': True, 'response': response})
+    except Exception as e:
+        logging.error(f"处理用户 {username} 消息时出错: {e}")
+        await _asgi_send_json(send, {'success': False, 'error': f'处理消息时出错: {e}'}, 500)
+    finally:
+        release_admission(ticket)
+
+async def async_handle_message_stream(scope, receive, send):
+    """/api/send_stream 的异步实现，SSE 格式与 handle_message_stream 相同"""
+    data = await _asgi_read_json(receive)
+    user_input = data.get('message', '')
+    username = data.get('username')
+
+    state = await _asgi_request_state(scope, username)
+    if not username or state is None:
+         logging.warning("收到流式发送消息请求，但缺少用户名或认证无效")
+         return await _asgi_send_json(send, {'success': False, 'error': '用户未登录或请求无效'}, 401)
+    if not await asyncio.to_thread(ensure_upstream_ready, state):
+        return await _asgi_send_not_ready(send)
+    exceeded = await asyncio.to_thread(check_usage_quota, username) # 可能需要读数据库
+    if exceeded:
+        return await _asgi_send_quota_exceeded(send, exceeded)
+    ticket, rejection = await async_admit_request(state)
+    if rejection:
+        return await _asgi_send_rejected(send, rejection)
+
+    logging.info(f"用户 {username} 发送消息 (流式): {user_input[:50]}...")
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+
+        async def push(chunk):
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+
+        parts = []
         try:
-            api_process.terminate()
-            api_process.wait(timeout=5)
-            logging.info("simple-one-api 进程已终止。")
-        except subprocess.TimeoutExpired:
-            if api_process.poll() is None: api_process.kill()
-            logging.info("simple-one-api 进程已被强制结束。")
+            async for delta in async_ai_call_stream(user_input, state):
+                parts.append(delta)
+                await push(sse_event({"delta": delta}))
         except Exception as e:
-             logging.warning(f"关闭时终止 simple-one-api 出错: {e}")
\ No newline at end of file
+            logging.error(f"处理用户 {username} 流式消息时出错: {e}")
+            await push(sse_event({"error": f"处理消息时出错: {e}"}, event="error"))
+        else:
+            save_chat(username, user_input, "".join(parts), state["session_id"])
+            await push(sse_event({"done": True}, event="done"))
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        release_admission(ticket)
+
+ASYNC_ROUTES = {
+    ("POST", "/api/send"): async_handle_message,
+    ("POST", "/api/send_stream"): async_handle_message_stream,
+}
+
+async def _observe_asgi_handler(handler, scope, receive, send):
+    """异步路由的请求指标，口径与 Flask 路由相同 (记录到响应开始为止)"""
+    start = time.perf_counter()
+    inc_counter("chatapp_http_requests_in_progress")
+
+    async def send_with_metrics(message):
+        if message["type"] == "http.response.start":
+            observe("chatapp_http_request_duration_seconds", time.perf_counter() - start,
+                    scope["path"], scope["method"], str(message["status"]))
+        await send(message)
+
+    try:
+        return await handler(scope, receive, send_with_metrics)
+    finally:
+        inc_counter("chatapp_http_requests_in_progress", amount=-1)
+
+def create_asgi_app():
+    """构建 ASGI 应用：聊天接口走原生 asyncio，其余请求转交 Flask"""
+    from asgiref.wsgi import WsgiToAsgi # 可选依赖，只在异步模式下导入
+
+    initialize_app() # 异步路由不经过 Flask 的 before_request
+    flask_asgi = WsgiToAsgi(app)
+
+    async def asgi_app(scope, receive, send):
+        if scope["type"] == "http":
+            handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+            if handler is not None:
+                return await _observe_asgi_handler(handler, scope, receive, send)
+        return await flask_asgi(scope, receive, send)
+
+    return asgi_app
+
+def run_asgi_server():
+    """使用 uvicorn 以异步模式运行 (阻塞直到服务停止)"""
+    import uvicorn # 可选依赖，只在异步模式下导入
+
+    settings = get_async_serving_settings()
+    logging.info(f"以异步模式启动服务: http://{settings['host']}:{settings['port']} "
+                 f"(上游并发上限 {settings['max_inflight']})")
+    uvicorn.run(create_asgi_app(), host=settings["host"], port=settings["port"], log_level="info")
+
+record_startup_phase("module_load", time.perf_counter() - _MODULE_LOAD_START)
+
+# 主程序入口 (修改 webview.start)
+if __name__ == '__main__':
+    run_startup() # **修改：** simple-one-api 在后台启动，不再阻塞窗口创建
+    if "--asgi" in sys.argv:
+        # 新增：异步服务模式，不打开 webview 窗口，用浏览器访问
+        run_asgi_server()
+    else:
+        import webview
+        STATE_STORE_DEFAULTS["restore_last_login"] = True # 新增：桌面窗口只有本机一个用户，重启后恢复上次登录
+        # 启动 Flask app (webview 会处理)
+        logging.info("启动 Flask 应用和 webview 窗口...")
+        window = webview.create_window('FLYINGPIG-Chatbox', app, width=1000, height=700)
+
+        webview.start(debug=False) # <-- 移除 storage_path
+
+    # 清理 simple-one-api 进程 (当 webview 关闭或异步服务停止时)
+    stop_all_sidecars()
+    stop_history_writer() # 写完队列中尚未落盘的聊天记录
+    flush_user_keys() # 写回尚未落盘的密钥修改
+    flush_usage() # 写入尚未落盘的 token 用量
\ No newline at end of file
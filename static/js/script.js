@@ -420,19 +420,49 @@
             input.value = '';//清空输入框内容。
 
             try {
-                const response = await fetch('/api/send', {
+                // **修改：** 改用流式接口，回答边生成边显示
+                const response = await fetch('/api/send_stream', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    // **修改：** 发送消息和用户名 (这里逻辑不变，因为之前已从变量获取)
                     body: JSON.stringify({ message: message, username: loggedInUser })
                 });
 
-                const data = await response.json();
-                if (data.success) {
-                    addMessage(data.response, 'ai');
-                    // 可以在这里考虑是否需要更新历史列表预览，目前不刷新
-                } else {
+                if (!response.ok || !response.body) {
+                    // 流开始前的错误 (如未登录) 仍以 JSON 返回
+                    const data = await response.json();
                     showError(data.error);
+                    return;
+                }
+
+                const chatArea = document.getElementById('chatArea');
+                const aiDiv = addMessage('', 'ai'); // 先放一个空的 AI 气泡，收到增量后更新
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let fullText = '';
+
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+
+                    // SSE 事件之间以空行分隔
+                    let sep;
+                    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                        const rawEvent = buffer.slice(0, sep);
+                        buffer = buffer.slice(sep + 2);
+                        const dataLine = rawEvent.split('\n').find(line => line.startsWith('data: '));
+                        if (!dataLine) continue;
+
+                        const payload = JSON.parse(dataLine.slice(6));
+                        if (payload.delta) {
+                            fullText += payload.delta;
+                            aiDiv.innerHTML = marked.parse(fullText);
+                            chatArea.scrollTop = chatArea.scrollHeight;
+                        } else if (payload.error) {
+                            showError(payload.error);
+                        }
+                    }
                 }
             } catch (error) {
                 showError('与服务器通信时出错: '+ error);
@@ -456,7 +486,7 @@
             chatArea.scrollTop = chatArea.scrollHeight; 
             // `chatArea.scrollHeight` 是 `chatArea` 内部内容的总高度（即使内容超出了可见区域）。
              // `chatArea.scrollTop` 是 `chatArea` 向上滚动的距离。将其设置为 `scrollHeight` 意味着滚动到最底部，使用户能看到最新的消息。
-            
+            return div; // 新增：返回元素，流式输出时需要持续更新它
         }
 
         // 显示错误 (不变)
@@ -585,9 +615,8 @@
              }
             console.log(`用户 ${username} 尝试加载会话: ${sessionId}`);
             try {
-                // **修改：** 在请求中加入用户名 (这里逻辑不变)
-                const response = await fetch(`/api/load_session?session=${sessionId}&user=${encodeURIComponent(username)}`);
-                const data = await response.json();
+                // **修改：** 只取最近一页，更早的消息点击“加载更早的消息”再取
+                const data = await fetchSessionPage(sessionId, username, null);
 
                 if (data.success) {
                     const chatArea = document.getElementById('chatArea');
@@ -597,6 +626,7 @@
                     data.messages.forEach(message => {
                         addMessage(message.text, message.sender);
                     });
+                    updateLoadEarlierButton(sessionId, username, data);
 
                     // 确保滚动到底部
                     chatArea.scrollTop = chatArea.scrollHeight;
@@ -615,6 +645,57 @@
                 console.error("加载会话错误:", error);
             }
         }
+
+        // 新增：获取会话的一页消息 (cursor 为空时取最新一页)
+        async function fetchSessionPage(sessionId, username, cursor) {
+            let url = `/api/load_session?session=${sessionId}&user=${encodeURIComponent(username)}`;
+            if (cursor) {
+                url += `&before=${encodeURIComponent(cursor)}`;
+            }
+            const response = await fetch(url);
+            return response.json();
+        }
+
+        // 新增：在聊天区顶部显示/移除“加载更早的消息”按钮
+        function updateLoadEarlierButton(sessionId, username, data) {
+            const chatArea = document.getElementById('chatArea');
+            const existing = document.getElementById('loadEarlierBtn');
+            if (existing) {
+                existing.remove();
+            }
+            if (!data.has_more) {
+                return;
+            }
+            const button = document.createElement('button');
+            button.id = 'loadEarlierBtn';
+            button.className = 'load-earlier-btn';
+            button.textContent = '加载更早的消息';
+            button.onclick = () => loadEarlierMessages(sessionId, username, data.next_cursor);
+            chatArea.insertBefore(button, chatArea.firstChild);
+        }
+
+        // 新增：加载更早的一页，插入到顶部并保持当前阅读位置
+        async function loadEarlierMessages(sessionId, username, cursor) {
+            try {
+                const data = await fetchSessionPage(sessionId, username, cursor);
+                if (!data.success) {
+                    showError(data.error || '加载更早的消息失败');
+                    return;
+                }
+                const chatArea = document.getElementById('chatArea');
+                const previousHeight = chatArea.scrollHeight;
+                const button = document.getElementById('loadEarlierBtn');
+                const anchor = button ? button.nextSibling : chatArea.firstChild;
+                data.messages.forEach(message => {
+                    const div = addMessage(message.text, message.sender);
+                    chatArea.insertBefore(div, anchor); // addMessage 追加在末尾，这里移动到顶部
+                });
+                updateLoadEarlierButton(sessionId, username, data);
+                chatArea.scrollTop = chatArea.scrollHeight - previousHeight;
+            } catch (error) {
+                showError('加载更早的消息时发生网络错误: ' + error);
+            }
+        }
     
         async function loadModels() {
             if (!currentUsername) return; // 确保已登录